@@ -1,6 +1,7 @@
 import streamlit as st
 import pyrebase  # Added for Firebase
 import json      # Added to parse Firebase errors
+import rag_backend as rb
 
 # --- Firebase Configuration ---
 firebase_config = {
@@ -32,6 +33,9 @@ def init_firebase():
 
 auth = init_firebase()
 
+# Load the embedding model and open API clients in the background while the user logs in.
+rb.start_warm_up()
+
 # --- Page Configuration ---
 st.set_page_config(
     page_title="CARAG Home", # --- MODIFIED: Renamed
@@ -186,7 +190,7 @@ else:
 
     if st.button("Logout", type="primary"):
         # Robust logout to clear all session data
-        keys_to_clear = ["authenticated", "user", "username", "messages", "history", "faiss_index", "chunks", "pdf_name"]
+        keys_to_clear = ["authenticated", "user", "username", "messages", "history", "faiss_index", "chunks", "pdf_name", "pdf_hash", "collection", "collection_handle", "history_synced"]
         for key in keys_to_clear:
             if key in st.session_state:
                 del st.session_state[key]
@@ -0,0 +1,548 @@
+"""Offline benchmark for ingestion, indexing and retrieval.
+
+Runs rag_backend end to end without network access: synthetic PDFs, a
+hashing embedder (or a locally cached sentence-transformers model), and stub
+Groq, Tavily and Firestore clients. Results are written as JSON so runs from
+different commits can be compared:
+
+    python benchmark.py --pages 10 100 1000 --output bench_new.json --compare bench_old.json
+"""
+import os
+import re
+import io
+import sys
+import json
+import time
+import zlib
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+from collections import Counter
+
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+import numpy as np
+import faiss
+import rag_backend as rb
+from llm_gateway import LLMGateway, FakeLLMBackend
+from tracing import tracer
+
+
+# --- Synthetic Corpus ---
+SYLLABLES = ["ka", "lo", "mi", "ren", "ta", "vo", "shi", "nu", "pel", "dra", "qua", "zi", "mor", "tes", "bri", "un"]
+
+def make_vocabulary(size=3000, seed=0):
+    """Returns size distinct pseudo-words."""
+    rng = np.random.default_rng(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES, rng.integers(2, 5))))
+    return sorted(words)
+
+def _pseudo_lines(rng, vocabulary, topic, num_lines, line_chars):
+    words = []
+    while sum(len(w) + 1 for w in words) < num_lines * line_chars:
+        sentence = [rng.choice(topic) if rng.random() < 0.3 else rng.choice(vocabulary)
+                    for _ in range(rng.integers(8, 17))]
+        sentence[0] = sentence[0].capitalize()
+        sentence[-1] += "."
+        words.extend(sentence)
+    lines, line = [], ""
+    for word in words:
+        if len(line) + len(word) + 1 > line_chars:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    return lines[:num_lines]
+
+def synthetic_pages(num_pages, seed=0, lines_per_page=40, line_chars=90, boilerplate_lines=0):
+    """Returns num_pages pages of pseudo-text; each page favours its own topic words.
+
+    boilerplate_lines of each page are the same disclaimer text on every page.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(seed=seed)
+    disclaimer = []
+    if boilerplate_lines:
+        disclaimer_rng = np.random.default_rng(seed + 2)
+        disclaimer = _pseudo_lines(disclaimer_rng, vocabulary, vocabulary, boilerplate_lines, line_chars)
+    pages = []
+    for p in range(num_pages):
+        topic = rng.choice(vocabulary, 20, replace=False)
+        pages.append(_pseudo_lines(rng, vocabulary, topic, lines_per_page - len(disclaimer), line_chars) + disclaimer)
+    return pages
+
+def _pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def make_pdf(pages):
+    """Writes pages (lists of text lines) as a minimal single-font PDF. Returns its bytes."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for lines in pages:
+        content = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({_pdf_escape(l)}) Tj T*" for l in lines) + " ET"
+        stream = zlib.compress(content.encode("latin-1"))
+        objects.append(b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Resources << /Font << /F1 3 0 R >> >>"
+                       b" /Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{k} 0 R" for k in kids).encode(), len(kids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    out.writelines(b"%010d 00000 n \n" % offset for offset in offsets)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+def make_queries(pages, num_queries, seed=0):
+    """Returns (question, page_number) pairs built from sentences of random pages."""
+    rng = np.random.default_rng(seed + 1)
+    queries = []
+    for _ in range(num_queries):
+        p = int(rng.integers(len(pages)))
+        sentences = [s.strip() for s in re.split(r"(?<=\.)\s", " ".join(pages[p])) if len(s.split()) >= 6]
+        if sentences:
+            queries.append((sentences[int(rng.integers(len(sentences)))], p))
+    return queries
+
+
+# --- Stub Models and Clients ---
+class StubTokenizer:
+    """Approximates word-piece offsets (words split into pieces of up to 4 characters) for the "token" strategy."""
+
+    def __call__(self, text, add_special_tokens=False, return_offsets_mapping=False, **kwargs):
+        offsets = []
+        for match in re.finditer(r"\w+|[^\w\s]", text):
+            start, end = match.span()
+            offsets.extend((i, min(i + 4, end)) for i in range(start, end, 4))
+        return {"input_ids": list(range(len(offsets))), "offset_mapping": offsets}
+
+class HashingEmbedder:
+    """Deterministic bag-of-words embedder with the SentenceTransformer encode() interface."""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+        self.max_seq_length = 256
+        self.tokenizer = StubTokenizer()
+        self.encoded = 0
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False, **kwargs):
+        self.encoded += len(texts)
+        out = np.zeros((len(texts), self.dim), dtype='float32')
+        for i, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+                out[i, h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.maximum(norms, 1e-12)
+
+class StubTavily:
+    """Tavily client returning canned results after a fixed latency."""
+
+    def __init__(self, latency=0.3):
+        self.latency = latency
+
+    def search(self, query, search_depth="basic", max_results=3):
+        time.sleep(self.latency)
+        return {"results": [{"content": f"Result {i} for {query}: " + " ".join(make_vocabulary(40, i)[:30])}
+                            for i in range(max_results)]}
+
+class StubFirestore:
+    """Firestore client supporting the batched writes used by FirestoreHistoryWriter."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.documents = {}
+
+    def collection(self, name):
+        return _StubCollection(name)
+
+    def batch(self):
+        return _StubBatch(self)
+
+class _StubCollection:
+    def __init__(self, name):
+        self.name = name
+
+    def document(self, doc_id):
+        return (self.name, doc_id)
+
+class _StubBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append((ref, data))
+
+    def commit(self):
+        time.sleep(self.db.latency)
+        self.db.documents.update(self.writes)
+
+
+# --- Measurements ---
+def rss_bytes():
+    """Returns the current resident set size, or 0 where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def percentiles(seconds):
+    values = np.asarray(seconds) * 1000
+    if not len(values):
+        return {}
+    return {"p50_ms": float(np.percentile(values, 50)), "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)), "mean_ms": float(values.mean())}
+
+def bench_ingestion(pdf_bytes, num_pages, model, strategy, cache_dir):
+    t0 = time.perf_counter()
+    extracted = sum(1 for _ in rb.iter_pdf_pages(pdf_bytes))
+    extract_seconds = time.perf_counter() - t0
+
+    rss_before = rss_bytes()
+    encoded_before = getattr(model, "encoded", 0)
+    t0 = time.perf_counter()
+    collection = rb.DocumentCollection(model.get_sentence_embedding_dimension())
+    doc_id = collection.add_pdf(pdf_bytes, f"synthetic-{num_pages}.pdf", model, strategy=strategy,
+                                cache_dir=cache_dir)
+    ingest_seconds = time.perf_counter() - t0
+    # Only the hashing embedder counts the texts it encodes.
+    encoded = getattr(model, "encoded", 0) - encoded_before if hasattr(model, "encoded") else None
+    if doc_id is None:
+        raise RuntimeError(f"Ingestion of the {num_pages}-page PDF failed")
+
+    t0 = time.perf_counter()
+    collection.add_pdf(pdf_bytes, "cached.pdf", model, strategy=strategy, cache_dir=cache_dir)
+    cached_seconds = time.perf_counter() - t0
+    chunks = len(collection)
+    return collection, {
+        "pages": num_pages,
+        "pages_extracted": extracted,
+        "chunks": chunks,
+        "vectors": collection.index.ntotal,
+        "texts_embedded": encoded,
+        "extract_seconds": extract_seconds,
+        "extract_pages_per_second": extracted / extract_seconds,
+        "ingest_seconds": ingest_seconds,
+        "ingest_pages_per_second": num_pages / ingest_seconds,
+        "ingest_chunks_per_second": chunks / ingest_seconds,
+        "cached_load_seconds": cached_seconds,
+        "rss_delta_bytes": rss_bytes() - rss_before,
+        "memory": {k: v for k, v in collection.memory_report().items() if k != "documents"},
+    }
+
+def word_f1(reference, text):
+    """Word-level F1 of text against reference (bags of words, case-sensitive)."""
+    ref, got = Counter(reference.split()), Counter(text.split())
+    overlap = sum((ref & got).values())
+    if not overlap:
+        return 0.0 if ref or got else 1.0
+    precision, recall = overlap / sum(got.values()), overlap / sum(ref.values())
+    return 2 * precision * recall / (precision + recall)
+
+def bench_extractors(pdf_bytes, extractors, reference, cache_dir, revise=None):
+    """Pages/second and word F1 against reference (one text per page) for each extractor.
+
+    revise, a second version of the PDF with some pages changed, is used to time
+    re-extraction through the page cache. inline_seconds and pool_seconds time
+    extraction without and with the process pool, to check the extractor's
+    PARALLEL_EXTRACTION_PAGES threshold.
+    """
+    workers = max(2, os.cpu_count() or 1)
+    # Start the forkserver once, as a long-running app process would have.
+    for _ in rb.iter_pdf_pages(make_pdf([["Warm up."]] * 2), max_workers=2, pages_per_task=1,
+                               extractor=extractors[0], min_parallel_pages=0):
+        pass
+    results = {}
+    for name in extractors:
+        t0 = time.perf_counter()
+        texts = [text for _, text in rb.iter_pdf_pages(pdf_bytes, extractor=name)]
+        seconds = time.perf_counter() - t0
+        scores = [word_f1(ref, text) for ref, text in zip(reference, texts)]
+        results[name] = {"pages_per_second": len(texts) / seconds, "seconds": seconds,
+                         "mean_f1": float(np.mean(scores)), "min_f1": float(np.min(scores)),
+                         "parallel_threshold": rb.PARALLEL_EXTRACTION_PAGES.get(name), "pool_workers": workers}
+        modes = {"inline": {"max_workers": 1}, "pool": {"max_workers": workers, "min_parallel_pages": 0}}
+        for mode, kwargs in modes.items():
+            t0 = time.perf_counter()
+            for _ in rb.iter_pdf_pages(pdf_bytes, extractor=name, **kwargs):
+                pass
+            results[name][f"{mode}_seconds"] = time.perf_counter() - t0
+
+        cache = rb.PageTextCache(os.path.join(cache_dir, f"pages-{name}.sqlite3"))
+        t0 = time.perf_counter()
+        for _ in rb.iter_pdf_pages(pdf_bytes, extractor=name, cache=cache):
+            pass
+        results[name]["cache_cold_seconds"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for _ in rb.iter_pdf_pages(pdf_bytes, extractor=name, cache=cache):
+            pass
+        results[name]["cache_hit_seconds"] = time.perf_counter() - t0
+        if revise is not None:
+            t0 = time.perf_counter()
+            for _ in rb.iter_pdf_pages(revise, extractor=name, cache=cache):
+                pass
+            results[name]["cache_revised_seconds"] = time.perf_counter() - t0
+    return results
+
+def bench_indexes(embeddings, index_types, k, num_queries, seed):
+    results = {}
+    for index_type in index_types:
+        if index_type in ("ivf_flat", "ivf_pq") and len(embeddings) < 1000:
+            continue  # too few vectors to train the coarse quantizer meaningfully
+        rss_before = rss_bytes()
+        t0 = time.perf_counter()
+        index = rb.build_faiss_index(embeddings, index_type, seed=seed)
+        build_seconds = time.perf_counter() - t0
+        report = rb.evaluate_recall(index, embeddings, k=k, num_queries=num_queries, seed=seed)
+        report.update(build_seconds=build_seconds, rss_delta_bytes=rss_bytes() - rss_before)
+        results[index_type] = report
+    return results
+
+def bench_queries(collection, queries, embedder, gateway, k):
+    """Times retrieval-only and full speculative turns; also page hit rate@k."""
+    retrieval, speculative, first_token, hits = [], [], [], 0
+    for question, page in queries:
+        t0 = time.perf_counter()
+        results = rb.retrieve_from_collection(question, collection, embedder, k)
+        retrieval.append(time.perf_counter() - t0)
+        hits += any(hit["page"] == page for hit in results)
+
+        t0 = time.perf_counter()
+        turn = rb.retrieve_speculatively(question, gateway, collection, embedder, top_k=3)
+        stream = rb.generate_answer_stream(question, turn["chunks"], [], turn["source_type"])
+        next(stream, None)
+        first_token.append(time.perf_counter() - t0)
+        for _ in stream:
+            pass
+        speculative.append(time.perf_counter() - t0)
+    return {
+        "queries": len(queries),
+        "retrieval": percentiles(retrieval),
+        "time_to_first_token": percentiles(first_token),
+        "full_turn": percentiles(speculative),
+        "page_hit_rate_at_k": hits / max(len(queries), 1),
+    }
+
+def bench_history_writer(db, records, spill_path):
+    writer = rb.FirestoreHistoryWriter(lambda: db, spill_path=spill_path)
+    t0 = time.perf_counter()
+    for i in range(records):
+        writer.submit("bench", f"Question {i}", f"Answer {i}")
+    submit_seconds = time.perf_counter() - t0
+    flushed = writer.flush(timeout=60)
+    total_seconds = time.perf_counter() - t0
+    writer.close()
+    return {"records": records, "submit_us_per_record": 1e6 * submit_seconds / records,
+            "records_per_second": records / total_seconds, "flushed": flushed, "batches": writer.stats["batches"]}
+
+def import_report():
+    """Cold import times in seconds: rag_backend (including interpreter start-up), then each deferred dependency."""
+    t0 = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", "import rag_backend"], capture_output=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    report = {"rag_backend": time.perf_counter() - t0 if result.returncode == 0 else None}
+    report.update((name, seconds) for name, seconds, _ in rb.import_profile(cold=True))
+    return report
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count(), "numpy": np.__version__,
+            "faiss": getattr(faiss, "__version__", None)}
+
+
+# --- Comparison ---
+def flatten(results, prefix=""):
+    """Flattens nested result dicts into {"a.b.c": number}."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(old, new, threshold=0.1):
+    """Returns rows (metric, old, new, relative change) for metrics that changed by more than threshold."""
+    old_flat, new_flat = flatten(old.get("results", {})), flatten(new.get("results", {}))
+    rows = []
+    for name in sorted(old_flat.keys() & new_flat.keys()):
+        a, b = old_flat[name], new_flat[name]
+        change = (b - a) / abs(a) if a else (0.0 if b == a else float("inf"))
+        if abs(change) > threshold:
+            rows.append((name, a, b, change))
+    return rows
+
+
+def run(args):
+    model = HashingEmbedder() if args.model == "hash" else rb.sentence_transformers.SentenceTransformer(args.model)
+    embedder = rb.QueryEmbedder(model)
+    gateway = LLMGateway(FakeLLMBackend(latency=args.llm_latency), requests_per_minute=None,
+                         tokens_per_minute=None, model_limits={})
+    workdir = tempfile.mkdtemp(prefix="carag-bench-")
+
+    # Route every client and cache the backend would create to stubs or the scratch directory.
+    rb.get_sentence_transformer = lambda: model
+    rb.get_query_embedder = lambda: embedder
+    rb.get_llm_gateway = lambda: gateway
+    rb.get_tavily_client = lambda: StubTavily(args.web_latency)
+    web_cache = rb.WebSearchCache(path=os.path.join(workdir, "web.sqlite3"))
+    rb.get_web_search_cache = lambda: web_cache
+    router = rb.LocalRouter(embedder)
+    rb.get_local_router = lambda: router
+
+    results = {"ingestion": {}, "indexes": {}, "queries": {}}
+    for num_pages in args.pages:
+        pages = synthetic_pages(num_pages, seed=args.seed, boilerplate_lines=args.boilerplate)
+        pdf_bytes = make_pdf(pages)
+        # Corpora of different sizes share their first pages, so each size gets empty
+        # page text and chunk vector caches; otherwise larger runs reuse smaller ones' work.
+        size_dir = os.path.join(workdir, str(num_pages))
+        os.makedirs(size_dir)
+        page_cache = rb.PageTextCache(os.path.join(size_dir, "pages.sqlite3"))
+        vector_cache = rb.ChunkVectorCache(os.path.join(size_dir, "chunk_vectors.sqlite3"))
+        rb.get_page_text_cache = lambda cache=page_cache: cache
+        rb.get_chunk_vector_cache = lambda cache=vector_cache: cache
+        print(f"[{num_pages} pages] ingesting ({len(pdf_bytes) / 1e6:.1f} MB PDF)...", file=sys.stderr)
+        collection, ingestion = bench_ingestion(pdf_bytes, num_pages, model, args.strategy,
+                                                os.path.join(workdir, "indexes"))
+        results["ingestion"][str(num_pages)] = ingestion
+
+        print(f"[{num_pages} pages] building indexes...", file=sys.stderr)
+        embeddings = collection.index.reconstruct_n(0, collection.index.ntotal)
+        results["indexes"][str(num_pages)] = bench_indexes(embeddings, args.index_types, args.k,
+                                                           args.queries, args.seed)
+
+        print(f"[{num_pages} pages] querying...", file=sys.stderr)
+        queries = make_queries(pages, args.queries, seed=args.seed)
+        results["queries"][str(num_pages)] = bench_queries(collection, queries, embedder, gateway, args.k)
+
+    results["history_writer"] = bench_history_writer(StubFirestore(), args.history_records,
+                                                     os.path.join(workdir, "history_spill.jsonl"))
+    results["spans"] = tracer.summary()
+    gateway.close()
+    return {"environment": environment(), "config": vars(args), "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline CARAG ingestion and retrieval benchmark.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100, 1000], help="synthetic PDF sizes")
+    parser.add_argument("--queries", type=int, default=200, help="queries per corpus size")
+    parser.add_argument("--k", type=int, default=10, help="k for recall@k and page hit rate")
+    parser.add_argument("--index-types", nargs="+", default=list(rb.INDEX_TYPES), choices=rb.INDEX_TYPES)
+    parser.add_argument("--model", default="hash",
+                        help='"hash" for the offline hashing embedder, or a locally cached sentence-transformers model')
+    parser.add_argument("--strategy", default="token", choices=sorted(rb.CHUNK_STRATEGIES),
+                        help='chunking strategy (the app uses "token")')
+    parser.add_argument("--boilerplate", type=int, default=0,
+                        help="lines of identical disclaimer text at the end of every synthetic page")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="stub LLM latency in seconds")
+    parser.add_argument("--web-latency", type=float, default=0.3, help="stub Tavily latency in seconds")
+    parser.add_argument("--history-records", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported by --compare")
+    parser.add_argument("--embedding-backends", nargs="+", choices=rb.EMBEDDING_BACKENDS,
+                        help="only compare these embedding backends (throughput and parity with torch) on --model")
+    parser.add_argument("--threads", type=int, help="intra-op threads for --embedding-backends")
+    parser.add_argument("--extractors", nargs="+", choices=sorted(rb.PDF_EXTRACTORS),
+                        help="only compare these PDF text extractors (pages/s, word F1, inline vs process pool,"
+                             " page cache) on --pages")
+    parser.add_argument("--pdf", nargs="+", default=[],
+                        help="real PDFs for --extractors, scored against pdfplumber's text")
+    parser.add_argument("--import-profile", action="store_true",
+                        help="only time the cold import of rag_backend and each deferred dependency")
+    args = parser.parse_args(argv)
+
+    if args.embedding_backends:
+        model_name = rb.EMBEDDING_MODEL_NAME if args.model == "hash" else args.model
+        pages = synthetic_pages(max(args.pages), seed=args.seed)
+        texts = rb.chunk_text("\n".join(" ".join(lines) for lines in pages))
+        results = rb.compare_embedding_backends(texts, args.embedding_backends, model_name, args.threads)
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "config": vars(args), "results": {"embeddings": results}}, f,
+                      indent=2)
+        for backend, row in results.items():
+            parity = row.get("parity", {})
+            print(f"  {backend:10s} {row['texts_per_second']:8.1f} texts/s"
+                  + (f"  x{row['speedup']:.2f}  mean cosine {parity['mean_cosine']:.5f}"
+                     f"  min {parity['min_cosine']:.5f}" if parity else ""))
+        return
+
+    if args.extractors:
+        workdir = tempfile.mkdtemp(prefix="carag-bench-")
+        results = {}
+        for num_pages in args.pages:
+            pages = synthetic_pages(num_pages, seed=args.seed)
+            # The revision rewrites the first line of one page in ten.
+            revised = [[f"Revised {p}."] + lines[1:] if p % 10 == 0 else lines for p, lines in enumerate(pages)]
+            print(f"[{num_pages} pages] extracting...", file=sys.stderr)
+            results[f"synthetic-{num_pages}"] = bench_extractors(
+                make_pdf(pages), args.extractors, [" ".join(lines) for lines in pages],
+                os.path.join(workdir, str(num_pages)), revise=make_pdf(revised))
+        for path in args.pdf:
+            with open(path, "rb") as f:
+                pdf_bytes = f.read()
+            print(f"[{path}] extracting...", file=sys.stderr)
+            reference = [text for _, text in rb.iter_pdf_pages(pdf_bytes, extractor="pdfplumber")]
+            results[os.path.basename(path)] = bench_extractors(pdf_bytes, args.extractors, reference,
+                                                               os.path.join(workdir, os.path.basename(path)))
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "config": vars(args), "results": {"extractors": results}}, f,
+                      indent=2)
+        for corpus, rows in results.items():
+            print(corpus)
+            for name, row in rows.items():
+                print(f"  {name:10s} {row['pages_per_second']:8.1f} pages/s  F1 {row['mean_f1']:.4f}"
+                      f" (min {row['min_f1']:.4f})  inline {1000 * row['inline_seconds']:.0f} ms"
+                      f"  pool({row['pool_workers']}) {1000 * row['pool_seconds']:.0f} ms"
+                      f"  cache hit {1000 * row['cache_hit_seconds']:.1f} ms"
+                      + (f"  revised {1000 * row['cache_revised_seconds']:.1f} ms"
+                         if "cache_revised_seconds" in row else ""))
+        return
+
+    if args.import_profile:
+        report = {"environment": environment(), "imports": import_report()}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        for name, seconds in report["imports"].items():
+            print(f"  {name:32s} {'failed' if seconds is None else f'{1000 * seconds:8.1f} ms'}")
+        return
+
+    report = run(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print(f"Changes of more than {args.threshold:.0%} vs {args.compare} ({old['environment'].get('commit')}):")
+        for name, a, b, change in compare(old, report, args.threshold):
+            print(f"  {name}: {a:.4g} -> {b:.4g} ({change:+.0%})")
+
+
+if __name__ == "__main__":
+    main()
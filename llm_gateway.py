@@ -0,0 +1,388 @@
+import os
+import json
+import time
+import queue
+import random
+import asyncio
+import threading
+
+# --- LLM Gateway ---
+# All chat-completion traffic goes through one LLMGateway per process. It owns
+# an asyncio event loop on a background thread and an async backend holding a
+# pooled HTTP connection, so concurrent Streamlit sessions share keep-alive
+# connections instead of each blocking on its own request. Calls are retried
+# with jittered exponential backoff on 429 and 5xx responses.
+# Synchronous wrappers (complete/stream) serve the Streamlit script threads;
+# async callers use acomplete/astream directly.
+#
+# Rate limits are tracked per model, as the provider does. There is no client
+# side quota unless one is configured: GROQ_RPM / GROQ_TPM set default limits
+# for every model and CARAG_LLM_LIMITS='{"<model>": {"rpm": 30, "tpm": 12000}}'
+# sets them per model. A model's token bucket is also sized from the
+# x-ratelimit-* headers of the provider's 429 responses. Each call is charged
+# an estimate of its prompt up front, corrected from the reported usage once
+# it finishes.
+
+GROQ_RPM = int(os.environ.get("GROQ_RPM", "0")) or None
+GROQ_TPM = int(os.environ.get("GROQ_TPM", "0")) or None
+MODEL_LIMITS = json.loads(os.environ.get("CARAG_LLM_LIMITS", "{}"))
+GROQ_MAX_CONCURRENCY = int(os.environ.get("GROQ_MAX_CONCURRENCY", "8"))
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """An error from an LLM backend, with the HTTP status when there is one."""
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    """Returns True for rate-limit, server and connection errors."""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRY_STATUSES
+    # The Groq SDK raises APIConnectionError / APITimeoutError without a status.
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError") or isinstance(
+        error, (ConnectionError, TimeoutError, asyncio.TimeoutError))
+
+
+def retry_after_seconds(error):
+    """Returns the server's Retry-After hint in seconds, or None."""
+    if getattr(error, "retry_after", None) is not None:
+        return float(error.retry_after)
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(messages):
+    """Rough token count of messages (4 characters per token) for the token bucket."""
+    return sum(len(m.get("content") or "") for m in messages) // 4
+
+
+# --- Rate Limiting ---
+class TokenBucket:
+    """Async token bucket refilling at rate_per_minute up to capacity."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity or rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1.0):
+        """Waits until amount tokens are available and takes them."""
+        amount = min(float(amount), self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def charge(self, amount):
+        """Takes amount tokens without waiting (returns them if negative), e.g. to correct an estimate.
+
+        The balance never drops below -capacity: a call larger than the whole
+        bucket delays later ones by at most two buckets' refill time.
+        """
+        self._refill()
+        self.tokens = max(-self.capacity, min(self.capacity, self.tokens - amount))
+
+    def resize(self, rate_per_minute):
+        """Changes the refill rate and capacity."""
+        self._refill()
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = min(self.tokens, self.capacity)
+
+
+class ModelLimiter:
+    """Request and token buckets of one model; a missing bucket means no client-side limit."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    async def admit(self, prompt_tokens):
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None:
+            await self.tokens.acquire(prompt_tokens)
+
+    def settle(self, charged, used):
+        """Corrects a call's up-front charge to the tokens it actually used."""
+        if self.tokens is not None:
+            self.tokens.charge(used - charged)
+
+    def learn(self, error):
+        """Sizes the token bucket from the x-ratelimit-* headers of a rate-limit response."""
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        try:
+            limit = float(headers["x-ratelimit-limit-tokens"])
+        except (KeyError, TypeError, ValueError):
+            return
+        if self.tokens is None:
+            self.tokens = TokenBucket(limit)
+        else:
+            self.tokens.resize(limit)
+        try:
+            self.tokens.tokens = min(self.tokens.tokens, float(headers["x-ratelimit-remaining-tokens"]))
+        except (KeyError, TypeError, ValueError):
+            pass
+
+
+# --- Backends ---
+# A backend turns (model, messages, params) into text. complete() returns the
+# whole answer; stream() is an async generator of text deltas. Both record the
+# call's total token count in the usage dict when the provider reports it.
+# Errors should carry a status_code so the gateway can tell retryable ones apart.
+class GroqBackend:
+    """Groq's async client over a pooled httpx connection."""
+
+    def __init__(self, api_key=None, max_connections=GROQ_MAX_CONCURRENCY, timeout=60.0):
+        self.api_key = api_key or os.environ.get("GROQ_API_KEY")
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._client = None
+
+    def _get_client(self):
+        # Created lazily on the gateway's loop, which the pooled connections are bound to.
+        if self._client is None:
+            import httpx
+            from groq import AsyncGroq
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=self.timeout,
+            )
+            # The gateway does its own retries, so the SDK's are disabled.
+            self._client = AsyncGroq(api_key=self.api_key, http_client=http_client, max_retries=0)
+        return self._client
+
+    async def complete(self, model, messages, usage=None, **params):
+        completion = await self._get_client().chat.completions.create(model=model, messages=messages, **params)
+        if usage is not None and completion.usage is not None:
+            usage["total_tokens"] = completion.usage.total_tokens
+        return completion.choices[0].message.content
+
+    async def stream(self, model, messages, usage=None, **params):
+        completion = await self._get_client().chat.completions.create(
+            model=model, messages=messages, stream=True, **params)
+        async for chunk in completion:
+            # Groq reports the usage of a streamed completion on its last chunk.
+            chunk_usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if usage is not None and chunk_usage is not None:
+                usage["total_tokens"] = chunk_usage.total_tokens
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                yield chunk.choices[0].delta.content
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+
+
+class FakeLLMBackend:
+    """Offline backend for tests and benchmarks.
+
+    responder(model, messages) returns the answer text (default: echoes the last
+    message). failures is a list of status codes raised by the first calls, to
+    exercise the retry path. latency is slept before answering.
+    """
+
+    def __init__(self, responder=None, latency=0.0, failures=(), chunk_words=1):
+        self.responder = responder or (lambda model, messages: f"Echo: {messages[-1]['content']}")
+        self.latency = latency
+        self.failures = list(failures)
+        self.chunk_words = chunk_words
+        self.calls = []
+
+    async def _answer(self, model, messages, params, usage):
+        self.calls.append({"model": model, "messages": messages, **params})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failures:
+            raise LLMError("Injected failure", status_code=self.failures.pop(0))
+        answer = self.responder(model, messages)
+        if usage is not None:
+            usage["total_tokens"] = estimate_tokens(messages) + len(answer) // 4
+        return answer
+
+    async def complete(self, model, messages, usage=None, **params):
+        return await self._answer(model, messages, params, usage)
+
+    async def stream(self, model, messages, usage=None, **params):
+        words = (await self._answer(model, messages, params, usage)).split(" ")
+        for i in range(0, len(words), self.chunk_words):
+            yield " ".join(words[i:i + self.chunk_words]) + (" " if i + self.chunk_words < len(words) else "")
+            await asyncio.sleep(0)
+
+    async def aclose(self):
+        pass
+
+
+def backend_from_env():
+    """Returns the backend named by CARAG_LLM_BACKEND ("groq" or "fake")."""
+    if os.environ.get("CARAG_LLM_BACKEND", "groq").lower() == "fake":
+        return FakeLLMBackend()
+    return GroqBackend()
+
+
+# --- Gateway ---
+class LLMGateway:
+    """Rate-limited, retrying front end for an async LLM backend.
+
+    requests_per_minute and tokens_per_minute are the limits of models without
+    an entry in model_limits ({model: {"rpm", "tpm"}}); None means unlimited.
+    """
+
+    def __init__(self, backend=None, requests_per_minute=GROQ_RPM, tokens_per_minute=GROQ_TPM, model_limits=None,
+                 max_concurrency=GROQ_MAX_CONCURRENCY, max_retries=5, base_backoff=0.5, max_backoff=20.0):
+        self.backend = backend or backend_from_env()
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.model_limits = MODEL_LIMITS if model_limits is None else model_limits
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "tokens": 0}
+        self._limiters = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+        self._thread.start()
+        # Loop-bound primitives are created on the gateway's own loop.
+        self._call(self._setup())
+
+    async def _setup(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _call(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    def _backoff(self, attempt, error):
+        hint = retry_after_seconds(error)
+        if hint is not None:
+            return min(hint, self.max_backoff) + random.uniform(0, self.base_backoff)
+        # Full jitter keeps retrying sessions from synchronising.
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+    def _limiter(self, model):
+        """Returns the model's limiter (created on the gateway loop)."""
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limits = self.model_limits.get(model, {})
+            limiter = self._limiters[model] = ModelLimiter(limits.get("rpm", self.requests_per_minute),
+                                                           limits.get("tpm", self.tokens_per_minute))
+        return limiter
+
+    def _settle(self, limiter, charged, used):
+        limiter.settle(charged, used)
+        self.stats["tokens"] += used
+
+    async def acomplete(self, model, messages, **params):
+        """Returns the full completion text."""
+        limiter = self._limiter(model)
+        charged = estimate_tokens(messages)
+        attempt = 0
+        while True:
+            await limiter.admit(charged)
+            async with self._semaphore:
+                self.stats["requests"] += 1
+                usage = {}
+                try:
+                    text = await self.backend.complete(model, messages, usage=usage, **params)
+                    self._settle(limiter, charged, usage.get("total_tokens", charged + len(text or "") // 4))
+                    return text
+                except Exception as e:
+                    # A rejected call used no tokens.
+                    self._settle(limiter, charged, 0)
+                    if getattr(e, "status_code", None) == 429:
+                        limiter.learn(e)
+                    if attempt >= self.max_retries or not is_retryable(e):
+                        self.stats["failures"] += 1
+                        raise
+                    delay = self._backoff(attempt, e)
+            self.stats["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def astream(self, model, messages, **params):
+        """Yields completion text deltas. Retries only until the first delta arrives."""
+        limiter = self._limiter(model)
+        charged = estimate_tokens(messages)
+        attempt = 0
+        while True:
+            await limiter.admit(charged)
+            started = False
+            async with self._semaphore:
+                self.stats["requests"] += 1
+                usage, chars = {}, 0
+                try:
+                    async for delta in self.backend.stream(model, messages, usage=usage, **params):
+                        started = True
+                        chars += len(delta)
+                        yield delta
+                    return
+                except Exception as e:
+                    if getattr(e, "status_code", None) == 429:
+                        limiter.learn(e)
+                    if started or attempt >= self.max_retries or not is_retryable(e):
+                        self.stats["failures"] += 1
+                        raise
+                    delay = self._backoff(attempt, e)
+                finally:
+                    # Also runs when the consumer stops early; a call that produced nothing used no tokens.
+                    used = usage.get("total_tokens", charged + chars // 4) if started else 0
+                    self._settle(limiter, charged, used)
+            self.stats["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def complete(self, model, messages, timeout=None, **params):
+        """Blocking wrapper around acomplete for script threads."""
+        return self._call(self.acomplete(model, messages, **params), timeout)
+
+    def stream(self, model, messages, **params):
+        """Blocking generator over astream for script threads."""
+        deltas = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for delta in self.astream(model, messages, **params):
+                    deltas.put(delta)
+            except Exception as e:
+                deltas.put(e)
+            finally:
+                deltas.put(done)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        try:
+            while True:
+                item = deltas.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # The consumer stopped early (e.g. the session rerun); stop the request too.
+            future.cancel()
+
+    def close(self):
+        """Closes the backend's connections and stops the loop."""
+        self._call(self.backend.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
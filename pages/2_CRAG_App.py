@@ -2,12 +2,18 @@ import streamlit as st
 import rag_backend as rb  # Import your backend functions
 
 st.set_page_config(layout="wide")
+rb.start_warm_up()  # no-op if already started by the Home page
+
+# Token-budgeted, sentence-aware chunks (see rb.CHUNK_STRATEGIES).
+CHUNK_STRATEGY = "token"
 st.title("📄🚀 Agentic RAG Chatbot (PDF + Web)")
 
 # --- Initialize models and clients ---
 try:
-    client = rb.get_groq_client()
+    client = rb.get_llm_gateway()
     model = rb.get_sentence_transformer()
+    query_encoder = rb.get_query_embedder()
+    answer_cache = rb.get_answer_cache()
     rb.get_tavily_client() 
     
     if client is None or model is None:
@@ -21,23 +27,73 @@ except Exception as e:
 
 # --- Sidebar for PDF Upload and Settings ---
 with st.sidebar:
-    st.header("1. Upload Your PDF")
-    uploaded_file = st.file_uploader("Upload a PDF document:", type="pdf")
+    st.header("1. Upload Your PDFs")
+    uploaded_files = st.file_uploader("Upload PDF documents:", type="pdf", accept_multiple_files=True)
     
     show_debug = st.checkbox("Show retrieved context (Debug)")
-
-    if uploaded_file:
-        if "faiss_index" not in st.session_state or st.session_state.get("pdf_name") != uploaded_file.name:
-            with st.spinner("Processing PDF... (Extracting, Chunking, Embedding)"):
-                pdf_text = rb.extract_text_from_pdf(uploaded_file)
-                if pdf_text:
-                    all_chunks = rb.chunk_text(pdf_text)
-                    st.session_state.faiss_index, st.session_state.chunks = rb.index_chunks(all_chunks, model)
-                    st.session_state.pdf_name = uploaded_file.name 
-                    st.success(f"PDF '{uploaded_file.name}' processed! Indexed {len(all_chunks)} chunks.")
-                else:
-                    st.error("Failed to extract text from PDF.")
+    show_latency = st.checkbox("Show latency breakdown (Debug)")
+    local_routing = st.checkbox("Fast local routing", value=True)
+    use_reranker = st.checkbox("Rerank PDF results (cross-encoder)")
+    vector_storage = st.selectbox("Vector storage", list(rb.VECTOR_STORAGES), index=0)
+
+    # All PDFs of the session live in one collection, keyed by content hash, so a
+    # changed file with the same name is re-indexed and an unchanged one is not.
+    # Collections are shared read-only between sessions that load the same PDFs.
+    documents = []
+    model_id = rb.embedding_model_id(model)
+    for uploaded_file in uploaded_files or []:
+        pdf_bytes = uploaded_file.getvalue()
+        doc_id = rb.compute_index_key(pdf_bytes, model_id, strategy=CHUNK_STRATEGY)
+        documents.append((doc_id, uploaded_file.name, pdf_bytes))
+    collection_key = rb.collection_key(
+        [(doc_id, name) for doc_id, name, _ in documents], strategy=CHUNK_STRATEGY, storage=vector_storage
+    )
+
+    handle = st.session_state.get("collection_handle")
+    if handle is None or handle.key != collection_key:
+        with st.spinner("Processing PDFs... (Extracting, Chunking, Embedding)"):
+            new_handle = rb.get_index_registry().acquire(
+                collection_key,
+                lambda: rb.build_collection(
+                    [(name, pdf_bytes) for _, name, pdf_bytes in documents],
+                    model,
+                    strategy=CHUNK_STRATEGY,
+                    storage=vector_storage
+                )
+            )
+        if handle is not None:
+            handle.release()
+        st.session_state.collection_handle = handle = new_handle
+        if documents:
+            st.success(f"Indexed {len(handle.value)} chunks from {len(handle.value.documents)} PDF(s).")
+    st.session_state.collection = collection = handle.value
+
+    for doc_id, name, _ in documents:
+        if doc_id not in collection:
+            st.error(f"Failed to extract text from '{name}'.")
+
+    selected_doc_ids = None
+    if len(collection.documents) > 1:
+        names = {doc_id: doc["name"] for doc_id, doc in collection.documents.items()}
+        selected_doc_ids = st.multiselect(
+            "Search in documents:",
+            options=list(names),
+            default=list(names),
+            format_func=names.get
+        )
     
+    if show_debug and len(collection) > 0:
+        with st.expander("Index memory"):
+            report = collection.memory_report()
+            st.write(f"{report['index_type']} / {report['storage']}: "
+                     f"{report['chunks']} chunks in {report['vectors']} distinct vectors, "
+                     f"{report['private_bytes'] / 1e6:.1f} MB private, "
+                     f"{report['shared_text_bytes'] / 1e6:.1f} MB shared text")
+            st.table([
+                {"Document": d["name"], "Chunks": d["chunks"], "Bytes": d["private_bytes"]}
+                for d in report["documents"].values()
+            ])
+
     st.header("2. Chat with your Doc")
     st.markdown("Your bot can now answer questions about your PDF *and* the general web.")
 
@@ -71,66 +127,111 @@ if prompt := st.chat_input("Ask about your doc or the web..."):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # --- AGENTIC LOGIC ---
-    with st.chat_message("assistant"):
+    # The whole turn is traced; see the latency panel in the sidebar.
+    with rb.span("chat_turn") as turn_span:
+        # --- AGENTIC LOGIC ---
+        with st.chat_message("assistant"):
+
+            # STEP 0: Look for a cached answer to the same (or a paraphrased) question,
+            # asked by this user after the same conversation
+            history_for_api = st.session_state.messages[:-1]
+            if len(st.session_state.collection) > 0:
+                cache_scope = rb.answer_cache_scope(selected_doc_ids or list(st.session_state.collection.documents),
+                                                    username, history_for_api)
+            else:
+                cache_scope = rb.answer_cache_scope(None, username, history_for_api)
+            query_embedding = query_encoder.encode([prompt])[0]
+            cached_answer = answer_cache.lookup(cache_scope, query_embedding)
+
+            if cached_answer:
+                retrieved_chunks = [text for text, _ in cached_answer["sources"]]
+                source_labels = [label for _, label in cached_answer["sources"]]
+                source_type = cached_answer["source_type"]
+                st.write("*(Answering from cache...)*")
+
+            # STEP 1 + 2: Route and retrieve. Routing, PDF retrieval and web search
+            # run concurrently; only the routed result is kept.
+            else:
+                if len(st.session_state.collection) == 0:
+                    st.info("No PDF loaded. Using web search.")
+                with st.spinner("Routing and searching..."):
+                    retrieval = rb.retrieve_speculatively(
+                        prompt,
+                        client,
+                        st.session_state.collection,
+                        query_encoder,
+                        doc_ids=selected_doc_ids,
+                        local_routing=local_routing,
+                        reranker=rb.get_reranker() if use_reranker else None
+                    )
+                tool_choice = retrieval["route"]
+                retrieved_chunks = retrieval["chunks"]
+                source_labels = retrieval["labels"]
+                source_type = retrieval["source_type"]
+                st.write("*(Searched PDF)*" if tool_choice == "PDF" else "*(Searched the web)*")
+
+            if show_debug:
+                with st.info(f"Retrieved Context from {source_type} (Debug View)"):
+                    st.write(retrieved_chunks)
+
+            # STEP 3: Generate and stream the response
+            response_placeholder = st.empty()
+            full_response = ""
         
-        # STEP 1: Decide which tool
-        if "faiss_index" in st.session_state:
-            tool_choice = rb.decide_tool_to_use(prompt, client)
-        else:
-            tool_choice = "WEB"
-            st.info("No PDF loaded. Using web search.")
-
-        # STEP 2: Run the chosen tool
-        if tool_choice == "PDF":
-            st.write("*(Searching PDF...)*")
-            retrieved_chunks = rb.retrieve_pdf_chunks(
-                prompt, 
-                st.session_state.chunks, 
-                st.session_state.faiss_index, 
-                model
-            )
-            source_type = "private PDF document"
+            if cached_answer:
+                stream = rb.replay_answer_stream(cached_answer["answer"])
+            else:
+                stream = rb.cache_answer_stream(
+                    rb.generate_answer_stream(
+                        prompt, 
+                        retrieved_chunks, 
+                        history_for_api, 
+                        source_type
+                    ),
+                    answer_cache,
+                    cache_scope,
+                    prompt,
+                    query_embedding,
+                    source_type,
+                    list(zip(retrieved_chunks, source_labels))
+                )
         
-        else: # tool_choice == "WEB"
-            st.write("*(Searching the web...)*")
-            retrieved_chunks = rb.tavily_web_search(prompt)
-            source_type = "web search"
-
-        if show_debug:
-            with st.info(f"Retrieved Context from {source_type} (Debug View)"):
-                st.write(retrieved_chunks)
-
-        # STEP 3: Generate and stream the response
-        response_placeholder = st.empty()
-        full_response = ""
-        history_for_api = st.session_state.messages[:-1] 
-        
-        stream = rb.generate_answer_stream(
-            prompt, 
-            retrieved_chunks, 
-            history_for_api, 
-            source_type
-        )
-        
-        for chunk in stream:
-            full_response += chunk
-            response_placeholder.markdown(full_response + "▌") 
-        response_placeholder.markdown(full_response)
+            for chunk in stream:
+                full_response += chunk
+                response_placeholder.markdown(full_response + "▌") 
+            response_placeholder.markdown(full_response)
     
-    # --- NEW: Save to History ---
+        # --- NEW: Save to History ---
     
-    # 1. Add assistant's full response to chat UI
-    st.session_state.messages.append({"role": "assistant", "content": full_response})
+        # 1. Add assistant's full response to chat UI
+        st.session_state.messages.append({"role": "assistant", "content": full_response})
     
-    # 2. Add Q&A pair to the local session history
-    st.session_state.history.append({"Question": prompt, "Answer": full_response})
+        # 2. Add Q&A pair to the local session history
+        st.session_state.history.append({"Question": prompt, "Answer": full_response})
     
-    # 3. Write Q&A pair to Firebase
-    rb.write_history_to_firestore(username, prompt, full_response)
+        # 3. Write Q&A pair to Firebase
+        rb.write_history_to_firestore(username, prompt, full_response)
 
 
     # Display Source Citations
     with st.expander(f"View Sources (from {source_type})"):
-        for i, chunk in enumerate(retrieved_chunks):
-            st.markdown(f"**Source {i+1}:**\n> {chunk}\n\n---")
\ No newline at end of file
+        for i, (chunk, label) in enumerate(zip(retrieved_chunks, source_labels)):
+            st.markdown(f"**Source {i+1}** ({label}):\n> {chunk}\n\n---")
+
+    # Latency breakdown of this turn, plus percentiles across all turns in this process
+    if show_latency:
+        with st.expander("Latency breakdown (Debug)", expanded=True):
+            turn_spans = rb.tracer.trace(turn_span.trace_id)
+            st.dataframe(
+                [{"Stage": s.name, "ms": round(s.duration * 1000, 1), "Error": s.error or ""} for s in turn_spans],
+                use_container_width=True
+            )
+            st.markdown("**Percentiles (all turns)**")
+            st.dataframe(
+                [{"Stage": name, **{k: round(v, 1) for k, v in row.items()}} for name, row in rb.tracer.summary().items()],
+                use_container_width=True
+            )
+            st.download_button("Download metrics (Prometheus)", rb.tracer.prometheus_text(),
+                               file_name="carag_metrics.prom", mime="text/plain")
+            st.download_button("Download trace (JSON lines)", rb.tracer.jsonl(turn_span.trace_id),
+                               file_name=f"trace_{turn_span.trace_id}.jsonl", mime="application/x-ndjson")
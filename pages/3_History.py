@@ -41,44 +41,38 @@ if not username:
     st.error("Error: Could not find username. Please log in again.")
     st.stop()
 
-# --- NEW: Load from Firestore ---
-# We check if history has already been loaded this session.
-if "history" not in st.session_state:
+# --- Load from Firestore ---
+# Only documents newer than the local cache are fetched, once per session.
+store = rb.get_history_store()
+if not st.session_state.get("history_synced"):
     with st.spinner("Loading persistent history from cloud..."):
-        # Load from Firebase and store it in the session
-        st.session_state.history = rb.load_history_from_firestore(username)
-else:
-    # If "history" is in session_state, it means we've already loaded it
-    # OR we've been adding to it from the CRAG_App page.
-    # The rb.load_history_from_firestore() is cached, but this
-    # check prevents re-loading if we just navigate away and come back.
-    pass 
+        try:
+            store.sync(username)
+            st.session_state.history_synced = True
+        except Exception as e:
+            st.error(f"Error loading history from Firestore: {e}")
 
+PAGE_SIZE = 50
+total = store.count(username)
 
-if "history" in st.session_state and st.session_state.history:
+if total:
     st.markdown("Here is your complete query history, loaded from the cloud.")
-    
-    # Convert history list of dicts to a DataFrame
-    # Note: This will be in reverse chronological order from Firestore
-    df = pd.DataFrame(st.session_state.history)
-    
-    # Optional: Display in reverse order (newest on top)
-    st.dataframe(df.iloc[::-1], use_container_width=True)
-    
-    # --- Download Button ---
-    @st.cache_data
-    def convert_df_to_csv(df_to_convert):
-        return df_to_convert.to_csv(index=False).encode('utf-8')
 
-    csv_data = convert_df_to_csv(df)
-    
+    # Render one page at a time, newest first
+    page_count = (total + PAGE_SIZE - 1) // PAGE_SIZE
+    page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1)
+    df = pd.DataFrame(store.page(username, page - 1, PAGE_SIZE))
+    st.dataframe(df, use_container_width=True)
+
+    # --- Download Button ---
+    # The CSV is generated in chunks only when the button is clicked.
     st.download_button(
         label="Download History as CSV",
-        data=csv_data,
+        data=lambda: store.export_csv(username),
         file_name=f"{username}_chat_history.csv",
         mime="text/csv",
         type="primary"
     )
-    
+
 else:
-    st.info("No queries have been made in this session. Go to the `2_CRAG_App` page to start.")
\ No newline at end of file
+    st.info("No queries have been made in this session. Go to the `2_CRAG_App` page to start.")
@@ -1,34 +1,146 @@
 import os
-import faiss
+import io
+import sys
+import re
+import json
+import shutil
+import sqlite3
+import uuid
+import random
+import weakref
+import contextlib
+import contextvars
+import csv
+from datetime import datetime, timezone
+import hashlib
+import math
+import time
+import queue
+import bisect
+import tempfile
+import threading
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed
+from concurrent.futures import wait as wait_futures
+import asyncio
+import argparse
+import importlib
+import importlib.util
+import subprocess
+try:
+    import fcntl
+except ImportError:  # Windows: the journal lock is per process only
+    fcntl = None
+import numpy as np
 import streamlit as st  # <-- ADDED
-import pdfplumber
-from groq import Groq
+from llm_gateway import LLMGateway
+from tracing import tracer, span, traced
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
-from tavily import TavilyClient
-from google.cloud import firestore  # <-- ADDED
-from google.oauth2 import service_account  # <-- ADDED
+
+# --- Deferred Imports ---
+# The heavy third-party packages are imported on first use rather than at module
+# load, so the app (and every new worker) starts without paying for torch,
+# FAISS, pdfplumber and the cloud SDKs until a capability is actually needed.
+# Each LazyModule imports its target on first attribute access and records how
+# long that took in IMPORT_TIMES.
+IMPORT_TIMES = {}
+
+class LazyModule:
+    """Module proxy that imports name on first attribute access."""
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            t0 = time.perf_counter()
+            module = importlib.import_module(self._name)
+            IMPORT_TIMES.setdefault(self._name, time.perf_counter() - t0)
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+faiss = LazyModule("faiss")
+sparse = LazyModule("scipy.sparse")
+pdfplumber = LazyModule("pdfplumber")
+sentence_transformers = LazyModule("sentence_transformers")
+tavily = LazyModule("tavily")
+firestore = LazyModule("google.cloud.firestore")  # <-- ADDED
+service_account = LazyModule("google.oauth2.service_account")  # <-- ADDED
+pypdfium2 = LazyModule("pypdfium2")
+torch = LazyModule("torch")
+transformers = LazyModule("transformers")
+onnxruntime = LazyModule("onnxruntime")
+LAZY_MODULES = (faiss, sparse, pdfplumber, pypdfium2, sentence_transformers, torch, transformers, onnxruntime,
+                tavily, firestore, service_account)
+
+def import_profile(cold=False):
+    """Returns [(module, seconds, loaded)] for the deferred imports, slowest first.
+
+    By default seconds is the in-process import time (None if not imported
+    yet). With cold=True each module is timed in a fresh interpreter with
+    -X importtime, which is what a new worker pays.
+    """
+    rows = []
+    for lazy in LAZY_MODULES:
+        name = lazy._name
+        seconds = IMPORT_TIMES.get(name)
+        if cold:
+            try:
+                result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {name}"],
+                                        capture_output=True, text=True, timeout=300)
+                # Lines read "import time: self [us] | cumulative | package"; the target's own line is last.
+                cumulative = [line.split("|") for line in result.stderr.splitlines()
+                              if line.split("|")[-1].strip() == name]
+                seconds = int(cumulative[-1][1]) / 1e6 if cumulative and result.returncode == 0 else None
+            except (OSError, subprocess.SubprocessError, ValueError) as e:
+                print(f"Failed to profile import of {name}: {e}")
+                seconds = None
+        rows.append((name, seconds, lazy.__dict__["_module"] is not None))
+    return sorted(rows, key=lambda row: -(row[1] or 0))
 
 # Load environment variables
 load_dotenv()
 
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx_int8")
+EMBEDDING_BACKEND = os.environ.get("CARAG_EMBEDDING_BACKEND", "torch")
+EMBEDDING_THREADS = int(os.environ.get("CARAG_EMBEDDING_THREADS", "0")) or None
+ONNX_CACHE_DIR = os.environ.get("CARAG_ONNX_CACHE_DIR", os.path.join(".cache", "onnx"))
+RERANKER_MODEL_NAME = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+INDEX_CACHE_DIR = os.environ.get("CARAG_INDEX_CACHE_DIR", os.path.join(".cache", "indexes"))
+INDEX_REGISTRY_BUDGET_BYTES = int(os.environ.get("CARAG_INDEX_REGISTRY_BYTES", 2 * 1024 ** 3))
+HISTORY_SPILL_PATH = os.environ.get("CARAG_HISTORY_SPILL_PATH", os.path.join(".cache", "history_spill.jsonl"))
+HISTORY_CACHE_PATH = os.environ.get("CARAG_HISTORY_CACHE_PATH", os.path.join(".cache", "history.sqlite3"))
+WEB_CACHE_PATH = os.environ.get("CARAG_WEB_CACHE_PATH", os.path.join(".cache", "web_search.sqlite3"))
+ANSWER_CACHE_PATH = os.environ.get("CARAG_ANSWER_CACHE_PATH", os.path.join(".cache", "answers.sqlite3"))
+CHUNK_VECTOR_CACHE_PATH = os.environ.get("CARAG_CHUNK_VECTOR_CACHE_PATH", os.path.join(".cache", "chunk_vectors.sqlite3"))
+
 # --- Model and Client Caching ---
-# ... (get_groq_client, get_tavily_client, get_sentence_transformer... no changes here)
+# ... (get_tavily_client, get_sentence_transformer... no changes here)
 @st.cache_resource
-def get_groq_client():
-    """Returns a cached Groq client."""
+def get_llm_gateway():
+    """Returns the process-wide rate-limited LLM gateway (see llm_gateway.py)."""
     try:
-        client = Groq(api_key=os.environ.get('GROQ_API_KEY'))
-        return client
+        return LLMGateway()
     except Exception as e:
-        print(f"Failed to initialize Groq client: {e}")
+        print(f"Failed to initialize LLM gateway: {e}")
         return None
 
 @st.cache_resource
 def get_tavily_client():
     """Returns a cached Tavily client."""
     try:
-        client = TavilyClient(api_key=os.environ.get('TAVILY_API_KEY'))
+        client = tavily.TavilyClient(api_key=os.environ.get('TAVILY_API_KEY'))
         return client
     except Exception as e:
         print(f"Failed to initialize Tavily client: {e}")
@@ -36,26 +148,358 @@ def get_tavily_client():
 
 @st.cache_resource
 def get_sentence_transformer():
-    """Returns a cached sentence transformer model."""
-    return SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+    """Returns the cached embedding model for the configured backend (CARAG_EMBEDDING_BACKEND)."""
+    return load_embedding_model(EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME, EMBEDDING_THREADS)
+
+
+# --- Embedding Backends ---
+# Chunk embedding dominates ingestion on CPU-only nodes. Besides the PyTorch
+# SentenceTransformer ("torch"), the model can run in ONNX Runtime ("onnx"),
+# optionally with dynamically int8-quantized weights ("onnx_int8"). The ONNX
+# model is exported once from the PyTorch model and cached under ONNX_CACHE_DIR.
+# Every backend exposes the SentenceTransformer surface the rest of this module
+# uses: encode(), get_sentence_embedding_dimension(), tokenizer, max_seq_length.
+# Use compare_embedding_backends() to check parity and throughput before switching.
+# Cached vectors and indexes are keyed by embedding_model_id() of the model that
+# produced them, which includes the backend, since ONNX (and int8) vectors differ slightly.
+def load_embedding_model(backend=EMBEDDING_BACKEND, model_name=EMBEDDING_MODEL_NAME, threads=EMBEDDING_THREADS):
+    """Returns an embedding model for backend, using threads intra-op threads (None: library default)."""
+    if backend == "torch":
+        if threads:
+            torch.set_num_threads(threads)
+        model = sentence_transformers.SentenceTransformer(model_name)
+        model.model_id = model_name
+        return model
+    if backend in ("onnx", "onnx_int8"):
+        return OnnxEmbedder(model_name, quantize=backend == "onnx_int8", threads=threads)
+    raise ValueError(f"Unknown embedding backend {backend!r}; expected one of {EMBEDDING_BACKENDS}")
+
+def embedding_model_id(model):
+    """Returns the cache identity of an embedding model: its name (or class) and dimension.
+
+    Models from load_embedding_model() carry a model_id naming the model and
+    backend; for others the tokenizer's name_or_path, if any, stands in for it.
+    """
+    model_id = getattr(model, "model_id", None)
+    if model_id is None:
+        name = getattr(getattr(model, "tokenizer", None), "name_or_path", None)
+        model_id = f"{type(model).__module__}.{type(model).__qualname__}:{name}"
+    return f"{model_id}/{model.get_sentence_embedding_dimension()}"
+
+def export_onnx_model(model, directory):
+    """Exports a mean-pooling SentenceTransformer's encoder, tokenizer and pooling settings to directory."""
+    pooling = next((m for m in model if type(m).__name__ == "Pooling"), None)
+    config = pooling.get_config_dict() if pooling is not None else {}
+    modes = {k for k, v in config.items() if k.startswith("pooling_mode_") and v is True}
+    # sentence-transformers >= 5 stores "pooling_mode"; earlier versions one flag per mode.
+    if config.get("pooling_mode", "mean" if modes == {"pooling_mode_mean_tokens"} else None) != "mean":
+        raise ValueError("Only mean-pooling models can be exported")
+    encoder = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+    sample = tokenizer(["an export sample", "another"], padding=True, return_tensors="pt")
+    names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, *inputs):
+            return self.encoder(**dict(zip(names, inputs))).last_hidden_state
+
+    axes = {"batch": 0, "sequence": 1}
+    dynamic_axes = {n: {v: k for k, v in axes.items()} for n in names + ["token_embeddings"]}
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(directory) or ".")
+    try:
+        export_kwargs = dict(input_names=names, output_names=["token_embeddings"], dynamic_axes=dynamic_axes,
+                             opset_version=17)
+        with torch.no_grad():
+            try:
+                torch.onnx.export(TokenEmbeddings(), tuple(sample[n] for n in names),
+                                  os.path.join(tmp_dir, "model.onnx"), dynamo=False, **export_kwargs)
+            except TypeError:  # torch < 2.5 has no dynamo switch
+                torch.onnx.export(TokenEmbeddings(), tuple(sample[n] for n in names),
+                                  os.path.join(tmp_dir, "model.onnx"), **export_kwargs)
+        tokenizer.save_pretrained(tmp_dir)
+        normalize = any(type(m).__name__ == "Normalize" for m in model)
+        with open(os.path.join(tmp_dir, "embedding_config.json"), "w") as f:
+            json.dump({"max_seq_length": model.max_seq_length, "normalize": normalize,
+                       "dim": model.get_sentence_embedding_dimension()}, f)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp_dir, directory)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+class OnnxEmbedder:
+    """SentenceTransformer-compatible encoder running an exported model in ONNX Runtime."""
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, quantize=False, threads=None, cache_dir=ONNX_CACHE_DIR,
+                 reference=None):
+        directory = os.path.join(cache_dir, re.sub(r"[^\w.-]+", "_", model_name))
+        if not os.path.exists(os.path.join(directory, "embedding_config.json")):
+            os.makedirs(cache_dir, exist_ok=True)
+            export_onnx_model(reference or sentence_transformers.SentenceTransformer(model_name, device="cpu"),
+                              directory)
+        model_path = os.path.join(directory, "model.onnx")
+        if quantize:
+            quantized_path = os.path.join(directory, "model_int8.onnx")
+            if not os.path.exists(quantized_path):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                tmp_path = quantized_path + ".tmp"
+                quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+                os.replace(tmp_path, quantized_path)
+            model_path = quantized_path
+        with open(os.path.join(directory, "embedding_config.json")) as f:
+            config = json.load(f)
+        self.model_id = f"{model_name}@{'onnx_int8' if quantize else 'onnx'}"
+        self.max_seq_length = config["max_seq_length"]
+        self.normalize = config["normalize"]
+        self.dim = config["dim"]
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(directory)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or 0
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, normalize_embeddings=False, **kwargs):
+        """Returns float32 embeddings. Texts are batched by token length so padding stays minimal."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = np.zeros((len(texts), self.dim), dtype='float32')
+        if not texts:
+            return out
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)
+        order = np.argsort([-len(ids) for ids in encoded["input_ids"]], kind="stable")
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            batch = self.tokenizer.pad({k: [encoded[k][i] for i in rows] for k in encoded.keys()},
+                                       return_tensors="np")
+            feeds = {n: batch[n].astype(np.int64) for n in self.input_names if n in batch}
+            if "token_type_ids" in self.input_names and "token_type_ids" not in feeds:
+                feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+            token_embeddings = self.session.run(None, feeds)[0]
+            mask = batch["attention_mask"][..., None].astype('float32')
+            out[rows] = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self.normalize or normalize_embeddings:
+            out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+        return out[0] if single else out
+
+def embedding_parity(reference, candidate, texts, k=10):
+    """Compares candidate's embeddings of texts with reference's.
+
+    Reports the cosine similarity between the two vectors of each text, and the
+    mean overlap of each text's k nearest neighbours (among texts) under both models.
+    """
+    a = np.asarray(reference.encode(texts), dtype='float32')
+    b = np.asarray(candidate.encode(texts), dtype='float32')
+    a /= np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b /= np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    cosine = (a * b).sum(axis=1)
+    k = min(k, len(texts) - 1)
+    overlap = None
+    if k > 0:
+        neighbours_a = np.argsort(-(a @ a.T), axis=1)[:, 1:k + 1]
+        neighbours_b = np.argsort(-(b @ b.T), axis=1)[:, 1:k + 1]
+        overlap = float(np.mean([len(set(x) & set(y)) / k for x, y in zip(neighbours_a, neighbours_b)]))
+    return {"texts": len(texts), "mean_cosine": float(cosine.mean()), "min_cosine": float(cosine.min()),
+            "p1_cosine": float(np.percentile(cosine, 1)), f"neighbour_overlap_at_{k}": overlap}
+
+def embedding_throughput(model, texts, batch_size=32):
+    """Returns texts per second for encoding texts once, after a short warm-up."""
+    model.encode(texts[:batch_size], batch_size=batch_size)
+    t0 = time.perf_counter()
+    model.encode(texts, batch_size=batch_size)
+    return len(texts) / (time.perf_counter() - t0)
+
+def compare_embedding_backends(texts, backends=EMBEDDING_BACKENDS, model_name=EMBEDDING_MODEL_NAME, threads=None,
+                               batch_size=32):
+    """Loads each backend and reports load time, throughput, and speedup and parity against "torch"."""
+    results, models = {}, {}
+    for backend in dict.fromkeys(("torch",) + tuple(backends)):
+        t0 = time.perf_counter()
+        models[backend] = load_embedding_model(backend, model_name, threads)
+        results[backend] = {"load_seconds": time.perf_counter() - t0,
+                            "texts_per_second": embedding_throughput(models[backend], texts, batch_size)}
+    for backend in results:
+        if backend != "torch":
+            results[backend]["speedup"] = results[backend]["texts_per_second"] / results["torch"]["texts_per_second"]
+            results[backend]["parity"] = embedding_parity(models["torch"], models[backend], texts)
+    return results
+
+
+# --- Query Embedding Service ---
+# Query encoding sits on the critical path of every chat turn. QueryEmbedder puts
+# an LRU cache of normalized query strings in front of the model, and merges
+# cache misses arriving from concurrent sessions within a few milliseconds into
+# one model.encode() call. It exposes the same encode() call shape as the model,
+# so it can be passed wherever retrieval expects a model.
+def normalize_query(text):
+    """Collapses whitespace and lower-cases a query (MiniLM's tokenizer is uncased)."""
+    return " ".join(text.lower().split())
+
+class QueryEmbedder:
+    """LRU-cached, micro-batched query encoder shared by all sessions."""
+
+    def __init__(self, model, cache_size=4096, max_batch_size=32, max_wait_ms=5):
+        self.model = model
+        self.cache_size = cache_size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        self.stats = {"hits": 0, "misses": 0, "batches": 0, "batched_queries": 0}
+
+    @traced("embed_query")
+    def encode(self, texts, **kwargs):
+        """Returns float32 embeddings for texts, from the cache or a shared batch."""
+        keys = [normalize_query(t) for t in texts]
+        vectors = [None] * len(keys)
+        waiting = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    vectors[i] = self._cache[key]
+                    self.stats["hits"] += 1
+                else:
+                    self.stats["misses"] += 1
+                    future = self._inflight.get(key)
+                    if future is None:
+                        future = self._inflight[key] = Future()
+                        self._queue.put((key, future))
+                    waiting.append((i, future))
+            self._ensure_worker()
+        for i, future in waiting:
+            vectors[i] = future.result()
+        if not vectors:
+            return np.empty((0, 0), dtype='float32')
+        return np.vstack(vectors).astype('float32', copy=False)
+
+    def clear(self):
+        """Empties the cache."""
+        with self._lock:
+            self._cache.clear()
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="query-embedder", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch):
+        keys = [key for key, _ in batch]
+        try:
+            embeddings = np.asarray(self.model.encode(keys, show_progress_bar=False), dtype='float32')
+        except Exception as e:
+            with self._lock:
+                for key, future in batch:
+                    self._inflight.pop(key, None)
+                    future.set_exception(e)
+            return
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["batched_queries"] += len(batch)
+            for (key, future), vector in zip(batch, embeddings):
+                self._cache[key] = vector[None, :]
+                self._cache.move_to_end(key)
+                self._inflight.pop(key, None)
+                future.set_result(self._cache[key])
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+@st.cache_resource
+def get_query_embedder():
+    """Returns the process-wide cached, micro-batched query embedder."""
+    return QueryEmbedder(get_sentence_transformer())
+
+
+# --- Background Warm-Up ---
+# start_warm_up() is called by every page, but runs once per process: a daemon
+# thread loads the embedding model and runs a few encodes through it (the
+# first forward pass allocates and tunes kernels), imports FAISS and
+# pdfplumber, and opens the API clients, so the first user request does not
+# pay for any of it. Progress is visible through warm_up_status(). Firestore is
+# left to the first page that uses it, where a missing key file is reported.
+WARM_UP_STAGES = ("embedding_model", "query_embedder", "faiss", "pdfplumber", "llm_gateway", "tavily")
+_warm_up_status = {}
+
+def _warm_up_faiss():
+    index = faiss.IndexFlatL2(8)
+    index.add(np.zeros((4, 8), dtype='float32'))
+    index.search(np.zeros((1, 8), dtype='float32'), 1)
+
+WARM_UP_TASKS = {
+    "embedding_model": lambda: get_sentence_transformer().encode(["warm up"] * 8, batch_size=8),
+    "query_embedder": lambda: get_query_embedder().encode(["warm-up query"]),
+    "faiss": _warm_up_faiss,
+    "pdfplumber": lambda: pdfplumber.open,
+    "llm_gateway": lambda: get_llm_gateway(),
+    "tavily": lambda: get_tavily_client(),
+}
+
+def warm_up(stages=WARM_UP_STAGES):
+    """Runs the warm-up stages in order, recording each one's duration or error."""
+    for stage in stages:
+        _warm_up_status[stage] = {"state": "running"}
+        t0 = time.perf_counter()
+        try:
+            with span(f"warm_up.{stage}"):
+                WARM_UP_TASKS[stage]()
+            _warm_up_status[stage] = {"state": "done", "seconds": time.perf_counter() - t0}
+        except Exception as e:
+            print(f"Warm-up stage {stage} failed: {e}")
+            _warm_up_status[stage] = {"state": "failed", "seconds": time.perf_counter() - t0, "error": str(e)}
+
+@st.cache_resource
+def start_warm_up():
+    """Starts the process-wide warm-up thread (once) and returns it."""
+    thread = threading.Thread(target=warm_up, name="carag-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def warm_up_status():
+    """Returns {stage: {"state", "seconds", ...}} for stages started so far."""
+    return dict(_warm_up_status)
 
 
 # --- PDF Processing and RAG Logic ---
 # ... (extract_text_from_pdf, chunk_text, index_chunks... no changes here)
+@traced()
 def extract_text_from_pdf(uploaded_file):
     """Extracts text from an in-memory uploaded PDF file."""
-    text = ""
+    parts = []
     try:
-        with pdfplumber.open(uploaded_file) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        return text
+        for _, page_text in iter_pdf_pages(uploaded_file.read()):
+            if page_text:
+                parts.append(page_text + "\n")
+        return "".join(parts)
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
         return ""
 
+@traced()
 def chunk_text(text, chunk_size=700, overlap=100):
     """Chunks text into overlapping segments."""
     chunks = []
@@ -66,47 +510,1781 @@ def chunk_text(text, chunk_size=700, overlap=100):
         start += chunk_size - overlap
     return chunks
 
-def index_chunks(chunks, model):
-    """Creates a FAISS index for text chunks."""
+# --- Streaming Ingestion ---
+# For large PDFs, pages are extracted in a process pool and streamed through the
+# chunker and the embedding model, so embedding of early pages overlaps with
+# extraction of later ones and the full document text is never held in memory.
+# Workers come from a forkserver, not fork: the app process runs other threads
+# (script runners, the LLM gateway loop, warm-up) whose locks a fork would copy.
+# The forkserver preloads this module, so workers do not each re-import it (and
+# streamlit). Even so, starting a pool costs more than extracting a small PDF
+# with a fast extractor, so a pool is only used from PARALLEL_EXTRACTION_PAGES
+# pages to extract on; `benchmark.py --extractors` times both ways per
+# extractor. CARAG_PARALLEL_EXTRACTION_PAGES='{"pdfminer": 32}' overrides them.
+PARALLEL_EXTRACTION_PAGES = {"pypdfium2": 1000, "pdfminer": 64, "pdfplumber": 16,
+                             **json.loads(os.environ.get("CARAG_PARALLEL_EXTRACTION_PAGES", "{}"))}
+_worker_pdf_bytes = None
+
+# --- PDF Text Extractors ---
+# pdfplumber runs full layout analysis on every page, which dominates ingestion
+# of large text-heavy PDFs. Extractors are interchangeable functions
+# (pdf_bytes, page_numbers) -> [(page_number, text)]. The fast ones are pdfium
+# (pypdfium2) and pdfminer without layout analysis. Pages for which a fast
+# extractor returns no text, or batches it fails on, are re-extracted with
+# pdfplumber. PDF_EXTRACTOR ("auto" picks pypdfium2 when installed) selects one.
+PDF_EXTRACTOR = os.environ.get("CARAG_PDF_EXTRACTOR", "auto")
+PAGE_CACHE_PATH = os.environ.get("CARAG_PAGE_CACHE_PATH", os.path.join(".cache", "pages.sqlite3"))
+
+def _extract_pages_pdfplumber(pdf_bytes, page_numbers):
+    # pdfplumber's `pages` argument is 1-based and avoids building every page object.
+    with pdfplumber.open(io.BytesIO(pdf_bytes), pages=[n + 1 for n in page_numbers]) as pdf:
+        return [(n, page.extract_text() or "") for n, page in zip(page_numbers, pdf.pages)]
+
+def _extract_pages_pypdfium2(pdf_bytes, page_numbers):
+    pdf = pypdfium2.PdfDocument(pdf_bytes)
+    try:
+        pages = []
+        for n in page_numbers:
+            page = pdf[n]
+            textpage = page.get_textpage()
+            # pdfium ends lines with CRLF; normalise to pdfplumber's "\n".
+            pages.append((n, textpage.get_text_range().replace("\r\n", "\n").replace("\r", "\n").strip()))
+            textpage.close()
+            page.close()
+        return pages
+    finally:
+        pdf.close()
+
+def _extract_pages_pdfminer(pdf_bytes, page_numbers):
+    from pdfminer.converter import PDFPageAggregator
+    from pdfminer.layout import LTTextContainer, LTChar
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+
+    # Without LAParams pdfminer skips layout analysis and returns bare characters;
+    # lines are rebuilt from the baseline of consecutive characters.
+    resources = PDFResourceManager(caching=True)
+    device = PDFPageAggregator(resources, laparams=None)
+    interpreter = PDFPageInterpreter(resources, device)
+    wanted = set(page_numbers)
+    pages = []
+    for n, page in enumerate(PDFPage.get_pages(io.BytesIO(pdf_bytes), pagenos=wanted)):
+        interpreter.process_page(page)
+        parts, last = [], None
+        for item in device.get_result():
+            if isinstance(item, LTChar):
+                if last is not None and abs(item.y0 - last.y0) > item.height / 2:
+                    parts.append("\n")
+                elif last is not None and item.x0 - last.x1 > item.width / 3:
+                    parts.append(" ")
+                parts.append(item.get_text())
+                last = item
+            elif isinstance(item, LTTextContainer):
+                parts.append(item.get_text())
+        pages.append("".join(parts).strip())
+    return list(zip(sorted(wanted), pages))
+
+PDF_EXTRACTORS = {
+    "pypdfium2": _extract_pages_pypdfium2,
+    "pdfminer": _extract_pages_pdfminer,
+    "pdfplumber": _extract_pages_pdfplumber,
+}
+
+def resolve_pdf_extractor(name=PDF_EXTRACTOR):
+    """Returns the extractor name to use for name ("auto": pypdfium2 if installed, else pdfplumber)."""
+    if name == "auto":
+        return "pypdfium2" if importlib.util.find_spec("pypdfium2") else "pdfplumber"
+    if name not in PDF_EXTRACTORS:
+        raise ValueError(f"Unknown PDF extractor {name!r}; expected one of {tuple(PDF_EXTRACTORS)}")
+    return name
+
+def count_pdf_pages(pdf_bytes):
+    """Returns the number of pages in a PDF."""
+    if resolve_pdf_extractor("auto") == "pypdfium2":
+        pdf = pypdfium2.PdfDocument(pdf_bytes)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return len(pdf.pages)
+
+def _hash_pdf_object(obj, memo, path=()):
+    """Returns a digest of a PDF object with references resolved, independent of object numbers.
+
+    Streams are hashed by their decoded data and their attributes other than the
+    encoding ones. memo caches digests by object id within one document, so
+    fonts and images shared by many pages are hashed once.
+    """
+    from pdfminer.pdftypes import PDFObjRef, PDFStream
+
+    objid = None
+    if isinstance(obj, PDFObjRef):
+        objid = obj.objid
+        if objid in memo:
+            return memo[objid]
+        if objid in path:
+            return b"cycle"
+        path = path + (objid,)
+        obj = obj.resolve()
+    h = hashlib.sha256()
+    if isinstance(obj, PDFStream):
+        h.update(b"stream")
+        h.update(_hash_pdf_object({k: v for k, v in obj.attrs.items()
+                                   if k not in ("Length", "Filter", "DecodeParms", "F", "FFilter")}, memo, path))
+        try:
+            h.update(obj.get_data())
+        except Exception:
+            h.update(obj.rawdata or b"")
+    elif isinstance(obj, dict):
+        h.update(b"dict")
+        for key in sorted(obj, key=str):
+            h.update(str(key).encode("utf-8"))
+            h.update(_hash_pdf_object(obj[key], memo, path))
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"array")
+        for item in obj:
+            h.update(_hash_pdf_object(item, memo, path))
+    else:
+        h.update(repr(obj).encode("utf-8"))
+    digest = h.digest()
+    if objid is not None:
+        memo[objid] = digest
+    return digest
+
+def page_fingerprints(pdf_bytes):
+    """Returns one hash per page of everything that determines the page's text.
+
+    That is its decoded content streams, its resources (fonts with their
+    encodings and ToUnicode maps, form XObjects and images, resolved
+    recursively), its boxes and rotation. Pages that render the same text get
+    the same fingerprint in any document, whatever else changed in the file.
+    """
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdftypes import resolve1
+
+    memo = {}
+    fingerprints = []
+    for page in PDFPage.get_pages(io.BytesIO(pdf_bytes)):
+        h = hashlib.sha256(repr((page.mediabox, page.cropbox, page.rotate)).encode())
+        # /Contents arrays may hold unresolved references.
+        contents = resolve1(page.attrs.get("Contents"))
+        for stream in contents if isinstance(contents, list) else [contents]:
+            h.update(_hash_pdf_object(stream, memo))
+        h.update(_hash_pdf_object(page.attrs.get("Resources", {}), memo))
+        fingerprints.append(h.hexdigest())
+    return fingerprints
+
+def _page_worker_context():
+    """Returns the forkserver context for page workers, with this module preloaded into the server."""
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+def _init_page_worker(pdf_bytes):
+    """Stores the PDF bytes once per worker process."""
+    global _worker_pdf_bytes
+    _worker_pdf_bytes = pdf_bytes
+
+def _extract_page_batch(page_numbers, pdf_bytes=None, extractor="pdfplumber"):
+    """Extracts text for a batch of pages, returning [(page_number, text), ...]."""
+    pdf_bytes = pdf_bytes if pdf_bytes is not None else _worker_pdf_bytes
+    page_numbers = list(page_numbers)
+    if extractor == "pdfplumber":
+        return _extract_pages_pdfplumber(pdf_bytes, page_numbers)
+    try:
+        pages = dict(PDF_EXTRACTORS[extractor](pdf_bytes, page_numbers))
+    except Exception as e:
+        print(f"{extractor} failed on pages {page_numbers[0]}-{page_numbers[-1]}, using pdfplumber: {e}")
+        pages = {}
+    empty = [n for n in page_numbers if not pages.get(n, "").strip()]
+    if empty:
+        pages.update(_extract_pages_pdfplumber(pdf_bytes, empty))
+    return [(n, pages[n]) for n in page_numbers]
+
+class PageTextCache:
+    """SQLite cache of extracted page text, keyed by document hash and page number.
+
+    Each row also stores the page's content fingerprint, so a revised document
+    reuses the text of every page whose content is unchanged.
+    """
+
+    def __init__(self, path=PAGE_CACHE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS pages (doc_hash TEXT NOT NULL, page INTEGER NOT NULL,"
+                         " extractor TEXT NOT NULL, fingerprint TEXT, text TEXT NOT NULL,"
+                         " PRIMARY KEY (doc_hash, page, extractor))")
+            conn.execute("CREATE INDEX IF NOT EXISTS pages_fingerprint ON pages (fingerprint, extractor)")
+            conn.execute("CREATE TABLE IF NOT EXISTS documents (doc_hash TEXT NOT NULL, extractor TEXT NOT NULL,"
+                         " pages INTEGER NOT NULL, PRIMARY KEY (doc_hash, extractor))")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def document(self, doc_hash, extractor):
+        """Returns all page texts of a fully cached document in page order, or None."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT pages FROM documents WHERE doc_hash = ? AND extractor = ?",
+                               (doc_hash, extractor)).fetchone()
+            if row is None:
+                return None
+            texts = conn.execute("SELECT text FROM pages WHERE doc_hash = ? AND extractor = ? ORDER BY page",
+                                 (doc_hash, extractor)).fetchall()
+        return [t for (t,) in texts] if len(texts) == row[0] else None
+
+    def by_fingerprint(self, fingerprints, extractor):
+        """Returns {fingerprint: text} for the fingerprints already extracted."""
+        found = {}
+        with self._connect() as conn:
+            for i in range(0, len(fingerprints), 500):
+                batch = fingerprints[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT fingerprint, text FROM pages WHERE extractor = ? AND fingerprint IN"
+                    f" ({','.join('?' * len(batch))})", [extractor, *batch]).fetchall()
+                found.update(rows)
+        return found
+
+    def put(self, doc_hash, extractor, pages, fingerprints=None, complete_pages=None):
+        """Stores [(page_number, text)]; complete_pages marks the document as fully cached."""
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO pages (doc_hash, page, extractor, fingerprint, text) VALUES (?, ?, ?, ?, ?)",
+                [(doc_hash, n, extractor, fingerprints[n] if fingerprints else None, text) for n, text in pages])
+            if complete_pages is not None:
+                conn.execute("INSERT OR REPLACE INTO documents (doc_hash, extractor, pages) VALUES (?, ?, ?)",
+                             (doc_hash, extractor, complete_pages))
+
+@st.cache_resource
+def get_page_text_cache():
+    """Returns the process-wide page text cache."""
+    return PageTextCache()
+
+def iter_pdf_pages(pdf_bytes, max_workers=None, pages_per_task=8, max_pending=None, extractor=None, cache=None,
+                   min_parallel_pages=None):
+    """Yields (page_number, text) in page order, extracting pages in a process pool.
+
+    The pool is used when at least min_parallel_pages pages (default: the
+    extractor's PARALLEL_EXTRACTION_PAGES) need extracting. With a
+    PageTextCache, cached pages are served from it and only new or changed
+    pages are extracted (and then cached).
+    """
+    extractor = resolve_pdf_extractor(extractor or PDF_EXTRACTOR)
+    cached, fingerprints, doc_hash = {}, None, None
+    if cache is not None:
+        doc_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        texts = cache.document(doc_hash, extractor)
+        if texts is not None:
+            yield from enumerate(texts)
+            return
+        try:
+            fingerprints = page_fingerprints(pdf_bytes)
+        except Exception as e:
+            print(f"Could not fingerprint PDF pages, extracting without the page cache: {e}")
+            cache = None
+    if cache is not None:
+        known = cache.by_fingerprint(fingerprints, extractor)
+        cached = {n: known[f] for n, f in enumerate(fingerprints) if f in known}
+        num_pages = len(fingerprints)
+    else:
+        num_pages = count_pdf_pages(pdf_bytes)
+
+    missing = [n for n in range(num_pages) if n not in cached]
+    batches = [missing[i:i + pages_per_task] for i in range(0, len(missing), pages_per_task)]
+
+    def extracted_batches():
+        workers = max_workers or min(len(batches), os.cpu_count() or 1)
+        threshold = PARALLEL_EXTRACTION_PAGES.get(extractor, 0) if min_parallel_pages is None else min_parallel_pages
+        if len(batches) <= 1 or workers <= 1 or len(missing) < threshold:
+            for batch in batches:
+                yield _extract_page_batch(batch, pdf_bytes, extractor)
+            return
+        pending_limit = max_pending or 2 * workers
+        with ProcessPoolExecutor(workers, mp_context=_page_worker_context(),
+                                 initializer=_init_page_worker, initargs=(pdf_bytes,)) as pool:
+            pending = deque()
+            remaining = iter(batches)
+            for batch in remaining:
+                pending.append(pool.submit(_extract_page_batch, batch, None, extractor))
+                if len(pending) >= pending_limit:
+                    break
+            while pending:
+                pages = pending.popleft().result()
+                batch = next(remaining, None)
+                if batch is not None:
+                    pending.append(pool.submit(_extract_page_batch, batch, None, extractor))
+                yield pages
+
+    # Merge cached and freshly extracted pages back into page order.
+    next_page = 0
+    for pages in extracted_batches():
+        if cache is not None:
+            cache.put(doc_hash, extractor, pages, fingerprints)
+        for n, text in pages:
+            while next_page < n:
+                yield next_page, cached[next_page]
+                next_page += 1
+            yield n, text
+            next_page = n + 1
+    while next_page < num_pages:
+        yield next_page, cached[next_page]
+        next_page += 1
+    if cache is not None:
+        cache.put(doc_hash, extractor, [(n, cached[n]) for n in sorted(cached)], fingerprints, num_pages)
+
+def iter_chunks(texts, chunk_size=700, overlap=100):
+    """Yields the same chunks as chunk_text() over a stream of text pieces."""
+    step = chunk_size - overlap
+    buffer = ""
+    for piece in texts:
+        buffer += piece
+        while len(buffer) >= chunk_size:
+            yield buffer[:chunk_size]
+            buffer = buffer[step:]
+    while buffer:
+        yield buffer[:chunk_size]
+        buffer = buffer[step:]
+
+# --- Chunking Engine ---
+# Besides the fixed character windows of chunk_text(), two boundary-aware
+# strategies are available:
+#   "sentence": chunks of at most chunk_size characters that end on sentence or
+#               paragraph boundaries where possible;
+#   "token":    the same, but budgeted in MiniLM word pieces so no chunk is
+#               truncated by the embedding model.
+# Both pack chunks greedily over a precomputed array of boundary offsets with
+# np.searchsorted, and overlap by SENTENCE_OVERLAP boundaries instead of
+# repeating a fixed number of characters.
+CHUNK_STRATEGIES = ("fixed", "sentence", "token")
+SENTENCE_OVERLAP = 1
+_BOUNDARY_RE = re.compile(r"[.!?][\"')\]]*(?=\s)|\n[ \t]*\n")
+
+def boundary_offsets(text):
+    """Returns the sorted character offsets of sentence and paragraph ends in text."""
+    return np.fromiter((m.end() for m in _BOUNDARY_RE.finditer(text)), dtype=np.int64)
+
+def token_budget(model):
+    """Returns the number of word pieces a chunk may hold without being truncated by model."""
+    return max(int(getattr(model, "max_seq_length", None) or 256) - 2, 16)
+
+def _skip_space(text, i):
+    while i < len(text) and text[i].isspace():
+        i += 1
+    return i
+
+def boundary_chunk_spans(text, strategy="sentence", max_chars=700, tokenizer=None, max_tokens=254,
+                         overlap=SENTENCE_OVERLAP, final=True):
+    """Packs text into (start, end) chunk spans that end on sentence boundaries where possible.
+
+    Returns (spans, resume). With final=False, chunks that could still change if
+    more text were appended are not emitted, and resume is the offset at which
+    chunking should continue once it is.
+    """
+    n = len(text)
+    cuts = boundary_offsets(text)
+    if final and (len(cuts) == 0 or cuts[-1] != n):
+        cuts = np.append(cuts, n)
+
+    if strategy == "token":
+        token_starts = np.array(
+            [start for start, _ in tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]],
+            dtype=np.int64,
+        )
+        cost = lambda offsets: np.searchsorted(token_starts, offsets, side="left")
+        budget = max_tokens
+        # The last token of an unfinished buffer may be the first half of a word.
+        horizon = len(token_starts) if final else len(token_starts) - 1
+    elif strategy == "sentence":
+        token_starts = None
+        cost = lambda offsets: np.asarray(offsets, dtype=np.int64)
+        budget = max_chars
+        horizon = n if final else n - 1
+    else:
+        raise ValueError(f"Unknown chunking strategy {strategy!r}; expected one of {CHUNK_STRATEGIES}")
+
+    cut_costs = cost(cuts)
+    spans = []
+    start = _skip_space(text, 0)
+    while start < n:
+        limit = int(cost(start)) + budget
+        if not final and limit >= horizon:
+            break
+        # Furthest boundary past start that keeps the chunk within budget.
+        lo = np.searchsorted(cuts, start, side="right")
+        hi = np.searchsorted(cut_costs, limit, side="right")
+        if hi > lo:
+            j = hi - 1
+            end = int(cuts[j])
+            next_start = int(cuts[j - overlap]) if overlap and j - overlap >= lo else end
+        else:
+            # A single sentence longer than the budget: cut at the budget.
+            if token_starts is not None:
+                end = int(token_starts[limit]) if limit < len(token_starts) else n
+            else:
+                end = min(start + max_chars, n)
+                space = text.rfind(" ", start + 1, end)
+                end = space if end < n and space > start else end
+            next_start = end
+        spans.append((start, end))
+        start = _skip_space(text, max(next_start, start + 1))
+    return spans, start
+
+def iter_chunk_spans(pages, chunk_size=700, overlap=100, strategy="fixed", tokenizer=None, max_tokens=254):
+    """Like iter_chunks() over (page_number, text) pairs, yielding (chunk, page, start, end).
+
+    start/end are character offsets into the document text as extract_text_from_pdf()
+    would return it; page is the page on which the chunk starts. For the "sentence"
+    and "token" strategies, chunk_size is the character budget and overlap is ignored.
+    """
+    page_offsets, page_numbers = [], []
+    total = 0
+
+    def texts():
+        nonlocal total
+        for page_number, text in pages:
+            if text:
+                page_offsets.append(total)
+                page_numbers.append(page_number)
+                total += len(text) + 1
+                yield text + "\n"
+
+    def page_of(offset):
+        return page_numbers[bisect.bisect_right(page_offsets, offset) - 1]
+
+    if strategy == "fixed":
+        start = 0
+        for chunk in iter_chunks(texts(), chunk_size, overlap):
+            yield chunk, page_of(start), start, start + len(chunk)
+            start += chunk_size - overlap
+        return
+
+    # Chunk a sliding buffer of a few chunks' worth of text, emitting only chunks
+    # that later pages cannot change.
+    window = 8 * (chunk_size if strategy == "sentence" else 6 * max_tokens)
+    buffer, base = "", 0
+    pieces = texts()
+    while True:
+        piece = next(pieces, None)
+        if piece is not None:
+            buffer += piece
+            if len(buffer) < window:
+                continue
+        final = piece is None
+        spans, resume = boundary_chunk_spans(buffer, strategy, chunk_size, tokenizer, max_tokens, final=final)
+        for start, end in spans:
+            yield buffer[start:end], page_of(base + start), base + start, base + end
+        if final:
+            return
+        buffer, base = buffer[resume:], base + resume
+
+# --- Chunk Deduplication ---
+# Headers, footers, disclaimers and boilerplate sections repeat across pages and
+# documents, and overlapping windows can produce the same chunk twice. Chunks are
+# keyed by a hash of their normalized text (case-folded, whitespace collapsed);
+# with SIMHASH_DISTANCE > 0, chunks whose 64-bit SimHash differs from an earlier
+# chunk's in at most that many bits count as near-duplicates of it. Each
+# distinct chunk is embedded once (vectors are also cached on disk by content,
+# so other documents reuse them), a DocumentCollection stores one vector per
+# distinct chunk, and search returns each of them at most once.
+SIMHASH_DISTANCE = int(os.environ.get("CARAG_SIMHASH_DISTANCE", "0"))
+SIMHASH_MIN_SHINGLES = 8
+
+def normalize_chunk(text):
+    return " ".join(text.casefold().split())
+
+def chunk_key(text):
+    """Returns the content key of a chunk: a hash of its normalized text."""
+    return hashlib.blake2b(normalize_chunk(text).encode("utf-8"), digest_size=16).hexdigest()
+
+def simhash(text, k=3):
+    """Returns the 64-bit SimHash of text's k-word shingles, or None for very short text."""
+    features = shingles(text, k)
+    if len(features) < SIMHASH_MIN_SHINGLES:
+        return None
+    x = np.fromiter(features, dtype=np.uint64, count=len(features))[:, None]
+    bits = (x >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(features)
+    return int(sum(1 << i for i in np.flatnonzero(votes > 0)))
+
+class ChunkDeduplicator:
+    """Maps chunks to the key of the first equal (or near-equal) chunk seen.
+
+    Near-duplicate lookup splits signatures into max_distance + 1 bands: two
+    signatures within max_distance bits agree exactly on at least one band.
+    """
+
+    def __init__(self, max_distance=SIMHASH_DISTANCE):
+        self.max_distance = max_distance
+        self.keys = set()
+        self.signatures = {}  # key -> SimHash
+        self.bands = [{} for _ in range(max_distance + 1)] if max_distance else []
+        self.band_bits = 64 // len(self.bands) if self.bands else 0
+
+    def _band_values(self, signature):
+        mask = (1 << self.band_bits) - 1
+        return [(signature >> (b * self.band_bits)) & mask for b in range(len(self.bands))]
+
+    def canonical(self, text):
+        """Returns the canonical key for text, registering text as canonical if it is new."""
+        key = chunk_key(text)
+        if key in self.keys:
+            return key
+        signature = simhash(text) if self.bands else None
+        if signature is not None:
+            values = self._band_values(signature)
+            for band, value in zip(self.bands, values):
+                for other in band.get(value, ()):
+                    if bin(signature ^ self.signatures[other]).count("1") <= self.max_distance:
+                        return other
+            for band, value in zip(self.bands, values):
+                band.setdefault(value, []).append(key)
+            self.signatures[key] = signature
+        self.keys.add(key)
+        return key
+
+    def discard(self, key):
+        """Forgets a canonical key."""
+        self.keys.discard(key)
+        signature = self.signatures.pop(key, None)
+        if signature is not None:
+            for band, value in zip(self.bands, self._band_values(signature)):
+                band[value].remove(key)
+                if not band[value]:
+                    del band[value]
+
+class ChunkVectorCache:
+    """SQLite store of chunk embeddings keyed by model and chunk content key."""
+
+    def __init__(self, path=CHUNK_VECTOR_CACHE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS vectors (model TEXT NOT NULL, key TEXT NOT NULL,"
+                         " vector BLOB NOT NULL, PRIMARY KEY (model, key))")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_many(self, model_name, keys):
+        """Returns {key: float32 vector} for the keys that are cached."""
+        found = {}
+        try:
+            with self._connect() as conn:
+                for i in range(0, len(keys), 500):
+                    batch = keys[i:i + 500]
+                    rows = conn.execute(
+                        f"SELECT key, vector FROM vectors WHERE model = ? AND key IN ({','.join('?' * len(batch))})",
+                        [model_name, *batch]).fetchall()
+                    found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+        except sqlite3.Error as e:
+            print(f"Chunk vector cache lookup failed: {e}")
+        return found
+
+    def put_many(self, model_name, vectors):
+        """Stores {key: vector}."""
+        try:
+            with self._connect() as conn:
+                conn.executemany("INSERT OR REPLACE INTO vectors (model, key, vector) VALUES (?, ?, ?)",
+                                 [(model_name, key, np.asarray(v, dtype=np.float32).tobytes())
+                                  for key, v in vectors.items()])
+        except sqlite3.Error as e:
+            print(f"Chunk vector cache write failed: {e}")
+
+@st.cache_resource
+def get_chunk_vector_cache():
+    """Returns the process-wide chunk vector cache."""
+    return ChunkVectorCache()
+
+class ChunkEmbedder:
+    """Embeds the chunks of a document, encoding each distinct chunk only once.
+
+    Vectors of distinct chunks are kept for the lifetime of the embedder and, with
+    a vector_cache, shared with every other document embedded by the same model.
+    """
+
+    def __init__(self, model, vector_cache=None, model_name=None, max_distance=SIMHASH_DISTANCE, batch_size=32):
+        self.model = model
+        self.vector_cache = vector_cache
+        self.model_name = model_name or embedding_model_id(model)
+        self.dedup = ChunkDeduplicator(max_distance)
+        self.batch_size = batch_size
+        self.vectors = {}
+        self.stats = {"chunks": 0, "unique": 0, "cached": 0, "encoded": 0}
+
+    def encode(self, chunks, show_progress_bar=False):
+        """Returns a float32 array with one row per chunk."""
+        keys = [self.dedup.canonical(c) for c in chunks]
+        new = {}
+        for key, chunk in zip(keys, chunks):
+            if key not in self.vectors and key not in new:
+                new[key] = chunk
+        if new and self.vector_cache is not None:
+            cached = self.vector_cache.get_many(self.model_name, list(new))
+            self.vectors.update(cached)
+            self.stats["cached"] += len(cached)
+            new = {key: chunk for key, chunk in new.items() if key not in cached}
+        if new:
+            embeddings = self.model.encode(list(new.values()), batch_size=self.batch_size,
+                                           show_progress_bar=show_progress_bar).astype('float32')
+            encoded = dict(zip(new, embeddings))
+            self.vectors.update(encoded)
+            if self.vector_cache is not None:
+                self.vector_cache.put_many(self.model_name, encoded)
+            self.stats["encoded"] += len(encoded)
+        self.stats["chunks"] += len(chunks)
+        self.stats["unique"] = len(self.vectors)
+        if not chunks:
+            return np.empty((0, 0), dtype='float32')
+        return np.stack([self.vectors[key] for key in keys]).astype('float32', copy=False)
+
+@traced()
+def embed_pdf_streaming(pdf_bytes, model, chunk_size=700, overlap=100, batch_size=64, max_workers=None,
+                        strategy="fixed"):
+    """Extracts, chunks and embeds a PDF incrementally.
+
+    Returns (index, chunks, spans) where spans is an int64 array of (page, start, end) rows.
+    """
+    index = None
+    chunks = []
+    spans = []
+    batch = []
+    embedder = ChunkEmbedder(model, get_chunk_vector_cache(), batch_size=batch_size)
+
+    def flush():
+        nonlocal index
+        embeddings = embedder.encode(batch)
+        if index is None:
+            index = faiss.IndexFlatL2(embeddings.shape[1])
+        index.add(embeddings)
+        batch.clear()
+
     try:
-        embeddings = model.encode(chunks, show_progress_bar=True)
-        embeddings = embeddings.astype('float32')
-        index = faiss.IndexFlatL2(embeddings.shape[1])
+        pages = iter_pdf_pages(pdf_bytes, max_workers, cache=get_page_text_cache())
+        tokenizer = getattr(model, "tokenizer", None) if strategy == "token" else None
+        chunk_spans = iter_chunk_spans(pages, chunk_size, overlap, strategy, tokenizer, token_budget(model))
+        for chunk, page, start, end in chunk_spans:
+            chunks.append(chunk)
+            spans.append((page, start, end))
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        return index, chunks, np.array(spans, dtype=np.int64).reshape(-1, 3)
+    except Exception as e:
+        print(f"Error in streaming PDF ingestion: {e}")
+        return None, [], np.empty((0, 3), dtype=np.int64)
+
+# --- Index Factory ---
+# Brute-force search is exact and fast enough for a handful of PDFs; beyond that
+# we switch to approximate indexes. Each entry is (exclusive upper bound on the
+# number of vectors, index type); larger corpora use IVF-PQ.
+ANN_THRESHOLDS = [(20_000, "flat"), (200_000, "hnsw"), (2_000_000, "ivf_flat")]
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+# Vector storage for the flat, HNSW and IVF-Flat types: full float32, or a
+# scalar-quantized float16 (2x smaller) or int8 (4x smaller) encoding.
+VECTOR_STORAGES = {"float32": None, "float16": "QT_fp16", "int8": "QT_8bit"}
+
+def choose_index_type(num_vectors):
+    """Returns the index type recommended for a corpus of num_vectors vectors."""
+    for limit, index_type in ANN_THRESHOLDS:
+        if num_vectors < limit:
+            return index_type
+    return "ivf_pq"
+
+def _default_pq_m(dim):
+    """Largest number of PQ sub-quantizers of at least 4 dimensions that divides dim."""
+    for m in range(max(1, dim // 4), 0, -1):
+        if dim % m == 0 and m <= 64:
+            return m
+    return 1
+
+@traced()
+def build_faiss_index(embeddings, index_type="auto", ids=None, storage="float32", nlist=None, pq_m=None,
+                      pq_nbits=8, hnsw_m=32, ef_construction=40, nprobe=16, ef_search=64, train_size=None,
+                      seed=1234):
+    """Builds and fills a FAISS index of the given (or automatically chosen) type.
+
+    IVF and scalar-quantized indexes are trained on a random sample of the
+    embeddings. If ids are given the vectors are added under those ids: IVF
+    indexes store ids natively, other types are wrapped in an IndexIDMap2.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    n, dim = embeddings.shape
+    if index_type == "auto":
+        index_type = choose_index_type(n)
+    if storage not in VECTOR_STORAGES:
+        raise ValueError(f"Unknown vector storage {storage!r}; expected one of {tuple(VECTOR_STORAGES)}")
+    qtype = getattr(faiss.ScalarQuantizer, VECTOR_STORAGES[storage]) if VECTOR_STORAGES[storage] else None
+
+    def sample(size):
+        size = min(n, size)
+        return embeddings[np.random.default_rng(seed).choice(n, size, replace=False)] if size < n else embeddings
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim) if qtype is None else faiss.IndexScalarQuantizer(dim, qtype)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m) if qtype is None else faiss.IndexHNSWSQ(dim, qtype, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = nlist or int(np.clip(4 * np.sqrt(n), 1, max(1, n // 39)))
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat" and qtype is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype)
+            min_train = 39 * nlist
+        elif index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+            min_train = 39 * nlist
+        else:
+            pq_m = pq_m or _default_pq_m(dim)
+            pq_nbits = max(1, min(pq_nbits, int(np.log2(max(n // 39, 2)))))
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_nbits)
+            min_train = 39 * max(nlist, 2 ** pq_nbits)
+        index.train(sample(train_size or max(min_train, 10_000)))
+        # A hashtable direct map keeps reconstruct() and remove_ids() working by id,
+        # but only registers vectors added with explicit ids.
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        if ids is None:
+            ids = np.arange(n, dtype=np.int64)
+    else:
+        raise ValueError(f"Unknown index type {index_type!r}; expected 'auto' or one of {INDEX_TYPES}")
+    if not index.is_trained:
+        index.train(sample(train_size or 10_000))
+
+    if ids is not None:
+        if not isinstance(index, faiss.IndexIVF):
+            index = faiss.IndexIDMap2(index)
+        index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+    else:
         index.add(embeddings)
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    return index
+
+def _unwrap_index(index):
+    """Returns the innermost index of an IndexIDMap/IndexIDMap2 wrapper."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+def index_type_of(index):
+    """Returns the INDEX_TYPES name of a FAISS index."""
+    inner = _unwrap_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+def storage_of(index):
+    """Returns the VECTOR_STORAGES name of a FAISS index's vector encoding."""
+    inner = _unwrap_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    sq = getattr(inner, "sq", None)
+    if sq is not None:
+        for storage, qtype in VECTOR_STORAGES.items():
+            if qtype and sq.qtype == getattr(faiss.ScalarQuantizer, qtype):
+                return storage
+    return "float32"
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Sets the nprobe (IVF) and efSearch (HNSW) knobs where they apply."""
+    inner = _unwrap_index(index)
+    if nprobe is not None and isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = min(nprobe, inner.nlist)
+    if ef_search is not None and isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = ef_search
+
+def search_parameters(index, selector=None):
+    """Builds FAISS SearchParameters of the right type for index, carrying its current knobs."""
+    inner = _unwrap_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+def evaluate_recall(index, embeddings, queries=None, k=10, num_queries=200, ids=None, seed=1234):
+    """Measures recall@k and query latency of index against exact flat search over embeddings.
+
+    ids maps embedding rows to the ids stored in index (for IndexIDMap-wrapped indexes).
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    if queries is None:
+        rows = np.random.default_rng(seed).choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)
+        queries = embeddings[rows]
+    queries = np.ascontiguousarray(queries, dtype='float32')
+
+    flat = faiss.IndexFlatL2(embeddings.shape[1])
+    flat.add(embeddings)
+    t0 = time.perf_counter()
+    _, truth = flat.search(queries, k)
+    flat_seconds = time.perf_counter() - t0
+    if ids is not None:
+        truth = np.asarray(ids, dtype=np.int64)[truth]
+
+    t0 = time.perf_counter()
+    _, found = index.search(queries, k)
+    index_seconds = time.perf_counter() - t0
+
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth.tolist(), found.tolist()))
+    return {
+        "index_type": index_type_of(index),
+        "k": k,
+        "recall_at_k": hits / float(truth.size),
+        "flat_ms_per_query": 1000 * flat_seconds / len(queries),
+        "index_ms_per_query": 1000 * index_seconds / len(queries),
+        "flat_bytes": int(embeddings.nbytes),
+        "index_bytes": int(faiss.serialize_index(index).nbytes),
+    }
+
+@traced()
+def index_chunks(chunks, model, index_type="auto", **index_params):
+    """Creates a FAISS index for text chunks."""
+    try:
+        embeddings = ChunkEmbedder(model, get_chunk_vector_cache()).encode(chunks, show_progress_bar=True)
+        index = build_faiss_index(embeddings, index_type, **index_params)
         return index, chunks
     except Exception as e:
         print(f"Error creating FAISS index: {e}")
         return None, []
 
 
+# --- Persistent Index Cache ---
+# Indexes are stored under INDEX_CACHE_DIR/<key>/ where <key> hashes the PDF bytes
+# together with the chunking/embedding parameters, so any session or process that
+# sees the same file with the same settings reuses the embeddings instead of
+# recomputing them.
+class ChunkArena:
+    """Read-only sequence of chunk strings backed by a memory-mapped UTF-8 blob."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @staticmethod
+    def save(directory, chunks):
+        """Writes chunks as a UTF-8 blob plus an int64 offsets array."""
+        encoded = [c.encode("utf-8") for c in chunks]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        with open(os.path.join(directory, "chunks.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(os.path.join(directory, "offsets.npy"), offsets)
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-maps a chunk arena previously written with save()."""
+        blob_path = os.path.join(directory, "chunks.bin")
+        offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        if os.path.getsize(blob_path) == 0:
+            blob = np.zeros(0, dtype=np.uint8)
+        else:
+            blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        return cls(blob, offsets)
+
+
+def compute_index_key(pdf_bytes, model_name, chunk_size=700, overlap=100, strategy="fixed", extractor=None):
+    """Returns a content hash of the PDF bytes, the text extractor and the chunking/embedding parameters.
+
+    model_name is the embedding_model_id() of the model the index is built with.
+    """
+    h = hashlib.sha256(pdf_bytes)
+    params = {"chunk_size": chunk_size, "overlap": overlap, "model": model_name,
+              "extractor": resolve_pdf_extractor(extractor or PDF_EXTRACTOR)}
+    if strategy != "fixed":
+        params.update(strategy=strategy, sentence_overlap=SENTENCE_OVERLAP)
+    h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+def load_cached_index(key, cache_dir=INDEX_CACHE_DIR):
+    """Loads a cached FAISS index and its chunks from disk, or returns (None, [])."""
+    index, chunks, _ = load_cached_document(key, cache_dir)
+    return index, chunks
+
+def load_cached_document(key, cache_dir=INDEX_CACHE_DIR):
+    """Like load_cached_index(), also returning the (page, start, end) spans or None."""
+    entry_dir = os.path.join(cache_dir, key)
+    index_path = os.path.join(entry_dir, "index.faiss")
+    spans_path = os.path.join(entry_dir, "spans.npy")
+    if not os.path.exists(index_path):
+        return None, [], None
+    try:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        spans = np.load(spans_path, mmap_mode="r") if os.path.exists(spans_path) else None
+        return index, ChunkArena.load(entry_dir), spans
+    except Exception as e:
+        print(f"Error loading cached index {key}: {e}")
+        return None, [], None
+
+def save_index_to_cache(key, index, chunks, cache_dir=INDEX_CACHE_DIR, spans=None):
+    """Atomically writes a FAISS index and its chunks to the on-disk cache."""
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{key}.", dir=cache_dir)
+        faiss.write_index(index, os.path.join(tmp_dir, "index.faiss"))
+        ChunkArena.save(tmp_dir, chunks)
+        if spans is not None:
+            np.save(os.path.join(tmp_dir, "spans.npy"), np.asarray(spans, dtype=np.int64))
+        try:
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # Another process finished the same entry first; keep theirs.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return True
+    except Exception as e:
+        print(f"Error saving index {key} to cache: {e}")
+        return False
+
+@traced()
+def load_or_build_document(pdf_bytes, model, chunk_size=700, overlap=100, cache_dir=INDEX_CACHE_DIR, streaming=True,
+                           strategy="fixed"):
+    """Returns a dict with the key, index, chunks and spans of a PDF, using the cache when possible.
+
+    Boundary-aware chunking strategies always use the streaming pipeline.
+    """
+    key = compute_index_key(pdf_bytes, embedding_model_id(model), chunk_size, overlap, strategy=strategy)
+    index, chunks, spans = load_cached_document(key, cache_dir)
+    if index is not None:
+        return {"key": key, "index": index, "chunks": chunks, "spans": spans}
+
+    if streaming or strategy != "fixed":
+        index, chunks, spans = embed_pdf_streaming(pdf_bytes, model, chunk_size, overlap, strategy=strategy)
+    else:
+        text = extract_text_from_pdf(io.BytesIO(pdf_bytes))
+        if not text:
+            return {"key": key, "index": None, "chunks": [], "spans": None}
+        index, chunks = index_chunks(chunk_text(text, chunk_size, overlap), model)
+        starts = np.arange(len(chunks), dtype=np.int64) * (chunk_size - overlap)
+        spans = np.stack([np.full_like(starts, -1), starts, np.minimum(starts + chunk_size, len(text))], axis=1)
+    if index is not None and save_index_to_cache(key, index, chunks, cache_dir, spans):
+        # Reload so the session holds memory-mapped chunk text shared with every
+        # other session, instead of its own copy of the strings.
+        cached_index, cached_chunks, cached_spans = load_cached_document(key, cache_dir)
+        if cached_index is not None:
+            index, chunks, spans = cached_index, cached_chunks, cached_spans
+    return {"key": key, "index": index, "chunks": chunks, "spans": spans}
+
+# --- Sparse (BM25) Retrieval ---
+# Dense embeddings blur exact identifiers such as part numbers and acronyms, so a
+# BM25 index is kept next to the vector index. Raw term frequencies live in a
+# sparse matrix with one row per chunk; BM25 weights are computed at query time
+# for the query's columns only, so adding or removing rows needs no re-weighting.
+_TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+
+def tokenize(text):
+    """Lower-cases text and splits it into word tokens, keeping identifiers like 'XJ-200' whole."""
+    return _TOKEN_RE.findall(text.lower())
+
+class BM25Index:
+    """Okapi BM25 over a CSR term-frequency matrix whose rows are chunks."""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocab = {}
+        self.tf = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self._tf_csc = None
+
+    def __len__(self):
+        return self.tf.shape[0]
+
+    def add(self, texts):
+        """Appends one row per text."""
+        indptr, indices, data = [0], [], []
+        for text in texts:
+            term_ids = [self.vocab.setdefault(token, len(self.vocab)) for token in tokenize(text)]
+            terms, counts = np.unique(np.asarray(term_ids, dtype=np.int64), return_counts=True)
+            indices.append(terms)
+            data.append(counts)
+            indptr.append(indptr[-1] + len(terms))
+        rows = sparse.csr_matrix(
+            (np.concatenate(data or [[]]).astype(np.float32), np.concatenate(indices or [[]]).astype(np.int64), indptr),
+            shape=(len(indptr) - 1, len(self.vocab)),
+        )
+        tf = self.tf.copy()
+        tf.resize((tf.shape[0], len(self.vocab)))
+        self.tf = sparse.vstack([tf, rows], format="csr")
+        self.doc_lengths = np.asarray(self.tf.sum(axis=1), dtype=np.float32).ravel()
+        self._tf_csc = None
+
+    def remove(self, keep):
+        """Keeps only the rows where the boolean mask keep is True."""
+        self.tf = self.tf[keep]
+        self.doc_lengths = self.doc_lengths[keep]
+        self._tf_csc = None
+
+    def scores(self, query):
+        """Returns the BM25 score of every row for query as a dense array."""
+        n = len(self)
+        term_ids = sorted({self.vocab[t] for t in tokenize(query) if t in self.vocab})
+        if n == 0 or not term_ids:
+            return np.zeros(n, dtype=np.float32)
+        if self._tf_csc is None:
+            self._tf_csc = self.tf.tocsc()
+        columns = self._tf_csc[:, term_ids]
+        df = np.diff(columns.indptr)
+        idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        rows = columns.indices
+        tf = columns.data
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[rows] / max(self.doc_lengths.mean(), 1e-9))
+        weights = np.repeat(idf, df) * tf * (self.k1 + 1) / (tf + norm)
+        return np.bincount(rows, weights=weights, minlength=n).astype(np.float32)
+
+    def search(self, query, top_k=10, mask=None):
+        """Returns (rows, scores) of the top_k rows with a positive score, optionally within mask."""
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        order = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return order, scores[order]
+
+def reciprocal_rank_fusion(rankings, k=60, weights=None):
+    """Fuses ranked lists of ids, returning [(id, score), ...] sorted by descending RRF score."""
+    fused = {}
+    for ranking, weight in zip(rankings, weights or [1.0] * len(rankings)):
+        for rank, item in enumerate(ranking):
+            fused[item] = fused.get(item, 0.0) + weight / (k + rank + 1)
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
+
+
+# --- Multi-Document Collection ---
+class DocumentCollection:
+    """Many PDFs in a single FAISS IndexIDMap2 with an array-backed side table.
+
+    Chunk ids are assigned in increasing order, so each document owns a contiguous
+    id range and the side table stays sorted by id. Each row stores the document
+    slot, the chunk number within that document, its (page, start, end) span and
+    the id of its vector. Duplicate chunks (see ChunkDeduplicator), within or
+    across documents, share one vector, and search returns each vector once.
+    A BM25 index with rows aligned to the side table supports hybrid search.
+    """
+
+    def __init__(self, dim, index_type="auto", near_duplicate_bits=SIMHASH_DISTANCE, **index_params):
+        self.dim = dim
+        self.index_type = index_type
+        self.index_params = index_params
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+        self.next_id = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.doc_slots = np.empty(0, dtype=np.int32)
+        self.chunk_nos = np.empty(0, dtype=np.int32)
+        self.spans = np.empty((0, 3), dtype=np.int64)
+        self.vector_ids = np.empty(0, dtype=np.int64)
+        self.documents = {}  # doc_id -> {"slot", "name", "chunks", "id_range"}
+        self.slot_to_doc = []
+        self.sparse = BM25Index()
+        self.dedup = ChunkDeduplicator(near_duplicate_bits)
+        self.key_to_vector = {}
+        self.vector_keys = {}  # vector id -> [content key, number of rows using it]
+        self.next_vector_id = 0
+        self._vector_order = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.documents
+
+    def add_document(self, doc_id, name, embeddings, chunks, spans=None):
+        """Adds a document's vectors; returns False if doc_id is already present."""
+        if doc_id in self.documents:
+            return False
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        n = len(embeddings)
+        ids = np.arange(self.next_id, self.next_id + n, dtype=np.int64)
+        if spans is None:
+            spans = np.full((n, 3), -1, dtype=np.int64)
+        vector_ids = np.empty(n, dtype=np.int64)
+        new_rows = []
+        for i, chunk in enumerate(chunks):
+            key = self.dedup.canonical(chunk)
+            vector_id = self.key_to_vector.get(key)
+            if vector_id is None:
+                vector_id = self.key_to_vector[key] = self.next_vector_id
+                self.vector_keys[vector_id] = [key, 0]
+                self.next_vector_id += 1
+                new_rows.append(i)
+            self.vector_keys[vector_id][1] += 1
+            vector_ids[i] = vector_id
+        if new_rows and self.index.ntotal == 0:
+            # Build (and train, for quantized storage) the configured index type.
+            self._set_vectors(embeddings[new_rows], vector_ids[new_rows])
+        elif new_rows:
+            self.index.add_with_ids(embeddings[new_rows], vector_ids[new_rows])
+
+        slot = len(self.slot_to_doc)
+        self.slot_to_doc.append(doc_id)
+        self.documents[doc_id] = {"slot": slot, "name": name, "chunks": chunks,
+                                  "id_range": (self.next_id, self.next_id + n)}
+        self.ids = np.concatenate([self.ids, ids])
+        self.doc_slots = np.concatenate([self.doc_slots, np.full(n, slot, dtype=np.int32)])
+        self.chunk_nos = np.concatenate([self.chunk_nos, np.arange(n, dtype=np.int32)])
+        self.spans = np.concatenate([self.spans, np.asarray(spans, dtype=np.int64).reshape(n, 3)])
+        self.vector_ids = np.concatenate([self.vector_ids, vector_ids])
+        self._vector_order = None
+        self.sparse.add(chunks)
+        self.next_id += n
+        if self.index_type == "auto" and choose_index_type(self.index.ntotal) != index_type_of(self.index):
+            self.rebuild_index()
+        return True
+
+    def rebuild_index(self, index_type=None, **index_params):
+        """Rebuilds the vector index, e.g. to switch to an approximate index type or storage.
+
+        Vectors are reconstructed from the current index, which is lossy if it is
+        IVF-PQ or scalar-quantized.
+        """
+        if index_type is not None:
+            self.index_type = index_type
+            self.index_params = index_params
+        vector_ids = self.live_vector_ids()
+        self._set_vectors(self.index.reconstruct_batch(vector_ids) if len(vector_ids) else None, vector_ids)
+
+    def live_vector_ids(self):
+        """Returns the sorted ids of the vectors in the index."""
+        return np.fromiter(sorted(self.vector_keys), dtype=np.int64, count=len(self.vector_keys))
+
+    def _rows_of_vector(self, vector_id, mask=None):
+        """Returns the side-table rows (in id order) that share vector_id, limited to mask."""
+        if self._vector_order is None:
+            order = np.argsort(self.vector_ids, kind="stable")
+            self._vector_order = (order, self.vector_ids[order])
+        order, sorted_ids = self._vector_order
+        rows = order[np.searchsorted(sorted_ids, vector_id, "left"):np.searchsorted(sorted_ids, vector_id, "right")]
+        return rows if mask is None else rows[mask[rows]]
+
+    def _set_vectors(self, embeddings, ids):
+        """Replaces the index with a freshly built one holding embeddings under ids."""
+        if len(ids) == 0:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+        else:
+            self.index = build_faiss_index(embeddings, self.index_type, ids=ids, **self.index_params)
+
+    def memory_report(self):
+        """Returns estimated bytes held per document and in total.
+
+        Vector bytes are the serialized index size apportioned by vector count.
+        Chunk text in a memory-mapped ChunkArena is page cache shared by every
+        session and process using the same cached document, so it is reported
+        separately as shared_text_bytes.
+        """
+        total_rows = max(len(self.ids), 1)
+        index_bytes = int(faiss.serialize_index(self.index).nbytes) if len(self.ids) else 0
+        row_bytes = (self.ids.itemsize + self.doc_slots.itemsize + self.chunk_nos.itemsize
+                     + self.spans.itemsize * self.spans.shape[1] + self.vector_ids.itemsize)
+        tf = self.sparse.tf
+        sparse_bytes = tf.data.nbytes + tf.indices.nbytes + tf.indptr.nbytes + self.sparse.doc_lengths.nbytes
+
+        documents = {}
+        for doc_id, doc in self.documents.items():
+            n = int(np.count_nonzero(self.doc_slots == doc["slot"]))
+            chunks = doc["chunks"]
+            if isinstance(chunks, ChunkArena):
+                private_text, shared_text = chunks.offsets.nbytes, int(chunks.blob.nbytes)
+            else:
+                private_text, shared_text = sum(sys.getsizeof(c) for c in chunks), 0
+            # Shared vectors are apportioned by the number of chunks using them.
+            vector_bytes = index_bytes * n // total_rows
+            private = vector_bytes + n * row_bytes + sparse_bytes * n // total_rows + private_text
+            documents[doc_id] = {
+                "name": doc["name"],
+                "chunks": n,
+                "vector_bytes": vector_bytes,
+                "private_bytes": private,
+                "shared_text_bytes": shared_text,
+            }
+        return {
+            "index_type": index_type_of(self.index),
+            "storage": storage_of(self.index),
+            "index_bytes": index_bytes,
+            "chunks": len(self.ids),
+            "vectors": self.index.ntotal,
+            "side_table_bytes": len(self.ids) * row_bytes,
+            "sparse_bytes": int(sparse_bytes),
+            "private_bytes": sum(d["private_bytes"] for d in documents.values()),
+            "shared_text_bytes": sum(d["shared_text_bytes"] for d in documents.values()),
+            "documents": documents,
+        }
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Sets the nprobe/efSearch knobs of the collection's index."""
+        set_search_params(self.index, nprobe, ef_search)
+
+    def evaluate_recall(self, k=10, num_queries=200):
+        """Reports recall@k and latency of the current index against exact search."""
+        vector_ids = self.live_vector_ids()
+        embeddings = self.index.reconstruct_batch(vector_ids)
+        return evaluate_recall(self.index, embeddings, k=k, num_queries=num_queries, ids=vector_ids)
+
+    def add_pdf(self, pdf_bytes, name, model, **kwargs):
+        """Indexes (or loads from cache) a PDF and adds it. Returns its doc id, or None on failure."""
+        doc = load_or_build_document(pdf_bytes, model, **kwargs)
+        if doc["index"] is None:
+            return None
+        if doc["key"] not in self.documents:
+            embeddings = doc["index"].reconstruct_n(0, doc["index"].ntotal)
+            self.add_document(doc["key"], name, embeddings, doc["chunks"], doc["spans"])
+        return doc["key"]
+
+    def remove_document(self, doc_id):
+        """Removes a document's vectors without rebuilding the index."""
+        doc = self.documents.pop(doc_id, None)
+        if doc is None:
+            return False
+        keep = self.doc_slots != doc["slot"]
+        # Only vectors no other document's chunks still use are removed.
+        removed = []
+        for vector_id, count in zip(*np.unique(self.vector_ids[~keep], return_counts=True)):
+            entry = self.vector_keys[int(vector_id)]
+            entry[1] -= int(count)
+            if entry[1] == 0:
+                del self.vector_keys[int(vector_id)]
+                del self.key_to_vector[entry[0]]
+                self.dedup.discard(entry[0])
+                removed.append(vector_id)
+        removed = np.array(removed, dtype=np.int64)
+        if index_type_of(self.index) == "hnsw":
+            # HNSW graphs do not support deletion; rebuild from the remaining vectors.
+            ids = self.live_vector_ids()
+            self._set_vectors(self.index.reconstruct_batch(ids) if len(ids) else None, ids)
+        elif len(removed):
+            # IVF hashtable direct maps only accept IDSelectorArray for removal.
+            self.index.remove_ids(faiss.IDSelectorArray(len(removed), faiss.swig_ptr(removed)))
+        self.ids = self.ids[keep]
+        self.doc_slots = self.doc_slots[keep]
+        self.chunk_nos = self.chunk_nos[keep]
+        self.spans = self.spans[keep]
+        self.vector_ids = self.vector_ids[keep]
+        self._vector_order = None
+        self.sparse.remove(keep)
+        self.slot_to_doc[doc["slot"]] = None
+        return True
+
+    @traced("faiss_search")
+    def search(self, query_embeddings, top_k=3, doc_ids=None, query_texts=None, fetch_k=None):
+        """Searches all documents, or only doc_ids, returning a list of hits per query.
+
+        If query_texts are given, dense and BM25 results (fetch_k of each) are fused
+        with reciprocal rank fusion and each hit also carries its fused "score".
+        Chunks sharing a vector are returned once, as the first of them, with the
+        number of other copies in "duplicates".
+        """
+        query_embeddings = np.ascontiguousarray(query_embeddings, dtype='float32')
+        if self.index.ntotal == 0:
+            return [[] for _ in range(len(query_embeddings))]
+        hybrid = query_texts is not None
+        fetch_k = fetch_k or (max(4 * top_k, 20) if hybrid else top_k)
+
+        params = None
+        mask = None
+        if doc_ids is not None:
+            slots = [self.documents[d]["slot"] for d in doc_ids if d in self.documents]
+            mask = np.isin(self.doc_slots, slots)
+            selector = faiss.IDSelectorBatch(np.unique(self.vector_ids[mask]))
+            params = search_parameters(self.index, selector)
+        distances, ids = self.index.search(query_embeddings, fetch_k, params=params)
+
+        results = []
+        for i, (row_distances, row_ids) in enumerate(zip(distances, ids)):
+            valid = row_ids >= 0
+            dense = dict(zip(row_ids[valid].tolist(), row_distances[valid].tolist()))
+            if not hybrid:
+                results.append([self._hit(vector_id, mask, distance) for vector_id, distance in dense.items()])
+                continue
+            sparse_rows, _ = self.sparse.search(query_texts[i], fetch_k, mask)
+            # BM25 ranks every copy of a chunk equally; keep the first of each.
+            sparse = list(dict.fromkeys(self.vector_ids[sparse_rows].tolist()))
+            fused = reciprocal_rank_fusion([list(dense), sparse])[:top_k]
+            results.append([self._hit(vector_id, mask, dense.get(vector_id), score) for vector_id, score in fused])
+        return results
+
+    def _hit(self, vector_id, mask=None, distance=None, score=None):
+        """Builds the result dict for a vector, from the first side-table row using it."""
+        rows = self._rows_of_vector(vector_id, mask)
+        row = rows[0]
+        doc_id = self.slot_to_doc[self.doc_slots[row]]
+        doc = self.documents[doc_id]
+        page, start, end = (int(v) for v in self.spans[row])
+        hit = {
+            "text": doc["chunks"][int(self.chunk_nos[row])],
+            "doc_id": doc_id,
+            "name": doc["name"],
+            "page": page,
+            "start": start,
+            "end": end,
+            "distance": None if distance is None else float(distance),
+            "duplicates": len(rows) - 1,
+        }
+        if score is not None:
+            hit["score"] = score
+        return hit
+
+
+# --- Shared Index Registry ---
+# Sessions that load the same PDFs with the same settings share one read-only
+# DocumentCollection instead of each holding (and embedding) its own copy.
+# Entries are reference-counted by their content key; a session's handle
+# releases its reference when it is replaced or garbage-collected with the
+# session. Unreferenced entries stay cached until the memory budget forces
+# least-recently-used eviction.
+def collection_key(documents, **config):
+    """Returns the registry key for a collection of (doc_id, name) pairs built with config."""
+    payload = {"documents": sorted(documents), "config": config}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+@traced()
+def build_collection(documents, model, **collection_kwargs):
+    """Builds a DocumentCollection from (name, pdf_bytes) pairs; PDFs that fail are skipped."""
+    strategy = collection_kwargs.pop("strategy", "fixed")
+    collection = DocumentCollection(model.get_sentence_embedding_dimension(), **collection_kwargs)
+    for name, pdf_bytes in documents:
+        collection.add_pdf(pdf_bytes, name, model, strategy=strategy)
+    return collection
+
+class SharedHandle:
+    """A session's reference to a shared, read-only registry entry."""
+
+    def __init__(self, registry, key, value):
+        self.key = key
+        self.value = value
+        self._finalizer = weakref.finalize(self, registry._release, key)
+
+    def release(self):
+        """Drops this reference (idempotent)."""
+        self._finalizer()
+
+class IndexRegistry:
+    """Process-wide, reference-counted cache of shared indexes with a memory budget."""
+
+    def __init__(self, budget_bytes=INDEX_REGISTRY_BUDGET_BYTES, size_of=None):
+        self.budget_bytes = budget_bytes
+        self.size_of = size_of or (lambda value: value.memory_report()["private_bytes"])
+        self._entries = OrderedDict()  # key -> {"value", "refs", "bytes", "ready", "error"}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, build):
+        """Returns a SharedHandle for key, calling build() once if no session has built it yet.
+
+        Concurrent acquirers of a key that is still being built wait for that build.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            is_builder = entry is None
+            if is_builder:
+                entry = self._entries[key] = {"value": None, "refs": 0, "bytes": 0,
+                                              "ready": threading.Event(), "error": None}
+            entry["refs"] += 1
+            self._entries.move_to_end(key)
+
+        if is_builder:
+            try:
+                value = build()
+                size = self.size_of(value)
+            except Exception as e:
+                with self._lock:
+                    entry["error"] = e
+                    self._entries.pop(key, None)
+                entry["ready"].set()
+                raise
+            with self._lock:
+                entry["value"], entry["bytes"] = value, size
+                self._evict()
+            entry["ready"].set()
+        else:
+            entry["ready"].wait()
+            if entry["error"] is not None:
+                raise entry["error"]
+        return SharedHandle(self, key, entry["value"])
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["refs"] = max(entry["refs"] - 1, 0)
+                self._evict()
+
+    def _evict(self):
+        """Drops unreferenced entries, least recently used first, until within budget. Needs the lock."""
+        total = sum(e["bytes"] for e in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.budget_bytes:
+                break
+            entry = self._entries[key]
+            if entry["refs"] == 0 and entry["ready"].is_set():
+                total -= entry["bytes"]
+                del self._entries[key]
+
+    def stats(self):
+        """Returns the number of entries, their total bytes and live references."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e["bytes"] for e in self._entries.values()),
+                "references": sum(e["refs"] for e in self._entries.values()),
+                "budget_bytes": self.budget_bytes,
+            }
+
+@st.cache_resource
+def get_index_registry():
+    """Returns the process-wide shared index registry."""
+    return IndexRegistry()
+
+
+# --- Cross-Encoder Reranking ---
+# Retrieval over-fetches candidates and a small local cross-encoder scores all
+# (query, chunk) pairs in one batched forward pass. Results are cut where the
+# score drops sharply, so only clearly relevant chunks reach the 70B model.
+# Scores are cached per (query, chunk), and the candidate count shrinks
+# automatically if scoring would exceed the time budget.
+@st.cache_resource
+def get_cross_encoder():
+    """Returns a cached cross-encoder model for reranking."""
+    return sentence_transformers.CrossEncoder(RERANKER_MODEL_NAME)
+
+class Reranker:
+    """Batched, cached cross-encoder reranking with an adaptive score-gap cut-off."""
+
+    def __init__(self, model, max_candidates=20, max_seconds=0.3, score_gap=3.0, min_keep=1,
+                 batch_size=32, cache_size=20000):
+        self.model = model
+        self.max_candidates = max_candidates
+        self.max_seconds = max_seconds
+        self.score_gap = score_gap
+        self.min_keep = min_keep
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.seconds_per_pair = None
+        self.last_stats = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def candidate_budget(self):
+        """Number of candidates that can be scored within max_seconds, capped at max_candidates."""
+        if not self.seconds_per_pair:
+            return self.max_candidates
+        return int(np.clip(self.max_seconds / self.seconds_per_pair, self.min_keep, self.max_candidates))
+
+    @staticmethod
+    def _chunk_key(hit):
+        if isinstance(hit, dict) and hit.get("start", -1) >= 0:
+            return (hit["doc_id"], hit["start"], hit["end"])
+        text = hit["text"] if isinstance(hit, dict) else hit
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @traced("rerank")
+    def rerank(self, query, hits, top_k=3):
+        """Reorders hits (dicts with "text", or plain strings) by cross-encoder score.
+
+        Returns at most top_k hits, cut at the first score gap larger than score_gap.
+        Dict hits gain a "rerank_score" key.
+        """
+        start = time.perf_counter()
+        hits = list(hits)[:self.candidate_budget()]
+        query_key = normalize_query(query)
+        keys = [(query_key, self._chunk_key(hit)) for hit in hits]
+        scores = np.empty(len(hits), dtype=np.float32)
+        with self._lock:
+            missing = []
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[i] = self._cache[key]
+                else:
+                    missing.append(i)
+
+        if missing:
+            pairs = [(query, hits[i]["text"] if isinstance(hits[i], dict) else hits[i]) for i in missing]
+            t0 = time.perf_counter()
+            predicted = np.asarray(self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False))
+            per_pair = (time.perf_counter() - t0) / len(pairs)
+            self.seconds_per_pair = per_pair if self.seconds_per_pair is None else 0.8 * self.seconds_per_pair + 0.2 * per_pair
+            scores[missing] = predicted
+            with self._lock:
+                for i in missing:
+                    self._cache[keys[i]] = float(scores[i])
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        keep = len(order)
+        gaps = -np.diff(scores[order])
+        for i, gap in enumerate(gaps):
+            if i + 1 >= self.min_keep and gap > self.score_gap:
+                keep = i + 1
+                break
+
+        ranked = []
+        for i in order[:keep]:
+            hit = hits[i]
+            if isinstance(hit, dict):
+                hit = dict(hit, rerank_score=float(scores[i]))
+            ranked.append(hit)
+        self.last_stats = {"candidates": len(hits), "scored": len(missing), "kept": len(ranked),
+                           "seconds": time.perf_counter() - start}
+        return ranked
+
+@st.cache_resource
+def get_reranker():
+    """Returns the process-wide reranker."""
+    return Reranker(get_cross_encoder())
+
+
 # --- Agentic RAG Tools ---
 # ... (retrieve_pdf_chunks, tavily_web_search, decide_tool_to_use, generate_answer_stream... no changes here)
+@traced()
 def retrieve_pdf_chunks(question, chunks, index, model, top_k=3):
     """Retrieves the most relevant chunks from the PDF."""
     try:
         question_embedding = model.encode([question]).astype('float32')
-        distances, indices = index.search(question_embedding, top_k)
-        return [chunks[i] for i in indices[0]]
+        # Fetch extra neighbours so repeated boilerplate does not crowd out distinct chunks.
+        distances, indices = index.search(question_embedding, min(4 * top_k, index.ntotal))
+        results, seen = [], set()
+        for i in indices[0]:
+            if i < 0:
+                continue
+            key = chunk_key(chunks[i])
+            if key not in seen:
+                seen.add(key)
+                results.append(chunks[i])
+                if len(results) == top_k:
+                    break
+        return results
     except Exception as e:
         print(f"Error retrieving PDF chunks: {e}")
         return []
 
-def tavily_web_search(question, top_k=3):
-    """Performs a web search using Tavily."""
+@traced()
+def retrieve_from_collection(question, collection, model, top_k=3, doc_ids=None, hybrid=True, reranker=None):
+    """Retrieves the most relevant chunks, with provenance, from a DocumentCollection.
+
+    With hybrid=True, dense and BM25 results are fused with reciprocal rank fusion.
+    With a reranker, more candidates are fetched and reranked down to top_k.
+    """
     try:
-        client = get_tavily_client()
-        response = client.search(
-            query=question, 
-            search_depth="basic", 
-            max_results=top_k
-        )
-        return [result['content'] for result in response['results']]
+        question_embedding = model.encode([question]).astype('float32')
+        query_texts = [question] if hybrid else None
+        if reranker is None:
+            return collection.search(question_embedding, top_k, doc_ids, query_texts)[0]
+        candidates = collection.search(question_embedding, reranker.candidate_budget(), doc_ids, query_texts)[0]
+        return reranker.rerank(question, candidates, top_k)
+    except Exception as e:
+        print(f"Error retrieving from collection: {e}")
+        return []
+
+# --- Web Search Cache and Deduplication ---
+# Tavily results are cached per normalized query in a small in-memory LRU backed
+# by SQLite, so repeated questions skip the network for WEB_CACHE_TTL seconds
+# (also across restarts). Snippets that are near-duplicates of a higher-ranked
+# one (estimated Jaccard similarity of word shingles, via MinHash) are dropped
+# before they reach the prompt. With an embedder, extra results are fetched and
+# ranked against the question in a throwaway FAISS index, then optionally by the
+# cross-encoder, the same way PDF chunks are.
+WEB_CACHE_TTL = 3600
+WEB_FETCH_K = 8
+MINHASH_PERMUTATIONS = 64
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = np.random.default_rng(1)
+_MINHASH_A = _minhash_rng.integers(1, _MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_MINHASH_B = _minhash_rng.integers(0, _MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def shingles(text, k=5):
+    """Returns the set of hashed k-word shingles of text."""
+    words = re.findall(r"\w+", text.lower())
+    grams = {" ".join(words[i:i + k]) for i in range(max(len(words) - k + 1, 1))}
+    return {int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "little") for g in grams}
+
+def minhash_signature(shingle_set):
+    """Returns the MinHash signature (MINHASH_PERMUTATIONS uint64 values) of a shingle set."""
+    if not shingle_set:
+        return np.full(MINHASH_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    x = np.fromiter(shingle_set, dtype=np.uint64, count=len(shingle_set))[:, None]
+    # Universal hashing in uint64; wrap-around is harmless for MinHash.
+    return ((x * _MINHASH_A + _MINHASH_B) % np.uint64(_MINHASH_PRIME)).min(axis=0)
+
+def dedupe_snippets(snippets, threshold=0.7, k=5):
+    """Drops snippets whose estimated Jaccard similarity to an earlier kept one is >= threshold."""
+    kept, signatures = [], []
+    for snippet in snippets:
+        signature = minhash_signature(shingles(snippet, k))
+        if any(np.mean(signature == other) >= threshold for other in signatures):
+            continue
+        kept.append(snippet)
+        signatures.append(signature)
+    return kept
+
+def rank_snippets(question, snippets, embedder, top_k=3, reranker=None):
+    """Orders snippets by similarity to question in a temporary FAISS index, then by the reranker.
+
+    The question goes through embedder (a QueryEmbedder or a sentence model); the
+    snippets are encoded by the underlying model, so they do not take over the
+    query cache.
+    """
+    if not snippets:
+        return []
+    model = embedder.model if isinstance(embedder, QueryEmbedder) else embedder
+    vectors = np.array(model.encode(list(snippets), show_progress_bar=False), dtype='float32')
+    query = np.array(embedder.encode([question]), dtype='float32')
+    faiss.normalize_L2(vectors)
+    faiss.normalize_L2(query)
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(vectors)
+    fetch_k = reranker.candidate_budget() if reranker is not None else top_k
+    _, ids = index.search(query, min(fetch_k, len(snippets)))
+    ranked = [snippets[i] for i in ids[0] if i >= 0]
+    if reranker is not None:
+        return reranker.rerank(question, ranked, top_k)
+    return ranked[:top_k]
+
+class WebSearchCache:
+    """TTL cache of web search results in memory and SQLite."""
+
+    def __init__(self, path=WEB_CACHE_PATH, ttl_seconds=WEB_CACHE_TTL, memory_entries=256):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.memory_entries = memory_entries
+        self.stats = {"hits": 0, "misses": 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, results TEXT NOT NULL,"
+                         " created REAL NOT NULL)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def key(query, **params):
+        return json.dumps([normalize_query(query), sorted(params.items())])
+
+    def get(self, key):
+        """Returns cached results for key, or None when missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT results, created FROM searches WHERE key = ? AND created > ?",
+                                   (key, now - self.ttl_seconds)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Web search cache lookup failed: {e}")
+            row = None
+        with self._lock:
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            results = json.loads(row[0])
+            self._remember(key, row[1], results)
+            return results
+
+    def put(self, key, results):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, results)
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO searches (key, results, created) VALUES (?, ?, ?)",
+                             (key, json.dumps(results), now))
+                conn.execute("DELETE FROM searches WHERE created < ?", (now - self.ttl_seconds,))
+        except sqlite3.Error as e:
+            print(f"Web search cache write failed: {e}")
+
+    def _remember(self, key, created, results):
+        self._memory[key] = (created, results)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+@st.cache_resource
+def get_web_search_cache():
+    """Returns the process-wide web search cache."""
+    return WebSearchCache()
+
+@traced()
+def tavily_web_search(question, top_k=3, embedder=None, reranker=None, cache=None):
+    """Performs a cached web search using Tavily and returns deduplicated snippets.
+
+    With an embedder, WEB_FETCH_K results are fetched and the best top_k kept
+    (see rank_snippets); otherwise the first top_k distinct snippets are returned.
+    """
+    max_results = max(top_k, WEB_FETCH_K) if embedder is not None else top_k
+    try:
+        cache = cache or get_web_search_cache()
+        key = cache.key(question, search_depth="basic", max_results=max_results)
+        snippets = cache.get(key)
+        if snippets is None:
+            client = get_tavily_client()
+            response = client.search(
+                query=question,
+                search_depth="basic",
+                max_results=max_results
+            )
+            snippets = dedupe_snippets([result['content'] for result in response['results']])
+            cache.put(key, snippets)
     except Exception as e:
         print(f"Error during Tavily search: {e}")
         return [f"Error searching web: {e}"]
+    if embedder is None:
+        return snippets[:top_k]
+    try:
+        return rank_snippets(question, snippets, embedder, top_k, reranker)
+    except Exception as e:
+        print(f"Error ranking web results: {e}")
+        return snippets[:top_k]
 
+@traced()
 def decide_tool_to_use(question, client):
-    """Uses a fast LLM to decide which tool to use."""
+    """Uses a fast LLM, through the LLM gateway `client`, to decide which tool to use."""
     prompt = f"""
     You are a routing agent. Your job is to decide whether to answer a user's question using a private PDF document or a public web search.
     If the question is about "the document", "the paper", "this document", or seems to refer to a specific uploaded text, reply with the single word: PDF
@@ -116,14 +2294,13 @@ def decide_tool_to_use(question, client):
     """
     
     try:
-        completion = client.chat.completions.create(
-            model="llama3-8b-8192", 
+        decision = client.complete(
+            model="llama3-8b-8192",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.0,
             top_p=0.1,
             max_tokens=10
-        )
-        decision = completion.choices[0].message.content.strip()
+        ).strip()
         if "PDF" in decision:
             return "PDF"
         else:
@@ -132,13 +2309,353 @@ def decide_tool_to_use(question, client):
         print(f"Error in routing: {e}")
         return "PDF"
 
-def generate_answer_stream(question, context_chunks, chat_history, source_type):
+# --- Local Router ---
+# decide_tool_to_use() costs a full LLM round trip before retrieval can start.
+# LocalRouter combines two cheap signals instead: a nearest-centroid classifier
+# over the question embedding (already computed for retrieval) and the best
+# dense distance in the loaded collection. Only questions whose combined
+# probability falls in the ambiguous band are sent to the LLM router.
+ROUTER_SEED_EXAMPLES = {
+    "PDF": [
+        "What does the document say about this?",
+        "Summarize the paper.",
+        "What is the conclusion of this paper?",
+        "According to the PDF, what are the requirements?",
+        "Which section of the manual covers installation?",
+        "What methodology do the authors use?",
+        "List the key findings in this report.",
+        "What does the uploaded file say about pricing?",
+        "Explain table 2 in the document.",
+        "Who are the authors of this paper?",
+    ],
+    "WEB": [
+        "What is the weather today?",
+        "What is the capital of France?",
+        "Who won the match yesterday?",
+        "What is the latest news about AI?",
+        "What is the current stock price of Apple?",
+        "How tall is Mount Everest?",
+        "When is the next public holiday?",
+        "Who is the president of the United States?",
+        "What are the best restaurants nearby?",
+        "What is the exchange rate of the dollar to the euro?",
+    ],
+}
+
+class LocalRouter:
+    """Routes questions to PDF or WEB from the question embedding and the best retrieval distance."""
+
+    def __init__(self, embedder, examples=None, low=0.3, high=0.7, margin_scale=20.0,
+                 similarity_midpoint=0.35, similarity_scale=10.0):
+        self.embedder = embedder
+        self.low = low
+        self.high = high
+        self.margin_scale = margin_scale
+        self.similarity_midpoint = similarity_midpoint
+        self.similarity_scale = similarity_scale
+        examples = examples or ROUTER_SEED_EXAMPLES
+        self.fit(examples["PDF"] + examples["WEB"], ["PDF"] * len(examples["PDF"]) + ["WEB"] * len(examples["WEB"]))
+
+    @staticmethod
+    def _unit(vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype='float32'))
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def fit(self, questions, labels):
+        """Sets the class centroids from labelled questions (e.g. logged LLM router decisions)."""
+        embeddings = self._unit(self.embedder.encode(list(questions)))
+        labels = np.asarray(labels)
+        self.centroids = self._unit([embeddings[labels == "PDF"].mean(axis=0), embeddings[labels == "WEB"].mean(axis=0)])
+
+    def pdf_probability(self, query_embedding, best_distance=None):
+        """Returns the estimated probability that the question should go to the PDF."""
+        query = self._unit(query_embedding)[0]
+        pdf_similarity, web_similarity = self.centroids @ query
+        logit = self.margin_scale * (pdf_similarity - web_similarity)
+        if best_distance is not None:
+            # MiniLM vectors are unit-length, so squared L2 distance d maps to cosine 1 - d/2.
+            logit += self.similarity_scale * ((1 - best_distance / 2) - self.similarity_midpoint)
+        return float(1 / (1 + np.exp(-logit)))
+
+    def route(self, query_embedding, best_distance=None):
+        """Returns ("PDF" | "WEB" | None, pdf_probability); None means ambiguous."""
+        probability = self.pdf_probability(query_embedding, best_distance)
+        if probability >= self.high:
+            return "PDF", probability
+        if probability <= self.low:
+            return "WEB", probability
+        return None, probability
+
+@st.cache_resource
+def get_local_router():
+    """Returns the process-wide local router."""
+    return LocalRouter(get_query_embedder())
+
+@traced()
+def route_question(question, client, collection=None, embedder=None, router=None, doc_ids=None):
+    """Routes locally when confident, falling back to decide_tool_to_use() otherwise.
+
+    Returns (decision, info) where info records the method used, the local
+    PDF probability and the time spent routing.
+    """
+    start = time.perf_counter()
+    embedder = embedder or get_query_embedder()
+    router = router or get_local_router()
+    try:
+        query_embedding = embedder.encode([question])
+        best_distance = None
+        if collection is not None and len(collection) > 0:
+            hits = collection.search(query_embedding, 1, doc_ids)[0]
+            best_distance = hits[0]["distance"] if hits else None
+        decision, probability = router.route(query_embedding, best_distance)
+    except Exception as e:
+        print(f"Error in local routing: {e}")
+        decision, probability = None, None
+
+    method = "local"
+    if decision is None:
+        method = "llm"
+        decision = decide_tool_to_use(question, client) if client is not None else "PDF"
+    return decision, {"method": method, "pdf_probability": probability, "seconds": time.perf_counter() - start}
+
+def evaluate_router(questions, client, collection=None, embedder=None, router=None, labels=None):
+    """Compares local routing with the LLM router over a list of questions.
+
+    Reports agreement with the LLM router (and with labels, if given), the share
+    of questions the local router decides on its own, and routing latency.
+    """
+    embedder = embedder or get_query_embedder()
+    router = router or get_local_router()
+    rows = []
+    for i, question in enumerate(questions):
+        t0 = time.perf_counter()
+        llm_decision = decide_tool_to_use(question, client)
+        llm_seconds = time.perf_counter() - t0
+        local_decision, info = route_question(question, None, collection, embedder, router)
+        final = local_decision if info["method"] == "local" else llm_decision
+        rows.append({
+            "question": question,
+            "label": labels[i] if labels is not None else None,
+            "llm": llm_decision,
+            "local": local_decision if info["method"] == "local" else None,
+            "final": final,
+            "pdf_probability": info["pdf_probability"],
+            "local_ms": 1000 * info["seconds"],
+            "llm_ms": 1000 * llm_seconds,
+            "routed_ms": 1000 * (info["seconds"] + (llm_seconds if info["method"] == "llm" else 0)),
+        })
+
+    def pct(values, q):
+        return float(np.percentile(values, q)) if values else None
+
+    confident = [r for r in rows if r["local"] is not None]
+    report = {
+        "questions": len(rows),
+        "local_coverage": len(confident) / max(len(rows), 1),
+        "local_agreement_with_llm": sum(r["local"] == r["llm"] for r in confident) / max(len(confident), 1),
+        "final_agreement_with_llm": sum(r["final"] == r["llm"] for r in rows) / max(len(rows), 1),
+        "llm_ms_p50": pct([r["llm_ms"] for r in rows], 50),
+        "llm_ms_p95": pct([r["llm_ms"] for r in rows], 95),
+        "routed_ms_p50": pct([r["routed_ms"] for r in rows], 50),
+        "routed_ms_p95": pct([r["routed_ms"] for r in rows], 95),
+        "rows": rows,
+    }
+    if labels is not None:
+        report["llm_accuracy"] = sum(r["llm"] == r["label"] for r in rows) / max(len(rows), 1)
+        report["final_accuracy"] = sum(r["final"] == r["label"] for r in rows) / max(len(rows), 1)
+    return report
+
+# --- Speculative Retrieval ---
+# Routing, PDF retrieval and web search are independent until the route is known,
+# so they are started together and the losing branch is cancelled or discarded.
+# Time to context becomes the slowest needed stage instead of the sum of all.
+# Each call gets its own small executor with a thread per stage, so stages start
+# immediately instead of queueing behind other sessions' (counting queue time
+# against their timeouts), and a slow losing branch only occupies its own thread.
+
+def source_label(hit):
+    """Returns a short citation label for a collection hit."""
+    if hit["page"] >= 0:
+        return f"{hit['name']}, page {hit['page'] + 1}"
+    return hit["name"]
+
+@traced()
+def retrieve_speculatively(question, client, collection=None, embedder=None, doc_ids=None, local_routing=True,
+                           top_k=3, router_timeout=5.0, pdf_timeout=5.0, web_timeout=10.0, reranker=None,
+                           rank_web=True):
+    """Runs routing, PDF retrieval and web search concurrently and keeps the routed result.
+
+    Each stage has its own timeout, counted from the common start. If the routed
+    retriever fails, times out or returns only errors, the other branch's result is
+    used when available.
+    With rank_web, web snippets are ranked like PDF chunks (see tavily_web_search).
+    Returns a dict with route, chunks, labels, source_type, fallback and per-stage timings.
+    """
+    embedder = embedder or get_query_embedder()
+    timings = {}
+    pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="carag-retrieval")
+
+    def submit(stage, fn, *args):
+        def run():
+            t0 = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                timings[stage] = time.perf_counter() - t0
+        # Copy the context so the stage's spans nest under this call's span.
+        return pool.submit(contextvars.copy_context().run, run)
+
+    def wait(future, deadline):
+        try:
+            return future.result(timeout=max(deadline - time.perf_counter(), 0))
+        except Exception as e:
+            print(f"Speculative stage failed or timed out: {e!r}")
+            return None
+
+    def usable(branch, result):
+        # Web search reports failures as "Error searching web: ..." snippets.
+        return bool(result) and not (branch == "WEB" and retrieval_failed(result))
+
+    start = time.perf_counter()
+    has_pdf = collection is not None and len(collection) > 0
+    futures = {"WEB": submit("web", tavily_web_search, question, top_k,
+                             embedder if rank_web else None, reranker if rank_web else None)}
+    deadlines = {"WEB": start + web_timeout, "PDF": start + pdf_timeout}
+    route = "WEB"
+    if has_pdf:
+        futures["PDF"] = submit("pdf", retrieve_from_collection, question, collection, embedder, top_k, doc_ids,
+                                True, reranker)
+        if local_routing:
+            router = submit("route", lambda: route_question(question, client, collection, embedder, doc_ids=doc_ids)[0])
+        else:
+            router = submit("route", decide_tool_to_use, question, client)
+        # decide_tool_to_use() also defaults to the PDF when routing fails.
+        route = wait(router, start + router_timeout) or "PDF"
+
+    fallback = False
+    result = wait(futures[route], deadlines[route])
+    other = "WEB" if route == "PDF" else "PDF"
+    if not usable(route, result) and other in futures:
+        other_result = wait(futures[other], deadlines[other])
+        if usable(other, other_result):
+            route, result, fallback = other, other_result, True
+    # Losing branches still running are dropped; their threads exit when they finish.
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    result = result or []
+    if route == "PDF":
+        chunks = [hit["text"] for hit in result]
+        labels = [source_label(hit) for hit in result]
+        source_type = "private PDF document"
+    else:
+        chunks = list(result)
+        labels = ["web" for _ in chunks]
+        source_type = "web search"
+    timings["total"] = time.perf_counter() - start
+    return {"route": route, "chunks": chunks, "labels": labels, "source_type": source_type,
+            "fallback": fallback, "timings": dict(timings)}
+
+# --- Context Budgeting ---
+# Retrieved chunks and the chat history are packed into fixed token budgets
+# before each generation call, so per-turn prompt size (and latency) stays
+# constant over long conversations. Token counts are estimated at ~4 characters
+# per Llama 3 token, which is close enough for budgeting without a tokenizer.
+CONTEXT_TOKEN_BUDGET = 2000
+HISTORY_TOKEN_BUDGET = 1000
+RECENT_TURNS = 4
+SUMMARY_CHARS_PER_TURN = 160
+
+def count_tokens(text):
+    """Estimates the number of LLM tokens in text."""
+    return math.ceil(len(text) / 4)
+
+def _suffix_prefix_overlap(a, b, min_overlap):
+    """Returns the length of the longest suffix of a that is a prefix of b (0 if < min_overlap)."""
+    if min(len(a), len(b)) < min_overlap:
+        return 0
+    anchor = b[:min_overlap]
+    i = a.find(anchor)
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(anchor, i + 1)
+    return 0
+
+def dedupe_chunks(chunks, min_overlap=40):
+    """Drops contained chunks and merges chunks that overlap verbatim, keeping rank order."""
+    merged = []
+    for chunk in chunks:
+        for i, kept in enumerate(merged):
+            if chunk in kept:
+                break
+            if kept in chunk:
+                merged[i] = chunk
+                break
+            k = _suffix_prefix_overlap(kept, chunk, min_overlap)
+            if k:
+                merged[i] = kept + chunk[k:]
+                break
+            k = _suffix_prefix_overlap(chunk, kept, min_overlap)
+            if k:
+                merged[i] = chunk + kept[k:]
+                break
+        else:
+            merged.append(chunk)
+    return merged
+
+def pack_chunks(chunks, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """Keeps the highest-ranked chunks (in order) that fit within max_tokens."""
+    packed, used = [], 0
+    for chunk in chunks:
+        cost = count_tokens(chunk)
+        if used + cost <= max_tokens:
+            packed.append(chunk)
+            used += cost
+    return packed
+
+def trim_history(chat_history, max_tokens=HISTORY_TOKEN_BUDGET, recent_turns=RECENT_TURNS):
+    """Keeps the most recent messages verbatim and condenses older ones into a single note.
+
+    Older messages are truncated to SUMMARY_CHARS_PER_TURN characters each and
+    dropped oldest-first until everything fits in max_tokens.
+    """
+    recent = list(chat_history[-2 * recent_turns:]) if recent_turns else []
+    older = list(chat_history[:len(chat_history) - len(recent)])
+    while recent and sum(count_tokens(m["content"]) for m in recent) > max_tokens:
+        older.append(recent.pop(0))
+    budget = max_tokens - sum(count_tokens(m["content"]) for m in recent)
+
+    lines = []
+    for message in reversed(older):
+        content = " ".join(message["content"].split())
+        if len(content) > SUMMARY_CHARS_PER_TURN:
+            content = content[:SUMMARY_CHARS_PER_TURN] + "..."
+        line = f"{message['role']}: {content}"
+        if count_tokens(line) + sum(count_tokens(l) for l in lines) + 10 > budget:
+            break
+        lines.insert(0, line)
+    if not lines:
+        return recent
+    summary = {"role": "system", "content": "Summary of earlier conversation:\n" + "\n".join(lines)}
+    return [summary] + recent
+
+def pack_context(context_chunks, chat_history, max_context_tokens=CONTEXT_TOKEN_BUDGET,
+                 max_history_tokens=HISTORY_TOKEN_BUDGET):
+    """Deduplicates and packs retrieved chunks and trims the history to their token budgets."""
+    history = [{"role": m["role"], "content": m["content"]} for m in chat_history]
+    return pack_chunks(dedupe_chunks(context_chunks), max_context_tokens), trim_history(history, max_history_tokens)
+
+@traced()
+def generate_answer_stream(question, context_chunks, chat_history, source_type,
+                           max_context_tokens=CONTEXT_TOKEN_BUDGET, max_history_tokens=HISTORY_TOKEN_BUDGET,
+                           client=None):
     """Generates an answer stream using Groq based on context."""
-    client = get_groq_client()
+    client = client or get_llm_gateway()
     if client is None:
         yield "Error: Groq client not initialized."
         return
 
+    context_chunks, chat_history = pack_context(context_chunks, chat_history, max_context_tokens, max_history_tokens)
     context = "\n\n---\n\n".join(context_chunks)
     system_prompt = {
         "role": "system",
@@ -151,88 +2668,816 @@ def generate_answer_stream(question, context_chunks, chat_history, source_type):
     messages_for_api = [system_prompt] + chat_history + [user_prompt]
     
     try:
-        completion = client.chat.completions.create(
+        yield from client.stream(
             model="llama-3.3-70b-versatile",
             messages=messages_for_api,
             temperature=0.2,
             top_p=0.1,
-            max_tokens=1000,
-            stream=True
+            max_tokens=1000
         )
-        
-        for chunk in completion:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
-                
+
     except Exception as e:
         yield f"\n\nError calling Groq API: {e}"
 
 
-# --- NEW: Firebase Firestore Functions ---
+# --- Semantic Answer Cache ---
+# Answers are cached per scope and looked up by cosine similarity of the query
+# embedding, so paraphrased FAQ-style questions skip routing, retrieval and
+# generation entirely. A scope is the user, the set of documents a question was
+# asked against (none for web questions) and the conversation before it, so
+# answers are never shared between users and a follow-up such as "what about
+# the second one?" only matches an answer given after the same conversation.
+# Answers built from failed or empty retrievals are not cached. Entries live in
+# a local SQLite file shared by all processes and expire by TTL, with
+# least-recently-used eviction beyond a cap.
+ANSWER_ERROR_MARKERS = ("Error: Groq client not initialized.", "Error calling Groq API")
+RETRIEVAL_ERROR_PREFIXES = ("Error searching web:",)
+
+def retrieval_failed(chunks):
+    """Returns True if retrieval produced no usable context (nothing, or only error messages)."""
+    return not chunks or all(chunk.startswith(RETRIEVAL_ERROR_PREFIXES) for chunk in chunks)
+
+def answer_cache_scope(doc_ids, user=None, chat_history=()):
+    """Returns the cache scope for a question asked by user against doc_ids after chat_history."""
+    payload = {"user": user, "documents": sorted(doc_ids or []),
+               "history": [[m["role"], m["content"]] for m in chat_history]}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+class SemanticAnswerCache:
+    """Disk-backed answer cache keyed by scope and query embedding."""
+
+    def __init__(self, path=ANSWER_CACHE_PATH, threshold=0.92, ttl_seconds=24 * 3600, max_entries=5000):
+        self.path = path
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " id INTEGER PRIMARY KEY, scope TEXT NOT NULL, question TEXT NOT NULL,"
+                " embedding BLOB NOT NULL, answer TEXT NOT NULL, source_type TEXT, sources TEXT,"
+                " created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_scope ON answers (scope, created)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype='float32').ravel()
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    @traced("answer_cache_lookup")
+    def lookup(self, scope, query_embedding):
+        """Returns the best cached entry above the similarity threshold, or None."""
+        query = self._normalize(query_embedding)
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT id, embedding FROM answers WHERE scope = ? AND created > ?",
+                    (scope, now - self.ttl_seconds),
+                ).fetchall()
+                if not rows:
+                    return None
+                matrix = np.frombuffer(b"".join(r[1] for r in rows), dtype='float32').reshape(len(rows), -1)
+                if matrix.shape[1] != len(query):
+                    return None
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] < self.threshold:
+                    return None
+                entry_id = rows[best][0]
+                conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (now, entry_id))
+                question, answer, source_type, sources = conn.execute(
+                    "SELECT question, answer, source_type, sources FROM answers WHERE id = ?", (entry_id,)
+                ).fetchone()
+            return {
+                "question": question,
+                "answer": answer,
+                "source_type": source_type,
+                "sources": json.loads(sources or "[]"),
+                "similarity": float(similarities[best]),
+            }
+        except Exception as e:
+            print(f"Error reading answer cache: {e}")
+            return None
+
+    def put(self, scope, question, query_embedding, answer, source_type=None, sources=None):
+        """Stores an answer and evicts expired and least-recently-used entries."""
+        if not answer or any(marker in answer for marker in ANSWER_ERROR_MARKERS):
+            return False
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT INTO answers (scope, question, embedding, answer, source_type, sources, created, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (scope, question, self._normalize(query_embedding).tobytes(), answer,
+                     source_type, json.dumps(sources or []), now, now),
+                )
+                conn.execute("DELETE FROM answers WHERE created <= ?", (now - self.ttl_seconds,))
+                conn.execute(
+                    "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            return True
+        except Exception as e:
+            print(f"Error writing answer cache: {e}")
+            return False
+
+def replay_answer_stream(answer, piece_size=24):
+    """Yields a cached answer in small pieces, like generate_answer_stream()."""
+    for i in range(0, len(answer), piece_size):
+        yield answer[i:i + piece_size]
+
+def cache_answer_stream(stream, cache, scope, question, query_embedding, source_type=None, sources=None):
+    """Passes an answer stream through unchanged and caches the full answer once it completes.
+
+    Nothing is cached when sources ((text, label) pairs) show that retrieval failed.
+    """
+    pieces = []
+    for piece in stream:
+        pieces.append(piece)
+        yield piece
+    if not retrieval_failed([text for text, _ in sources or []]):
+        cache.put(scope, question, query_embedding, "".join(pieces), source_type, sources)
 
 @st.cache_resource
-@st.cache_resource
-@st.cache_resource
-def get_firestore_client():
-    """Initializes and returns a Firestore client using a JSON key file."""
+def get_answer_cache():
+    """Returns the process-wide semantic answer cache."""
+    return SemanticAnswerCache()
+
+
+# --- Headless Pipeline ---
+# RAGPipeline runs the same turn as pages/2_CRAG_App.py (answer cache -> route
+# and retrieve -> generate) without Streamlit, for bulk evaluation and for other
+# clients. run_batch() answers a JSONL file of questions with bounded
+# concurrency and appends each result to the output as soon as it is done;
+# serve() exposes the pipeline over a small asyncio HTTP server. Concurrent
+# questions share query-embedding batches through the QueryEmbedder.
+class RAGPipeline:
+    """UI-independent question answering over an optional document collection."""
+
+    def __init__(self, collection=None, client=None, embedder=None, reranker=None, answer_cache=None,
+                 local_routing=True, top_k=3, max_context_tokens=CONTEXT_TOKEN_BUDGET,
+                 max_history_tokens=HISTORY_TOKEN_BUDGET):
+        self.collection = collection
+        self.client = client or get_llm_gateway()
+        self.embedder = embedder or get_query_embedder()
+        self.reranker = reranker
+        self.answer_cache = answer_cache
+        self.local_routing = local_routing
+        self.top_k = top_k
+        self.max_context_tokens = max_context_tokens
+        self.max_history_tokens = max_history_tokens
+
+    @classmethod
+    def from_pdfs(cls, paths, model=None, strategy="fixed", storage="float32", **kwargs):
+        """Builds a pipeline over the PDFs at paths (using the index cache)."""
+        model = model or get_sentence_transformer()
+        documents = []
+        for path in paths:
+            with open(path, "rb") as f:
+                documents.append((os.path.basename(path), f.read()))
+        collection = build_collection(documents, model, strategy=strategy, storage=storage) if documents else None
+        return cls(collection, **kwargs)
+
+    def _scope(self, doc_ids, user, chat_history):
+        if self.collection is not None and len(self.collection) > 0:
+            return answer_cache_scope(doc_ids or list(self.collection.documents), user, chat_history)
+        return answer_cache_scope(None, user, chat_history)
+
+    def stream(self, question, chat_history=(), doc_ids=None, user=None):
+        """Yields ("meta", info) once, then ("text", delta) pieces of the answer.
+
+        Cached answers are only shared between calls with the same user and chat_history.
+        """
+        query_embedding = self.embedder.encode([question])[0]
+        scope = self._scope(doc_ids, user, chat_history)
+        cached = self.answer_cache.lookup(scope, query_embedding) if self.answer_cache is not None else None
+        if cached:
+            yield "meta", {"route": "CACHE", "source_type": cached["source_type"], "fallback": False,
+                           "sources": cached["sources"], "timings": {}, "cached": True}
+            yield from (("text", piece) for piece in replay_answer_stream(cached["answer"]))
+            return
+
+        retrieval = retrieve_speculatively(question, self.client, self.collection, self.embedder, doc_ids,
+                                           self.local_routing, self.top_k, reranker=self.reranker)
+        sources = list(zip(retrieval["chunks"], retrieval["labels"]))
+        yield "meta", {"route": retrieval["route"], "source_type": retrieval["source_type"],
+                       "fallback": retrieval["fallback"], "sources": sources, "timings": retrieval["timings"],
+                       "cached": False}
+        stream = generate_answer_stream(question, retrieval["chunks"], list(chat_history), retrieval["source_type"],
+                                        self.max_context_tokens, self.max_history_tokens, client=self.client)
+        if self.answer_cache is not None:
+            stream = cache_answer_stream(stream, self.answer_cache, scope, question, query_embedding,
+                                         retrieval["source_type"], sources)
+        yield from (("text", piece) for piece in stream)
+
+    def answer(self, question, chat_history=(), doc_ids=None, user=None):
+        """Answers one question. Returns a dict with the answer, route, sources and timings."""
+        start = time.perf_counter()
+        result, pieces, first_token = {"question": question}, [], None
+        with span("pipeline_answer"):
+            for kind, value in self.stream(question, chat_history, doc_ids, user):
+                if kind == "meta":
+                    result.update(value)
+                else:
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    pieces.append(value)
+        result["answer"] = "".join(pieces)
+        result["timings"] = dict(result.get("timings", {}), first_token=first_token,
+                                 total=time.perf_counter() - start)
+        return result
+
+    async def aanswer(self, question, chat_history=(), doc_ids=None, user=None):
+        """Answers one question on a worker thread."""
+        return await asyncio.to_thread(self.answer, question, chat_history, doc_ids, user)
+
+def batch_question(record):
+    """Returns (id, question) for a batch input record.
+
+    Accepts {"id", "question"} records, and the request log format
+    {"request_id", "title", "body"} where the title and body form the question.
+    """
+    question = record.get("question")
+    if question is None:
+        question = "\n\n".join(part for part in (record.get("title"), record.get("body")) if part)
+    return record.get("id", record.get("request_id")), question
+
+def run_batch(pipeline, input_path, output_path, concurrency=8, resume=True):
+    """Answers every question of a JSONL file, appending one JSON result per line to output_path.
+
+    At most `concurrency` questions are in flight. With resume, ids already in
+    the output are skipped, so an interrupted run can be restarted.
+    Returns a summary with throughput and latency percentiles.
+    """
+    done = set()
+    if resume and os.path.exists(output_path):
+        with open(output_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line).get("id"))
+                except json.JSONDecodeError:
+                    continue
+    if os.path.exists(output_path):
+        with open(output_path, "rb+") as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # An interrupted run left a torn last line; keep the next result off it.
+                    f.write(b"\n")
+
+    def questions():
+        with open(input_path, encoding="utf-8") as f:
+            for number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                record_id, question = batch_question(json.loads(line))
+                record_id = number if record_id is None else record_id
+                if record_id not in done and question:
+                    yield record_id, question
+
+    def answer(record_id, question):
+        try:
+            return dict(pipeline.answer(question), id=record_id)
+        except Exception as e:
+            return {"id": record_id, "question": question, "error": repr(e)}
+
+    start = time.perf_counter()
+    latencies, errors = [], 0
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(concurrency) as pool:
+        pending = set()
+        for record_id, question in questions():
+            pending.add(pool.submit(answer, record_id, question))
+            if len(pending) < concurrency:
+                continue
+            finished, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                errors += _write_batch_result(out, future.result(), latencies)
+        for future in as_completed(pending):
+            errors += _write_batch_result(out, future.result(), latencies)
+
+    seconds = time.perf_counter() - start
+    values = np.asarray(latencies) * 1000
+    return {
+        "answered": len(latencies),
+        "errors": errors,
+        "skipped": len(done),
+        "seconds": seconds,
+        "questions_per_second": len(latencies) / seconds if seconds else 0.0,
+        "latency_ms_p50": float(np.percentile(values, 50)) if len(values) else None,
+        "latency_ms_p95": float(np.percentile(values, 95)) if len(values) else None,
+    }
+
+def _write_batch_result(out, result, latencies):
+    out.write(json.dumps(result, default=str) + "\n")
+    out.flush()
+    if "error" in result:
+        return 1
+    latencies.append(result["timings"]["total"])
+    return 0
+
+async def _handle_http(reader, writer, pipeline, semaphore):
+    """Serves one HTTP/1.1 request: GET /health, GET /metrics, POST /answer."""
+    def respond(status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else body.encode("utf-8")
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + data)
+
     try:
-        # --- THIS IS THE FIX ---
-        # Define the path to your key file
-        key_file_path = ".streamlit/firestore-key.json"
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) < 2:
+            return
+        method, path = request_line[0], request_line[1].split("?")[0]
 
-        # Check if the file exists
-        if not os.path.exists(key_file_path):
-            st.error(f"Firestore key file not found at: {key_file_path}")
-            st.error("Please make sure your JSON key file is in the .streamlit folder.")
-            return None
+        if method == "GET" and path == "/health":
+            respond("200 OK", json.dumps({"status": "ok", "warm_up": warm_up_status()}))
+        elif method == "GET" and path == "/metrics":
+            respond("200 OK", tracer.prometheus_text(), "text/plain; version=0.0.4")
+        elif method == "POST" and path == "/answer":
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            try:
+                request = json.loads(body or b"{}")
+                question = request["question"]
+            except (ValueError, KeyError):
+                respond("400 Bad Request", json.dumps({"error": 'expected a JSON body with "question"'}))
+                return
+            history, doc_ids, user = request.get("history", []), request.get("doc_ids"), request.get("user")
+            async with semaphore:
+                if not request.get("stream"):
+                    result = await pipeline.aanswer(question, history, doc_ids, user)
+                    respond("200 OK", json.dumps(result, default=str))
+                    return
+                # Streamed as newline-delimited JSON events over chunked transfer encoding.
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                             b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+                loop = asyncio.get_running_loop()
+                events = asyncio.Queue()
 
-        # Load credentials directly from the file
-        creds = service_account.Credentials.from_service_account_file(key_file_path)
-        db = firestore.Client(credentials=creds, project=creds.project_id)
-        return db
+                def produce():
+                    try:
+                        for kind, value in pipeline.stream(question, history, doc_ids, user):
+                            loop.call_soon_threadsafe(events.put_nowait, {kind: value})
+                    except Exception as e:
+                        loop.call_soon_threadsafe(events.put_nowait, {"error": repr(e)})
+                    finally:
+                        loop.call_soon_threadsafe(events.put_nowait, None)
 
+                producer = loop.run_in_executor(None, produce)
+                while (event := await events.get()) is not None:
+                    data = (json.dumps(event, default=str) + "\n").encode("utf-8")
+                    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    await writer.drain()
+                writer.write(b"0\r\n\r\n")
+                await producer
+        else:
+            respond("404 Not Found", json.dumps({"error": "not found"}))
+    except Exception as e:
+        print(f"Error handling HTTP request: {e}")
+    finally:
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+async def serve(pipeline, host="127.0.0.1", port=8765, concurrency=8):
+    """Serves the pipeline over HTTP until cancelled, answering at most `concurrency` questions at once."""
+    semaphore = asyncio.Semaphore(concurrency)
+    server = await asyncio.start_server(lambda r, w: _handle_http(r, w, pipeline, semaphore), host, port)
+    print(f"Serving on http://{host}:{port} (POST /answer, GET /health, GET /metrics)")
+    async with server:
+        await server.serve_forever()
+
+
+# --- NEW: Firebase Firestore Functions ---
+
+# Define the path to your key file
+FIRESTORE_KEY_FILE = ".streamlit/firestore-key.json"
+
+@st.cache_resource
+def _connect_firestore():
+    """Creates the Firestore client. Raises on failure, which st.cache_resource does not cache."""
+    # The client library talks to the emulator when FIRESTORE_EMULATOR_HOST is set.
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        return firestore.Client(project=os.environ.get("FIREBASE_PROJECT_ID", "carag-emulator"))
+
+    # Load credentials directly from the file
+    creds = service_account.Credentials.from_service_account_file(FIRESTORE_KEY_FILE)
+    return firestore.Client(credentials=creds, project=creds.project_id)
+
+def get_firestore_client():
+    """Returns the cached Firestore client, or None after reporting why it could not be created.
+
+    Failures are not cached: the next call (e.g. the history writer's retry) tries again.
+    """
+    # Check if the file exists
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST") and not os.path.exists(FIRESTORE_KEY_FILE):
+        st.error(f"Firestore key file not found at: {FIRESTORE_KEY_FILE}")
+        st.error("Please make sure your JSON key file is in the .streamlit folder.")
+        return None
+    try:
+        return _connect_firestore()
     except Exception as e:
         st.error(f"Failed to connect to Firestore using key file: {e}")
         return None
 
+# --- Write-Behind History Writer ---
+# Chat turns are appended to a local journal (the spill file) and queued for a
+# worker thread, which commits them to Firestore in batched writes with
+# exponential backoff. The chat turn returns as soon as the record is journaled.
+# Committed records are compacted out of the journal; anything still in it on
+# startup (e.g. after a crash or while Firestore was unreachable) is replayed.
+# Document ids are generated client-side, so a retried batch never duplicates.
+# App processes may share one journal, so appends and compactions also hold an
+# exclusive lock on a side file (fcntl; not available on Windows).
+class FirestoreHistoryWriter:
+    """Background, batched, durable writer for chat history records."""
+
+    def __init__(self, client_factory, spill_path=HISTORY_SPILL_PATH, collection="chat_history",
+                 max_queue=1000, batch_size=100, flush_interval=0.5, base_backoff=0.5, max_backoff=30.0):
+        self.client_factory = client_factory
+        self.spill_path = spill_path
+        self.collection = collection
+        self.batch_size = min(batch_size, 500)  # Firestore's per-batch write limit
+        self.flush_interval = flush_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.stats = {"submitted": 0, "committed": 0, "batches": 0, "retries": 0}
+        self._queue = queue.Queue(max_queue)
+        self._queued_ids = set()
+        self._committed_ids = set()
+        self._overflow = True  # replay whatever an earlier process left in the journal
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        os.makedirs(os.path.dirname(spill_path) or ".", exist_ok=True)
+        self._worker = threading.Thread(target=self._run, name="firestore-history-writer", daemon=True)
+        self._worker.start()
+
+    def submit(self, username, question, answer):
+        """Journals a Q&A record and queues it for writing. Returns its document id."""
+        record = {"id": uuid.uuid4().hex, "username": username, "question": question,
+                  "answer": answer, "timestamp": time.time()}
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._journal_lock():
+            with open(self.spill_path, "ab+") as f:
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        # A crash tore the last line; start a new one so this record stays readable.
+                        line = b"\n" + line
+                f.write(line)
+            self.stats["submitted"] += 1
+            try:
+                self._queue.put_nowait(record)
+                self._queued_ids.add(record["id"])
+            except queue.Full:
+                # The record is safe in the journal; the worker picks it up later.
+                self._overflow = True
+        return record["id"]
+
+    def pending(self):
+        """Returns the number of journaled records not yet committed."""
+        with self._journal_lock():
+            return len(self._read_journal())
+
+    def flush(self, timeout=10.0):
+        """Waits until every submitted record is committed. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._queued_ids and not self._overflow:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def close(self, timeout=10.0):
+        """Flushes and stops the worker; uncommitted records stay in the journal."""
+        self.flush(timeout)
+        self._stop.set()
+        self._worker.join(timeout)
+
+    @contextlib.contextmanager
+    def _journal_lock(self):
+        """Holds the lock, and an exclusive lock against other processes sharing the journal."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.spill_path + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_journal(self):
+        """Returns journaled records that are not committed yet. Needs the journal lock."""
+        if not os.path.exists(self.spill_path):
+            return []
+        records = []
+        with open(self.spill_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a torn final line from a crash mid-write
+                if record["id"] not in self._committed_ids:
+                    records.append(record)
+        return records
+
+    def _compact(self):
+        """Rewrites the journal without committed records. Needs the journal lock."""
+        remaining = self._read_journal()
+        tmp_path = self.spill_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(r) + "\n" for r in remaining)
+        os.replace(tmp_path, self.spill_path)
+        self._committed_ids.clear()
+
+    def _refill(self):
+        """Queues journaled records that are not queued yet. Needs the journal lock."""
+        self._overflow = False
+        for record in self._read_journal():
+            if record["id"] in self._queued_ids:
+                continue
+            try:
+                self._queue.put_nowait(record)
+                self._queued_ids.add(record["id"])
+            except queue.Full:
+                self._overflow = True
+                break
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    @traced("firestore_commit")
+    def _commit(self, records):
+        db = self.client_factory()
+        if db is None:
+            raise RuntimeError("Firestore client not available")
+        batch = db.batch()
+        collection = db.collection(self.collection)
+        for record in records:
+            batch.set(collection.document(record["id"]), {
+                "username": record["username"],
+                "question": record["question"],
+                "answer": record["answer"],
+                # Ordering and sync read the commit time: a batch that is retried or
+                # replayed commits after records submitted later than it.
+                "timestamp": firestore.SERVER_TIMESTAMP,
+                "submitted_at": datetime.fromtimestamp(record["timestamp"], timezone.utc),
+            })
+        batch.commit()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                refill = self._overflow and self._queue.empty()
+            if refill:
+                with self._journal_lock():
+                    self._refill()
+            records = self._next_batch()
+            if not records:
+                continue
+            attempt = 0
+            while not self._stop.is_set():
+                try:
+                    self._commit(records)
+                    break
+                except Exception as e:
+                    delay = min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    print(f"Error writing history batch to Firestore (retrying in {delay:.1f}s): {e}")
+                    self.stats["retries"] += 1
+                    attempt += 1
+                    self._stop.wait(delay)
+            else:
+                return
+            with self._journal_lock():
+                ids = {r["id"] for r in records}
+                self._committed_ids |= ids
+                self._queued_ids -= ids
+                self.stats["committed"] += len(records)
+                self.stats["batches"] += 1
+                try:
+                    self._compact()
+                except OSError as e:
+                    print(f"Error compacting history journal: {e}")
+
+@st.cache_resource
+def get_history_writer():
+    """Returns the process-wide background history writer."""
+    return FirestoreHistoryWriter(get_firestore_client)
+
+@traced()
 def write_history_to_firestore(username, question, answer):
-    """Writes a new Q&A pair to the user's history in Firestore."""
+    """Queues a new Q&A pair for a background batched write to Firestore."""
     try:
-        db = get_firestore_client()
-        if db:
-            doc_data = {
-                "username": username,
-                "question": question,
-                "answer": answer,
-                "timestamp": firestore.SERVER_TIMESTAMP  # Automatically set server time
-            }
-            # Add a new document with a random ID to the 'chat_history' collection
-            db.collection("chat_history").add(doc_data)
-            return True
+        doc_id = get_history_writer().submit(username, question, answer)
+        # Mirror the record locally so the History page shows it before the batch lands.
+        get_history_store().add(username, doc_id, question, answer, time.time())
+        return True
     except Exception as e:
         st.error(f"Error writing to Firestore: {e}")
         return False
 
-@st.cache_data(ttl=300) # Cache for 5 minutes
-def load_history_from_firestore(username):
-    """Loads a user's entire chat history from Firestore."""
-    try:
-        db = get_firestore_client()
-        if db:
-            # Query the collection for docs matching the username, order by timestamp
-            docs = db.collection("chat_history") \
-                     .where("username", "==", username) \
-                     .order_by("timestamp", direction=firestore.Query.ASCENDING) \
-                     .stream()
-            
-            history_list = []
+# --- Local History Cache ---
+# A per-user SQLite mirror of the chat_history collection. sync() only fetches
+# documents from shortly before the newest cached timestamp on, starting at that
+# point and paging through Firestore with start_after cursors, so a heavy user's
+# history is downloaded once. The overlap re-reads documents that committed with
+# a timestamp behind rows already synced (e.g. records written before timestamps
+# were server-assigned). Rows are keyed by Firestore document id, which makes
+# re-fetches idempotent.
+class HistoryStore:
+    """Incrementally synced local cache of users' chat history."""
+
+    def __init__(self, client_factory, path=HISTORY_CACHE_PATH, collection="chat_history", page_size=500,
+                 overlap_seconds=300):
+        self.client_factory = client_factory
+        self.path = path
+        self.collection = collection
+        self.page_size = page_size
+        self.overlap_seconds = overlap_seconds
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                " id TEXT PRIMARY KEY, username TEXT NOT NULL, question TEXT, answer TEXT,"
+                " timestamp REAL NOT NULL, synced INTEGER NOT NULL DEFAULT 1)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS history_user ON history (username, timestamp)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, username, doc_id, question, answer, timestamp):
+        """Records a locally written entry; the next sync() replaces it with the stored copy."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO history (id, username, question, answer, timestamp, synced)"
+                " VALUES (?, ?, ?, ?, ?, 0)",
+                (doc_id, username, question, answer, timestamp),
+            )
+
+    @traced("firestore_sync")
+    def sync(self, username):
+        """Fetches documents committed since the last sync. Returns the number of new documents."""
+        db = self.client_factory()
+        if db is None:
+            return 0
+        with self._connect() as conn:
+            (last_seen,) = conn.execute(
+                "SELECT MAX(timestamp) FROM history WHERE username = ? AND synced = 1", (username,)
+            ).fetchone()
+        query = db.collection(self.collection) \
+                  .where("username", "==", username) \
+                  .order_by("timestamp", direction=firestore.Query.ASCENDING) \
+                  .limit(self.page_size)
+        if last_seen is not None:
+            since = datetime.fromtimestamp(last_seen - self.overlap_seconds, timezone.utc)
+            page_query = query.start_at({"timestamp": since})
+        else:
+            page_query = query
+        fetched = 0
+        while True:
+            docs = list(page_query.stream())
+            rows = []
             for doc in docs:
                 data = doc.to_dict()
-                history_list.append({
-                    "Question": data.get("question"),
-                    "Answer": data.get("answer")
-                })
-            return history_list
-    except Exception as e:
-        st.error(f"Error loading history from Firestore: {e}")
-        return []
\ No newline at end of file
+                timestamp = data.get("timestamp")
+                timestamp = timestamp.timestamp() if hasattr(timestamp, "timestamp") else time.time()
+                rows.append((doc.id, username, data.get("question"), data.get("answer"), timestamp))
+            with self._connect() as conn:
+                known = {doc_id for (doc_id,) in conn.execute(
+                    f"SELECT id FROM history WHERE synced = 1 AND id IN ({','.join('?' * len(rows))})",
+                    [row[0] for row in rows])} if rows else set()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO history (id, username, question, answer, timestamp, synced)"
+                    " VALUES (?, ?, ?, ?, ?, 1)",
+                    rows,
+                )
+            fetched += len(rows) - len(known)
+            if len(docs) < self.page_size:
+                return fetched
+            page_query = query.start_after(docs[-1])
+
+    def count(self, username):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM history WHERE username = ?", (username,)).fetchone()[0]
+
+    def page(self, username, page_number, page_size=50, newest_first=True):
+        """Returns one page of history rows as dicts with Question, Answer and Time."""
+        order = "DESC" if newest_first else "ASC"
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT question, answer, timestamp FROM history WHERE username = ?"
+                f" ORDER BY timestamp {order}, id {order} LIMIT ? OFFSET ?",
+                (username, page_size, page_number * page_size),
+            ).fetchall()
+        return [{"Question": q, "Answer": a, "Time": datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M")}
+                for q, a, t in rows]
+
+    def iter_rows(self, username, chunk_size=500):
+        """Yields (question, answer) lists oldest-first, chunk_size rows at a time."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "SELECT question, answer FROM history WHERE username = ? ORDER BY timestamp, id", (username,)
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield rows
+
+    def export_csv(self, username, chunk_size=500):
+        """Writes the user's history to a temporary CSV file chunk by chunk and returns it opened for reading."""
+        out = tempfile.TemporaryFile(mode="w+b")
+        text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(["Question", "Answer"])
+        for rows in self.iter_rows(username, chunk_size):
+            writer.writerows(rows)
+        text.flush()
+        text.detach()
+        out.seek(0)
+        return out
+
+@st.cache_resource
+def get_history_store():
+    """Returns the process-wide local history cache."""
+    return HistoryStore(get_firestore_client)
+
+# --- Command Line ---
+def main(argv=None):
+    """python rag_backend.py batch|serve ... (see --help)."""
+    parser = argparse.ArgumentParser(description="Headless CARAG question answering.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    batch = commands.add_parser("batch", help="answer a JSONL file of questions")
+    batch.add_argument("input", help='JSONL with {"id", "question"} or {"request_id", "title", "body"} records')
+    batch.add_argument("output", help="JSONL file results are appended to")
+    batch.add_argument("--no-resume", action="store_true", help="do not skip ids already in the output")
+    server = commands.add_parser("serve", help="serve POST /answer over HTTP")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, default=8765)
+    for command in (batch, server):
+        command.add_argument("--pdf", nargs="*", default=[], help="PDFs to answer from (web only if none)")
+        command.add_argument("--concurrency", type=int, default=8)
+        command.add_argument("--top-k", type=int, default=3)
+        command.add_argument("--strategy", default="token", choices=CHUNK_STRATEGIES)
+        command.add_argument("--rerank", action="store_true", help="rerank PDF results with the cross-encoder")
+        command.add_argument("--llm-routing", action="store_true", help="always route with the LLM")
+        command.add_argument("--answer-cache", action="store_true", help="use the semantic answer cache")
+    args = parser.parse_args(argv)
+
+    pipeline = RAGPipeline.from_pdfs(
+        args.pdf, strategy=args.strategy, top_k=args.top_k, local_routing=not args.llm_routing,
+        reranker=get_reranker() if args.rerank else None,
+        answer_cache=get_answer_cache() if args.answer_cache else None,
+    )
+    if args.command == "batch":
+        summary = run_batch(pipeline, args.input, args.output, args.concurrency, resume=not args.no_resume)
+        print(json.dumps(summary, indent=2))
+    else:
+        start_warm_up()
+        try:
+            asyncio.run(serve(pipeline, args.host, args.port, args.concurrency))
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
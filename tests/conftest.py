@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from google.cloud import firestore
+
+
+class FakeFirestore:
+    """In-memory Firestore supporting the batched writes and cursor queries used for chat history.
+
+    SERVER_TIMESTAMP fields get the fake server clock at commit; fail_commits
+    makes the next commits raise.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.fail_commits = 0
+        self.commits = 0
+
+    def tick(self, seconds=1):
+        self.now += timedelta(seconds=seconds)
+        return self.now
+
+    def collection(self, name):
+        return FakeQuery(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append((ref, dict(data)))
+
+    def commit(self):
+        if self.db.fail_commits:
+            self.db.fail_commits -= 1
+            raise RuntimeError("unavailable")
+        now = self.db.tick()
+        for ref, data in self.writes:
+            self.db.documents[ref] = {k: now if v is firestore.SERVER_TIMESTAMP else v for k, v in data.items()}
+        self.db.commits += 1
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeQuery:
+    def __init__(self, db, name, filters=(), order=None, limit_to=None, start=None):
+        self.db, self.name, self.filters, self.order, self.limit_to, self.start = \
+            db, name, filters, order, limit_to, start
+
+    def _with(self, **changes):
+        state = dict(filters=self.filters, order=self.order, limit_to=self.limit_to, start=self.start)
+        state.update(changes)
+        return FakeQuery(self.db, self.name, **state)
+
+    def document(self, doc_id):
+        return (self.name, doc_id)
+
+    def where(self, field, op, value):
+        assert op == "=="
+        return self._with(filters=self.filters + ((field, value),))
+
+    def order_by(self, field, direction=None):
+        return self._with(order=field)
+
+    def limit(self, count):
+        return self._with(limit_to=count)
+
+    def start_at(self, values):
+        return self._with(start=(values[self.order], ""))
+
+    def start_after(self, snapshot):
+        return self._with(start=(snapshot.to_dict()[self.order], snapshot.id))
+
+    def stream(self):
+        docs = sorted(((data[self.order], doc_id, data) for (name, doc_id), data in self.db.documents.items()
+                       if name == self.name and all(data.get(f) == v for f, v in self.filters)),
+                      key=lambda row: row[:2])
+        if self.start is not None:
+            docs = [row for row in docs if (row[0], row[1]) > self.start]
+        return [FakeSnapshot(doc_id, data) for _, doc_id, data in docs[:self.limit_to]]
+
+
+@pytest.fixture
+def firestore_db():
+    return FakeFirestore()
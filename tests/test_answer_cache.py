@@ -0,0 +1,46 @@
+import numpy as np
+
+import rag_backend as rb
+
+
+def make_cache(tmp_path):
+    return rb.SemanticAnswerCache(path=str(tmp_path / "answers.sqlite3"))
+
+
+def test_same_question_with_different_history_misses(tmp_path):
+    cache = make_cache(tmp_path)
+    embedding = np.ones(8, dtype="float32")
+    history_a = [{"role": "user", "content": "List the supported GPUs."},
+                 {"role": "assistant", "content": "A100 and H100."}]
+    history_b = [{"role": "user", "content": "Which plans do you offer?"},
+                 {"role": "assistant", "content": "Basic and Pro."}]
+    scope_a = rb.answer_cache_scope(None, "alice", history_a)
+    assert cache.put(scope_a, "What about the second one?", embedding, "The H100 ...")
+
+    assert cache.lookup(scope_a, embedding)["answer"] == "The H100 ..."
+    assert cache.lookup(rb.answer_cache_scope(None, "alice", history_b), embedding) is None
+    assert cache.lookup(rb.answer_cache_scope(None, "alice"), embedding) is None
+
+
+def test_answers_are_not_shared_between_users(tmp_path):
+    cache = make_cache(tmp_path)
+    embedding = np.ones(8, dtype="float32")
+    cache.put(rb.answer_cache_scope(None, "alice"), "What is my balance?", embedding, "Yours is 10.")
+
+    assert cache.lookup(rb.answer_cache_scope(None, "bob"), embedding) is None
+
+
+def test_answers_from_failed_retrieval_are_not_cached(tmp_path):
+    cache = make_cache(tmp_path)
+    embedding = np.ones(8, dtype="float32")
+    scope = rb.answer_cache_scope(None, "alice")
+
+    for sources in ([], [("Error searching web: timed out", "web")]):
+        stream = rb.cache_answer_stream(iter(["I could not find ", "anything."]), cache, scope, "Q?", embedding,
+                                        "web search", sources)
+        assert "".join(stream) == "I could not find anything."
+        assert cache.lookup(scope, embedding) is None
+
+    "".join(rb.cache_answer_stream(iter(["Answer."]), cache, scope, "Q?", embedding, "web search",
+                                   [("Some snippet", "web")]))
+    assert cache.lookup(scope, embedding)["answer"] == "Answer."
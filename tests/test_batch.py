@@ -0,0 +1,59 @@
+import json
+
+import rag_backend as rb
+
+
+class EchoPipeline:
+    def __init__(self, fail_on=()):
+        self.asked = []
+        self.fail_on = set(fail_on)
+
+    def answer(self, question):
+        self.asked.append(question)
+        if question in self.fail_on:
+            raise RuntimeError("retrieval failed")
+        return {"question": question, "answer": question.upper(), "timings": {"total": 0.01}}
+
+
+def read_results(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_batch_answers_every_question(tmp_path):
+    input_path, output_path = tmp_path / "questions.jsonl", tmp_path / "answers.jsonl"
+    input_path.write_text('{"id": "a", "question": "first?"}\n\n'
+                          '{"request_id": "b", "title": "Second", "body": "in detail?"}\n'
+                          '{"question": "third?"}\n')
+    summary = rb.run_batch(EchoPipeline(fail_on=["third?"]), str(input_path), str(output_path), concurrency=2)
+
+    results = {r["id"]: r for r in read_results(output_path)}
+    assert results["a"]["answer"] == "FIRST?"
+    assert results["b"]["question"] == "Second\n\nin detail?"
+    assert "retrieval failed" in results[4]["error"]  # no id: the line number
+    assert (summary["answered"], summary["errors"], summary["skipped"]) == (2, 1, 0)
+
+
+def test_batch_resumes_after_an_interrupted_run(tmp_path):
+    input_path, output_path = tmp_path / "questions.jsonl", tmp_path / "answers.jsonl"
+    input_path.write_text("".join(json.dumps({"id": i, "question": f"q{i}?"}) + "\n" for i in range(5)))
+    # The run was killed while writing the result of question 2.
+    output_path.write_text(json.dumps({"id": 0, "answer": "Q0?", "timings": {"total": 0.01}}) + "\n"
+                           + json.dumps({"id": 1, "answer": "Q1?", "timings": {"total": 0.01}}) + "\n"
+                           + '{"id": 2, "answ')
+
+    pipeline = EchoPipeline()
+    summary = rb.run_batch(pipeline, str(input_path), str(output_path), concurrency=2)
+    assert sorted(pipeline.asked) == ["q2?", "q3?", "q4?"]
+    assert (summary["answered"], summary["skipped"]) == (3, 2)
+
+    lines = output_path.read_text().splitlines()
+    ids = []
+    for line in lines:
+        try:
+            ids.append(json.loads(line)["id"])
+        except json.JSONDecodeError:
+            assert line == '{"id": 2, "answ'
+    assert sorted(ids) == [0, 1, 2, 3, 4]
+
+    pipeline = EchoPipeline()
+    assert rb.run_batch(pipeline, str(input_path), str(output_path))["skipped"] == 5 and not pipeline.asked
@@ -0,0 +1,59 @@
+import pytest
+
+import benchmark
+import rag_backend as rb
+
+
+def test_sentence_chunks_end_on_boundaries_and_overlap_by_one_sentence():
+    text = "Alpha beta. Gamma delta epsilon. Zeta!\n\nEta theta iota kappa lambda mu nu xi omicron pi rho sigma tau."
+    spans, resume = rb.boundary_chunk_spans(text, "sentence", max_chars=35)
+    assert [text[start:end] for start, end in spans] == [
+        "Alpha beta. Gamma delta epsilon.",
+        "Gamma delta epsilon. Zeta!\n\n",
+        # A sentence longer than the budget is cut at the last space that fits.
+        "Eta theta iota kappa lambda mu nu",
+        "xi omicron pi rho sigma tau.",
+    ]
+    assert resume == len(text)
+
+    spans, _ = rb.boundary_chunk_spans(text, "sentence", max_chars=35, overlap=0)
+    assert [text[start:end] for start, end in spans][1] == "Zeta!\n\n"
+
+
+def test_unfinished_text_holds_back_chunks_that_could_change():
+    text = "One sentence here. Another one follows. And a third that is not done"
+    spans, resume = rb.boundary_chunk_spans(text, "sentence", max_chars=40, final=False)
+    final_spans, _ = rb.boundary_chunk_spans(text, "sentence", max_chars=40)
+    assert spans == final_spans[:2]
+    assert (resume, len(text)) == final_spans[2]
+
+
+@pytest.mark.parametrize("strategy", rb.CHUNK_STRATEGIES)
+def test_chunk_spans_point_into_the_document_text(strategy):
+    pages = [(n, " ".join(lines)) for n, lines in enumerate(benchmark.synthetic_pages(6, lines_per_page=20))]
+    pages.insert(3, (6, ""))  # pages without text are skipped
+    text = "".join(page_text + "\n" for _, page_text in pages if page_text)
+    page_starts = {}
+    offset = 0
+    for n, page_text in pages:
+        if page_text:
+            page_starts[n] = offset
+            offset += len(page_text) + 1
+
+    tokenizer = benchmark.StubTokenizer()
+    chunks = list(rb.iter_chunk_spans(pages, chunk_size=300, overlap=50, strategy=strategy,
+                                      tokenizer=tokenizer, max_tokens=60))
+    covered = [False] * len(text)
+    for chunk, page, start, end in chunks:
+        assert text[start:end] == chunk
+        assert page == max(n for n, page_start in page_starts.items() if page_start <= start)
+        if strategy == "token":
+            assert len(tokenizer(chunk)["input_ids"]) <= 60
+        else:
+            assert len(chunk) <= 300
+        covered[start:end] = [True] * (end - start)
+    assert all(covered[i] for i, c in enumerate(text) if not c.isspace())
+
+    if strategy == "sentence":
+        spans, _ = rb.boundary_chunk_spans(text, "sentence", max_chars=300)
+        assert [(start, end) for _, _, start, end in chunks] == spans
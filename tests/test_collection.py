@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+import benchmark
+import rag_backend as rb
+
+EMBEDDER = benchmark.HashingEmbedder(64)
+
+MANUAL = ["The XJ-200 pump must be primed before first use.",
+          "Replace the intake filter every six months.",
+          "All rights reserved. Do not redistribute this document."]
+GUIDE = ["Calibrate the pressure sensor after each firmware update.",
+         "Store the unit in a dry place between ten and thirty degrees.",
+         "All rights reserved. Do not redistribute this document."]
+
+
+def make_collection(storage="float32", index_type="flat"):
+    collection = rb.DocumentCollection(EMBEDDER.dim, index_type=index_type, storage=storage)
+    for doc_id, chunks in (("manual", MANUAL), ("guide", GUIDE)):
+        spans = np.array([(i, 0, len(chunk)) for i, chunk in enumerate(chunks)], dtype=np.int64)
+        collection.add_document(doc_id, f"{doc_id}.pdf", EMBEDDER.encode(chunks), chunks, spans)
+    return collection
+
+
+def search(collection, text, **kwargs):
+    return collection.search(EMBEDDER.encode([text]), **kwargs)[0]
+
+
+@pytest.mark.parametrize("storage", list(rb.VECTOR_STORAGES))
+@pytest.mark.parametrize("index_type", ["flat", "hnsw"])
+def test_add_filter_and_remove(storage, index_type):
+    collection = make_collection(storage, index_type)
+    assert len(collection) == 6 and collection.index.ntotal == 5
+
+    hit = search(collection, GUIDE[0], top_k=1)[0]
+    assert (hit["doc_id"], hit["name"], hit["text"], hit["page"]) == ("guide", "guide.pdf", GUIDE[0], 0)
+
+    hits = search(collection, GUIDE[0], top_k=5, doc_ids=["manual"])
+    assert hits and {h["doc_id"] for h in hits} == {"manual"}
+
+    assert collection.remove_document("guide")
+    assert "guide" not in collection and not collection.remove_document("guide")
+    assert len(collection) == 3 and collection.index.ntotal == 3
+    assert {h["doc_id"] for h in search(collection, GUIDE[0], top_k=5)} == {"manual"}
+
+
+def test_duplicate_chunks_share_one_vector():
+    collection = make_collection()
+    hits = search(collection, MANUAL[2], top_k=5)
+    shared = [h for h in hits if h["text"] == MANUAL[2]]
+    assert len(shared) == 1 and shared[0]["duplicates"] == 1 and shared[0]["doc_id"] == "manual"
+
+    # The shared vector stays while another document still uses it.
+    collection.remove_document("manual")
+    hit = search(collection, MANUAL[2], top_k=1)[0]
+    assert (hit["doc_id"], hit["text"], hit["duplicates"]) == ("guide", GUIDE[2], 0)
+    collection.remove_document("guide")
+    assert collection.index.ntotal == 0 and search(collection, MANUAL[2]) == []
+
+
+def test_hybrid_search_finds_exact_identifiers():
+    collection = make_collection()
+    hits = search(collection, "What is the XJ-200?", top_k=2, query_texts=["What is the XJ-200?"])
+    assert hits[0]["text"] == MANUAL[0] and hits[0]["score"] > 0
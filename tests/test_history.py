@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+import rag_backend as rb
+
+
+def make_writer(tmp_path, client_factory, name="spill"):
+    return rb.FirestoreHistoryWriter(client_factory, spill_path=str(tmp_path / f"{name}.jsonl"),
+                                     flush_interval=0.01, base_backoff=0.01, max_backoff=0.02)
+
+
+def test_retried_batch_carries_its_commit_time(tmp_path, firestore_db):
+    available = False
+    late = make_writer(tmp_path, lambda: firestore_db if available else None, "late")
+    prompt = make_writer(tmp_path, lambda: firestore_db, "prompt")
+    try:
+        late_id = late.submit("alice", "First?", "One.")
+        prompt_id = prompt.submit("alice", "Second?", "Two.")
+        assert prompt.flush()
+        available = True
+        assert late.flush()
+    finally:
+        late.close()
+        prompt.close()
+
+    first = firestore_db.documents[("chat_history", late_id)]
+    second = firestore_db.documents[("chat_history", prompt_id)]
+    assert first["submitted_at"] < second["submitted_at"]
+    assert first["timestamp"] > second["timestamp"]
+
+
+def test_failed_commits_are_retried_and_the_journal_compacted(tmp_path, firestore_db):
+    firestore_db.fail_commits = 2
+    writer = make_writer(tmp_path, lambda: firestore_db)
+    try:
+        ids = {writer.submit("alice", f"Q{i}?", "A.") for i in range(5)}
+        assert writer.flush()
+        assert writer.stats["retries"] == 2 and writer.stats["committed"] == 5
+        assert writer.pending() == 0
+    finally:
+        writer.close()
+    assert {doc_id for _, doc_id in firestore_db.documents} == ids
+
+
+def test_record_after_torn_line_survives_replay(tmp_path, firestore_db):
+    spill_path = tmp_path / "spill.jsonl"
+    spill_path.write_text('{"id": "a", "username": "alice", "question": "Q?", "answer": "A.", "timestamp": 1.0}\n'
+                          '{"id": "b", "username": "al')
+    offline = make_writer(tmp_path, lambda: None)
+    try:
+        new_id = offline.submit("alice", "After the crash?", "Kept.")
+        assert offline.pending() == 2
+    finally:
+        offline.close(timeout=0.1)
+
+    replay = make_writer(tmp_path, lambda: firestore_db)
+    try:
+        assert replay.flush()
+        assert replay.pending() == 0
+    finally:
+        replay.close()
+    assert {doc_id for _, doc_id in firestore_db.documents} == {"a", new_id}
+
+
+def test_compaction_keeps_records_appended_by_another_process(tmp_path, firestore_db, monkeypatch):
+    writer = make_writer(tmp_path, lambda: firestore_db)
+    other = make_writer(tmp_path, lambda: None)
+    appended = []
+    replace = os.replace
+
+    def append_then_replace(src, dst):
+        # Another writer appends while the journal is being compacted.
+        if dst == writer.spill_path and not appended:
+            thread = threading.Thread(target=lambda: appended.append(other.submit("bob", "Q?", "B.")))
+            thread.start()
+            thread.join(0.2)
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", append_then_replace)
+    try:
+        writer.submit("alice", "Q?", "A.")
+        assert writer.flush()
+        while not appended:
+            time.sleep(0.01)
+        assert other.pending() == 1
+    finally:
+        writer.close()
+        other.close(timeout=0.1)
+
+
+def add_documents(db, username, count, start=0):
+    for i in range(start, start + count):
+        db.documents[("chat_history", f"{username}-{i:05d}")] = {
+            "username": username, "question": f"Q{i}?", "answer": f"A{i}.", "timestamp": db.tick()}
+
+
+def test_sync_pages_through_history_once(tmp_path, firestore_db):
+    add_documents(firestore_db, "alice", 1238)
+    add_documents(firestore_db, "bob", 3)
+    store = rb.HistoryStore(lambda: firestore_db, path=str(tmp_path / "history.sqlite3"), page_size=100)
+
+    assert store.sync("alice") == 1238
+    assert store.count("alice") == 1238
+    assert store.sync("alice") == 0
+    assert [row["Question"] for row in store.page("alice", 0, page_size=2)] == ["Q1237?", "Q1236?"]
+    assert sum(len(rows) for rows in store.iter_rows("alice", chunk_size=500)) == 1238
+
+
+def test_sync_picks_up_late_commits(tmp_path, firestore_db):
+    add_documents(firestore_db, "alice", 10)
+    store = rb.HistoryStore(lambda: firestore_db, path=str(tmp_path / "history.sqlite3"), page_size=4)
+    assert store.sync("alice") == 10
+
+    # A record stamped before rows that are already synced.
+    firestore_db.documents[("chat_history", "late")] = {
+        "username": "alice", "question": "Late?", "answer": "Yes.",
+        "timestamp": firestore_db.now - timedelta(seconds=5)}
+    assert store.sync("alice") == 1
+
+    available = False
+    writer = make_writer(tmp_path, lambda: firestore_db if available else None)
+    try:
+        writer.submit("alice", "Written while offline?", "Yes.")
+        add_documents(firestore_db, "alice", 1, start=10)
+        assert store.sync("alice") == 1
+        available = True
+        assert writer.flush()
+    finally:
+        writer.close()
+    assert store.sync("alice") == 1
+    assert store.count("alice") == 13
+
+
+def test_failed_firestore_connection_is_not_cached(tmp_path, monkeypatch):
+    key_file = tmp_path / "firestore-key.json"
+    key_file.write_text("{}")
+    attempts = []
+
+    class Credentials:
+        project_id = "carag"
+
+        @staticmethod
+        def from_service_account_file(path):
+            attempts.append(path)
+            if len(attempts) == 1:
+                raise ValueError("invalid key file")
+            return Credentials()
+
+    monkeypatch.delenv("FIRESTORE_EMULATOR_HOST", raising=False)
+    monkeypatch.setattr(rb, "FIRESTORE_KEY_FILE", str(key_file))
+    monkeypatch.setattr(rb, "service_account", SimpleNamespace(Credentials=Credentials))
+    monkeypatch.setattr(rb, "firestore", SimpleNamespace(Client=lambda credentials, project: f"client:{project}"))
+    rb._connect_firestore.clear()
+    try:
+        assert rb.get_firestore_client() is None
+        assert rb.get_firestore_client() == "client:carag"
+        assert rb.get_firestore_client() == "client:carag"
+        assert len(attempts) == 2
+    finally:
+        rb._connect_firestore.clear()
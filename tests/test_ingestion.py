@@ -0,0 +1,30 @@
+import benchmark
+import rag_backend as rb
+
+
+def use_tmp_caches(tmp_path, monkeypatch):
+    vectors = rb.ChunkVectorCache(str(tmp_path / "vectors.sqlite3"))
+    pages = rb.PageTextCache(str(tmp_path / "pages.sqlite3"))
+    monkeypatch.setattr(rb, "get_chunk_vector_cache", lambda: vectors)
+    monkeypatch.setattr(rb, "get_page_text_cache", lambda: pages)
+    return vectors
+
+
+def test_caches_are_keyed_by_the_model_passed(tmp_path, monkeypatch):
+    vectors = use_tmp_caches(tmp_path, monkeypatch)
+    pdf_bytes = benchmark.make_pdf(benchmark.synthetic_pages(3))
+    cache_dir = str(tmp_path / "indexes")
+
+    small = rb.load_or_build_document(pdf_bytes, benchmark.HashingEmbedder(64), cache_dir=cache_dir)
+    large_model = benchmark.HashingEmbedder(128)
+    large = rb.load_or_build_document(pdf_bytes, large_model, cache_dir=cache_dir)
+    assert small["key"] != large["key"]
+    assert (small["index"].d, large["index"].d) == (64, 128)
+    assert large_model.encoded > 0
+
+    # Same dimension, different model: the chunk vectors must not be reused either.
+    other = benchmark.HashingEmbedder(64)
+    other.model_id = "other-model"
+    embedder = rb.ChunkEmbedder(other, vectors)
+    embedder.encode(list(small["chunks"]))
+    assert embedder.stats["cached"] == 0 and other.encoded == embedder.stats["unique"]
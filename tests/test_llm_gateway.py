@@ -0,0 +1,122 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from llm_gateway import FakeLLMBackend, LLMError, LLMGateway, TokenBucket
+
+
+def test_oversized_call_debt_is_capped():
+    bucket = TokenBucket(100)
+    bucket.charge(1000)
+    assert bucket.tokens >= -100
+
+
+def test_oversized_call_does_not_block_the_model_for_minutes():
+    gateway = LLMGateway(FakeLLMBackend(responder=lambda model, messages: "word " * 1000), model_limits={},
+                         tokens_per_minute=100)
+    try:
+        gateway.complete("m", [{"role": "user", "content": "Summarize everything."}], timeout=5)
+        bucket = gateway._limiters["m"].tokens
+        assert bucket.tokens >= -100
+        # Two minutes of refill cover the debt and the next prompt.
+        bucket.updated -= 120
+        started = time.perf_counter()
+        gateway.complete("m", [{"role": "user", "content": "And again."}], timeout=5)
+        assert time.perf_counter() - started < 1
+    finally:
+        gateway.close()
+
+
+def make_gateway(backend, **kwargs):
+    return LLMGateway(backend, model_limits=kwargs.pop("model_limits", {}), base_backoff=0.001, max_backoff=0.01,
+                      **kwargs)
+
+
+MESSAGES = [{"role": "user", "content": "Hello there"}]
+
+
+def test_retryable_errors_are_retried():
+    gateway = make_gateway(FakeLLMBackend(failures=[429, 503]))
+    try:
+        assert gateway.complete("m", MESSAGES, timeout=5) == "Echo: Hello there"
+        assert (gateway.stats["retries"], gateway.stats["failures"]) == (2, 0)
+    finally:
+        gateway.close()
+
+
+def test_client_errors_and_exhausted_retries_raise():
+    gateway = make_gateway(FakeLLMBackend(failures=[400]))
+    try:
+        with pytest.raises(LLMError):
+            gateway.complete("m", MESSAGES, timeout=5)
+        assert (gateway.stats["retries"], gateway.stats["failures"]) == (0, 1)
+    finally:
+        gateway.close()
+
+    gateway = make_gateway(FakeLLMBackend(failures=[500] * 3), max_retries=2)
+    try:
+        with pytest.raises(LLMError):
+            gateway.complete("m", MESSAGES, timeout=5)
+        assert gateway.stats["retries"] == 2
+    finally:
+        gateway.close()
+
+
+def test_stream_retries_only_before_the_first_delta():
+    gateway = make_gateway(FakeLLMBackend(failures=[503], chunk_words=1))
+    try:
+        assert "".join(gateway.stream("m", MESSAGES)) == "Echo: Hello there"
+        assert gateway.stats["retries"] == 1
+    finally:
+        gateway.close()
+
+    class FailingMidStream(FakeLLMBackend):
+        async def stream(self, model, messages, usage=None, **params):
+            yield "partial "
+            raise LLMError("connection reset", status_code=503)
+
+    gateway = make_gateway(FailingMidStream())
+    try:
+        deltas = []
+        with pytest.raises(LLMError):
+            for delta in gateway.stream("m", MESSAGES):
+                deltas.append(delta)
+        assert deltas == ["partial "] and gateway.stats["retries"] == 0
+    finally:
+        gateway.close()
+
+
+def test_requests_wait_for_their_model_bucket_only():
+    gateway = make_gateway(FakeLLMBackend(), model_limits={"slow": {"rpm": 600}})
+    try:
+        gateway.complete("slow", MESSAGES, timeout=5)
+        gateway._limiters["slow"].requests.tokens = 0
+        started = time.perf_counter()
+        gateway.complete("fast", MESSAGES, timeout=5)
+        assert time.perf_counter() - started < 0.05
+        gateway.complete("slow", MESSAGES, timeout=5)
+        assert time.perf_counter() - started >= 0.08
+    finally:
+        gateway.close()
+
+
+def test_token_bucket_is_sized_from_rate_limit_headers():
+    class RateLimited(FakeLLMBackend):
+        async def complete(self, model, messages, usage=None, **params):
+            if not self.calls:
+                self.calls.append(model)
+                error = LLMError("rate limited", status_code=429)
+                error.response = SimpleNamespace(headers={"x-ratelimit-limit-tokens": "12000",
+                                                          "x-ratelimit-remaining-tokens": "11000"})
+                raise error
+            return await super().complete(model, messages, usage, **params)
+
+    gateway = make_gateway(RateLimited())
+    try:
+        assert gateway.complete("m", MESSAGES, timeout=5) == "Echo: Hello there"
+        bucket = gateway._limiters["m"].tokens
+        assert bucket.capacity == 12000 and bucket.tokens <= 11000
+        assert gateway.stats["tokens"] > 0
+    finally:
+        gateway.close()
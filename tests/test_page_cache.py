@@ -0,0 +1,83 @@
+import rag_backend as rb
+
+
+def build_pdf(pages, contents_as_array=False):
+    """Writes a PDF whose pages draw their text lines through a form XObject.
+
+    Every page has the same content stream ("/Fm1 Do"); only the XObject differs.
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        form = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("latin-1")
+        objects.append(b"<< /Type /XObject /Subtype /Form /BBox [0 0 612 792]"
+                       b" /Resources << /Font << /F1 3 0 R >> >> /Length %d >>\nstream\n" % len(form)
+                       + form + b"\nendstream")
+        form_id = len(objects)
+        content = b"q /Fm1 Do Q"
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        contents = b"[%d 0 R]" % len(objects) if contents_as_array else b"%d 0 R" % len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792]"
+                       b" /Resources << /XObject << /Fm1 %d 0 R >> >> /Contents %s >>" % (form_id, contents))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{k} 0 R" for k in kids).encode(), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def extract(pdf_bytes, cache):
+    return [text for _, text in rb.iter_pdf_pages(pdf_bytes, extractor="pdfplumber", cache=cache)]
+
+
+def test_documents_with_identical_content_streams_do_not_share_text(tmp_path):
+    cache = rb.PageTextCache(str(tmp_path / "pages.sqlite3"))
+    first = build_pdf(["Alpha page one", "Alpha page two"])
+    second = build_pdf(["Beta page one", "Beta page two"])
+
+    assert extract(first, cache) == ["Alpha page one", "Alpha page two"]
+    assert extract(second, cache) == ["Beta page one", "Beta page two"]
+
+
+def test_revised_document_reuses_unchanged_pages(tmp_path, monkeypatch):
+    cache = rb.PageTextCache(str(tmp_path / "pages.sqlite3"))
+    original = build_pdf(["Page one", "Page two", "Page three"], contents_as_array=True)
+    revised = build_pdf(["Page one", "Page two revised", "Page three"], contents_as_array=True)
+    assert extract(original, cache) == ["Page one", "Page two", "Page three"]
+
+    extracted = []
+    batch = rb._extract_page_batch
+    monkeypatch.setattr(rb, "_extract_page_batch",
+                        lambda pages, *args: extracted.extend(pages) or batch(pages, *args))
+    assert extract(revised, cache) == ["Page one", "Page two revised", "Page three"]
+    assert extracted == [1]
+
+
+def test_index_key_depends_on_extractor():
+    pdf_bytes = build_pdf(["Page one"])
+    assert (rb.compute_index_key(pdf_bytes, "model", extractor="pdfplumber")
+            != rb.compute_index_key(pdf_bytes, "model", extractor="pdfminer"))
+
+
+def test_pool_is_only_started_for_large_extractions(monkeypatch):
+    pdf_bytes = build_pdf([f"Page {i}" for i in range(12)])
+    pool = rb.ProcessPoolExecutor
+    started = []
+    monkeypatch.setattr(rb, "ProcessPoolExecutor",
+                        lambda *args, **kwargs: started.append(args) or pool(*args, **kwargs))
+
+    texts = [text for _, text in rb.iter_pdf_pages(pdf_bytes, max_workers=2, pages_per_task=2, extractor="pdfminer")]
+    assert texts == [f"Page {i}" for i in range(12)] and not started
+
+    texts = [text for _, text in rb.iter_pdf_pages(pdf_bytes, max_workers=2, pages_per_task=2, extractor="pdfminer",
+                                                   min_parallel_pages=12)]
+    assert texts == [f"Page {i}" for i in range(12)] and started
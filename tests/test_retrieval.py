@@ -0,0 +1,40 @@
+import numpy as np
+
+import rag_backend as rb
+
+
+def test_tokenize_keeps_identifiers_whole():
+    assert rb.tokenize("Order XJ-200 (rev. 3.1) now") == ["order", "xj-200", "rev", "3.1", "now"]
+
+
+def test_bm25_ranks_rare_terms_and_respects_masks():
+    index = rb.BM25Index()
+    index.add(["the pump and the filter", "the pump", "the XJ-200 pump", "unrelated text"])
+
+    rows, scores = index.search("XJ-200 pump", top_k=3)
+    assert rows[0] == 2 and list(scores) == sorted(scores, reverse=True)
+    assert 3 not in rows
+
+    rows, _ = index.search("XJ-200 pump", mask=np.array([True, True, False, True]))
+    assert 2 not in rows and set(rows) == {0, 1}
+    assert len(index.search("nothing matches", top_k=3)[0]) == 0
+
+
+def test_bm25_rows_stay_aligned_after_removal():
+    index = rb.BM25Index()
+    index.add(["alpha", "beta", "gamma"])
+    index.remove(np.array([True, False, True]))
+    index.add(["beta delta"])
+
+    assert len(index) == 3
+    assert list(index.search("gamma")[0]) == [1]
+    assert list(index.search("beta")[0]) == [2]
+
+
+def test_reciprocal_rank_fusion():
+    fused = rb.reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]])
+    assert [item for item, _ in fused] == ["b", "a", "d", "c"]
+    assert dict(fused)["b"] == 1 / 62 + 1 / 61
+
+    weighted = rb.reciprocal_rank_fusion([["a"], ["b"]], weights=[1.0, 2.0])
+    assert [item for item, _ in weighted] == ["b", "a"]
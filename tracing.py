@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import inspect
+import threading
+import functools
+import contextlib
+import contextvars
+from collections import deque
+
+# --- Tracing ---
+# A span times one backend call. Spans nest through a context variable, so a
+# chat turn becomes a tree (route -> embed -> FAISS search, generate -> first
+# token, ...), and finished spans feed per-name latency histograms. The tracer
+# keeps the most recent spans in memory for the app's debug panel, appends
+# every span to a JSON-lines file when CARAG_TRACE_FILE is set, and renders
+# its histograms in the Prometheus text format. Overhead is a couple of
+# perf_counter() calls and a deque append per span.
+
+TRACE_FILE = os.environ.get("CARAG_TRACE_FILE")
+# Histogram bucket upper bounds in seconds (Prometheus defaults, extended to 30s).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current_span = contextvars.ContextVar("carag_current_span", default=None)
+
+
+class Span:
+    """One timed operation. attrs holds free-form annotations."""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "duration", "attrs", "error", "_t0")
+
+    def __init__(self, name, parent=None, attrs=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = time.time()
+        self.duration = None
+        self.attrs = dict(attrs or {})
+        self.error = None
+        self._t0 = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {"name": self.name, "trace_id": self.trace_id, "span_id": self.span_id,
+                "parent_id": self.parent_id, "start": self.start,
+                "duration_ms": None if self.duration is None else round(self.duration * 1000, 3),
+                "attrs": self.attrs, "error": self.error}
+
+
+class LatencyHistogram:
+    """Bucketed latency counts plus a sliding window of samples for exact quantiles."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window=2048):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        self.samples.append(seconds)
+
+    def quantile(self, q):
+        """Returns the q-quantile (0..1) of the recent samples in seconds."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Tracer:
+    """Collects spans, histograms and exports."""
+
+    def __init__(self, trace_file=TRACE_FILE, max_spans=5000, enabled=True):
+        self.trace_file = trace_file
+        self.enabled = enabled
+        self.spans = deque(maxlen=max_spans)
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Times the enclosed block as a child of the current span."""
+        if not self.enabled:
+            yield Span(name, attrs=attrs)
+            return
+        span = Span(name, _current_span.get(), attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            self.end_span(span)
+
+    def start_span(self, name, **attrs):
+        """Starts a span without making it current (for generators); pass it to end_span()."""
+        return Span(name, _current_span.get(), attrs)
+
+    def end_span(self, span):
+        self.finish(span, time.perf_counter() - span._t0)
+
+    def finish(self, span, seconds):
+        span.duration = seconds
+        if not self.enabled:
+            return
+        with self._lock:
+            self.spans.append(span)
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = LatencyHistogram()
+            histogram.observe(seconds)
+            if self.trace_file:
+                try:
+                    with open(self.trace_file, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(span.to_dict()) + "\n")
+                except OSError as e:
+                    print(f"Failed to write trace: {e}")
+
+    def observe(self, name, seconds, parent=None, **attrs):
+        """Records a measurement taken elsewhere (e.g. time to first token) as a span."""
+        span = Span(name, parent or _current_span.get(), attrs)
+        span.start -= seconds
+        self.finish(span, seconds)
+
+    def trace(self, trace_id):
+        """Returns the recorded spans of one trace, in start order."""
+        with self._lock:
+            spans = [s for s in self.spans if s.trace_id == trace_id]
+        return sorted(spans, key=lambda s: s.start)
+
+    def summary(self):
+        """Returns {name: {count, mean_ms, p50_ms, p95_ms, p99_ms}}, slowest p95 first."""
+        with self._lock:
+            items = list(self.histograms.items())
+        rows = {}
+        for name, h in items:
+            rows[name] = {"count": h.count, "mean_ms": 1000 * h.total / max(h.count, 1)}
+            for q in (50, 95, 99):
+                rows[name][f"p{q}_ms"] = 1000 * h.quantile(q / 100)
+        return dict(sorted(rows.items(), key=lambda item: -item[1]["p95_ms"]))
+
+    def prometheus_text(self, metric="carag_span_duration_seconds"):
+        """Renders the histograms (and recent quantiles) in the Prometheus text format."""
+        lines = [f"# HELP {metric} Latency of traced backend operations.",
+                 f"# TYPE {metric} histogram"]
+        quantile_lines = [f"# HELP {metric}_quantile Latency quantiles over recent samples.",
+                          f"# TYPE {metric}_quantile gauge"]
+        with self._lock:
+            for name, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets_with_inf(h.buckets), h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{span="{name}"}} {h.total:.6f}')
+                lines.append(f'{metric}_count{{span="{name}"}} {h.count}')
+                for q in (0.5, 0.95, 0.99):
+                    quantile_lines.append(f'{metric}_quantile{{span="{name}",quantile="{q}"}} {h.quantile(q):.6f}')
+        return "\n".join(lines + quantile_lines) + "\n"
+
+    @staticmethod
+    def buckets_with_inf(buckets):
+        return [f"{b:g}" for b in buckets] + ["+Inf"]
+
+    def jsonl(self, trace_id=None):
+        """Returns recent spans (optionally of one trace) as JSON lines."""
+        spans = self.trace(trace_id) if trace_id else list(self.spans)
+        return "".join(json.dumps(s.to_dict()) + "\n" for s in spans)
+
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.histograms.clear()
+
+    def traced(self, name=None):
+        """Decorator that wraps each call in a span. Generators are timed until exhausted,
+        with the delay to their first item recorded as "<name>.first_item"."""
+        def decorate(fn):
+            span_name = name or fn.__name__
+            if inspect.isgeneratorfunction(fn):
+                @functools.wraps(fn)
+                def generator_wrapper(*args, **kwargs):
+                    # The span is not made current: it would leak into the consumer across yields.
+                    span = self.start_span(span_name)
+                    first = True
+                    generator = fn(*args, **kwargs)
+                    try:
+                        for item in generator:
+                            if first:
+                                self.observe(f"{span_name}.first_item", time.perf_counter() - span._t0, span)
+                                first = False
+                            yield item
+                    except BaseException as e:
+                        if not isinstance(e, GeneratorExit):
+                            span.error = repr(e)
+                        raise
+                    finally:
+                        generator.close()
+                        self.end_span(span)
+                return generator_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced